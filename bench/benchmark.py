@@ -0,0 +1,321 @@
+"""
+End-to-end throughput benchmark against the local fake Bot API.
+
+Three scenarios:
+
+* flow: many users concurrently walk /groups -> group -> Add schedule ->
+  message -> times, measuring the latency of every step (update pushed to
+  reply received). Needs a scratch PostgreSQL database in DATABASE_URL,
+  since it exercises the real data layer.
+* dispatch: loads synthetic schedules into the dispatcher, fires one
+  minute and measures sends per second through the send queue. Runs
+  without a database, unless --delivery-log records every attempt. With
+  --media every schedule sends one shared photo by file_id.
+* membership: a storm of my_chat_member updates (the bot added to many
+  groups, then removed from half of them), reporting how many database
+  transactions the buffered membership writer needed. Needs a database.
+
+Usage: python bench/benchmark.py --users 200 --schedules 20000
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+from collections import defaultdict
+from typing import Any, Dict, List
+
+os.environ.setdefault("DATABASE_SSLMODE", "disable")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fake_telegram import BOT_USER, FakeTelegram, serve  # noqa: E402
+from bot import build_application  # noqa: E402
+from db import DATABASE_URL, add_chat, close_pool, connection, init_db, pool_stats  # noqa: E402
+from sender import SendQueue  # noqa: E402
+from payloads import MediaItem, Payload, send as send_payload  # noqa: E402
+from schedules import Schedule, minutes_of  # noqa: E402
+
+BENCH_TOKEN = "123456:benchmark"
+# Synthetic user and chat ids, far away from real Telegram ids
+USER_ID_BASE = 9_000_000_000
+CHAT_ID_BASE = -9_000_000_000_000
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Return p50/p90/p99/max of a list of seconds, in milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {"p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": ordered[-1] * 1000}
+
+
+def user_json(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def message_update(api: FakeTelegram, user_id: int, text: str) -> Dict[str, Any]:
+    message = {
+        "message_id": api.new_message_id(),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user_json(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+def callback_update(user_id: int, message: Dict[str, Any], data: str) -> Dict[str, Any]:
+    return {
+        "callback_query": {
+            "id": f"{user_id}-{time.monotonic_ns()}",
+            "from": user_json(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        }
+    }
+
+
+def member_update(user_id: int, chat_id: int, old: str, new: str) -> Dict[str, Any]:
+    """Build a my_chat_member update for the bot in a group."""
+    return {
+        "my_chat_member": {
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"},
+            "from": user_json(user_id),
+            "date": int(time.time()),
+            "old_chat_member": {"status": old, "user": BOT_USER},
+            "new_chat_member": {"status": new, "user": BOT_USER},
+        }
+    }
+
+
+class Driver:
+    """Pushes updates for one user at a time and waits for the bot's reply."""
+
+    def __init__(self, api: FakeTelegram) -> None:
+        self.api = api
+        self.loop = asyncio.get_running_loop()
+        self.replies: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        api.on_reply = self._on_reply
+
+    def _on_reply(self, method: str, params: Dict[str, Any], result: Dict[str, Any]) -> None:
+        chat_id = int(params["chat_id"])
+        if chat_id > 0:
+            self.loop.call_soon_threadsafe(self.replies[chat_id].put_nowait, (params, result))
+
+    async def step(self, name: str, user_id: int, update: Dict[str, Any]):
+        started = time.monotonic()
+        self.api.push_update(update)
+        params, result = await asyncio.wait_for(self.replies[user_id].get(), 30)
+        self.latency[name].append(time.monotonic() - started)
+        return params, result
+
+    async def add_schedule_flow(self, user_id: int) -> None:
+        params, message = await self.step("/groups", user_id, message_update(self.api, user_id, "/groups"))
+        group = params["reply_markup"]["inline_keyboard"][0][0]["callback_data"]
+        _, message = await self.step("group_selected", user_id, callback_update(user_id, message, group))
+        _, message = await self.step("action_selected", user_id, callback_update(user_id, message, "add"))
+        await self.step("message_entered", user_id, message_update(self.api, user_id, "Benchmark message"))
+        await self.step("time_entered", user_id, message_update(self.api, user_id, "09:00, 18:00"))
+
+
+async def run_flow(api: FakeTelegram, app, users: int) -> None:
+    """Drive the add-schedule conversation for many users at once."""
+    for i in range(users):
+        add_chat(CHAT_ID_BASE - i, f"Bench group {i}", USER_ID_BASE + i)
+
+    driver = Driver(api)
+    await app.updater.start_polling(poll_interval=0.0, timeout=1)
+    started = time.monotonic()
+    await asyncio.gather(*(driver.add_schedule_flow(USER_ID_BASE + i) for i in range(users)))
+    elapsed = time.monotonic() - started
+    await app.updater.stop()
+    api.on_reply = None
+
+    steps = sum(len(samples) for samples in driver.latency.values())
+    print(f"\nFlow: {users} users, {steps} updates in {elapsed:.2f}s ({steps / elapsed:.1f} updates/s)")
+    for name, samples in driver.latency.items():
+        stats = percentiles(samples)
+        print(f"  {name:16s} " + "  ".join(f"{k}={v:.1f}ms" for k, v in stats.items()))
+
+
+async def run_dispatch(
+    api: FakeTelegram,
+    app,
+    schedules: int,
+    rate: float,
+    concurrency: int,
+    delivery_log: bool,
+    media: bool,
+) -> None:
+    """Fire one minute holding every synthetic schedule and time the drain."""
+    log = app.bot_data["delivery_log"] if delivery_log else None
+    queue = SendQueue(
+        lambda chat_id, message: send_payload(app.bot, chat_id, message),
+        rate=rate,
+        burst=rate,
+        concurrency=concurrency,
+        on_attempt=log.record if log else None,
+    )
+    app.bot_data["send_queue"] = queue
+    dispatcher = app.bot_data["dispatcher"]
+    # One asset for every schedule, as when a popular payload is deduplicated
+    photo = Payload(kind="photo", items=(MediaItem("photo", "bench-file-id", "bench-unique-id", "Daily"),))
+    # Negative ids never match stored schedules, so delivery log rows stay apart
+    dispatcher.load(
+        Schedule(
+            -1 - i,
+            USER_ID_BASE,
+            CHAT_ID_BASE - i,
+            f"Scheduled {i}",
+            minutes_of(["09:00"]),
+            "UTC",
+            payload=photo if media else None,
+        )
+        for i in range(schedules)
+    )
+
+    queue.start()
+    before = len(api.sent)
+    started = time.monotonic()
+    await dispatcher.fire(9 * 60)
+    fired = time.monotonic() - started
+    await queue.drain()
+    elapsed = time.monotonic() - started
+    await queue.stop()
+    if log:
+        flush_started = time.monotonic()
+        written = await log.flush()
+        flushed = time.monotonic() - flush_started
+
+    delivered = len(api.sent) - before
+    print(f"\nDispatch: {schedules} schedules due in one minute")
+    print(f"  fan-out (enqueue) time  {fired * 1000:.1f}ms")
+    print(f"  delivered {delivered} in {elapsed:.2f}s ({delivered / elapsed:.1f} sends/s)")
+    print(f"  retried {queue.retried}, dead-lettered {queue.failed}, 429s injected {api.rate_limited}")
+    if media:
+        contents = {id(message) for _, _, message in dispatcher.due(9 * 60)}
+        print(f"  media: {len(contents)} payload object(s) in the index, {api.uploads} file upload(s)")
+    if log:
+        print(f"  delivery log: final batch of {written} row(s) written in {flushed * 1000:.1f}ms")
+
+
+def count_chats(first: int, count: int) -> int:
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "SELECT count(*) FROM chats WHERE chat_id <= %s AND chat_id > %s;",
+                    (first, first - count),
+                )
+                return curs.fetchone()[0]
+
+
+async def run_membership(api: FakeTelegram, app, groups: int) -> None:
+    """Add the bot to many groups, remove it from half, and count transactions."""
+    # Separate id range from the flow scenario's groups
+    first = CHAT_ID_BASE - 1_000_000
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "DELETE FROM chats WHERE chat_id <= %s AND chat_id > %s;",
+                    (first, first - groups),
+                )
+    before = pool_stats()["checkouts"]
+    # app.start() skips post_init, which starts the writer's periodic flush
+    membership = app.bot_data["membership"]
+    membership.start()
+    await app.updater.start_polling(poll_interval=0.0, timeout=1)
+    started = time.monotonic()
+    for i in range(groups):
+        api.push_update(member_update(USER_ID_BASE + i % 50, first - i, "left", "member"))
+    for i in range(0, groups, 2):
+        api.push_update(member_update(USER_ID_BASE + i % 50, first - i, "member", "left"))
+    expected = groups // 2
+    while count_chats(first, groups) != expected or membership.pending():
+        if time.monotonic() - started > 60:
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    await app.updater.stop()
+    await membership.stop()
+    # The polling check above borrows connections too
+    checkouts = pool_stats()["checkouts"] - before
+    events = groups + (groups + 1) // 2
+    print(f"\nMembership: {events} my_chat_member updates for {groups} groups")
+    print(f"  applied in {elapsed:.2f}s, {count_chats(first, groups)}/{expected} groups kept")
+    print(f"  {checkouts} connection checkouts, including the progress checks")
+
+
+async def run(args: argparse.Namespace) -> None:
+    api = FakeTelegram(args.latency, args.error_rate, args.retry_after)
+    server = serve(api)
+    app = build_application(BENCH_TOKEN, f"http://127.0.0.1:{server.server_port}/bot")
+
+    async with app:
+        await app.start()
+        try:
+            if args.users:
+                if DATABASE_URL:
+                    init_db()
+                    await run_flow(api, app, args.users)
+                else:
+                    logging.warning("DATABASE_URL is not set; skipping the flow scenario")
+            if args.groups:
+                if DATABASE_URL:
+                    init_db()
+                    await run_membership(api, app, args.groups)
+                else:
+                    logging.warning("DATABASE_URL is not set; skipping the membership scenario")
+            if args.schedules:
+                if args.delivery_log:
+                    if DATABASE_URL:
+                        init_db()
+                    else:
+                        logging.warning("DATABASE_URL is not set; the delivery log cannot be written")
+                await run_dispatch(
+                    api,
+                    app,
+                    args.schedules,
+                    args.send_rate,
+                    args.concurrency,
+                    args.delivery_log,
+                    args.media,
+                )
+        finally:
+            await app.stop()
+    server.shutdown()
+    close_pool()
+    print(f"\nAPI calls: {dict(api.calls)}")
+
+
+def main() -> None:
+    """Run the benchmark scenarios."""
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="AutoSendBot end-to-end benchmark")
+    parser.add_argument("--users", type=int, default=100, help="concurrent users in the flow scenario (0 to skip)")
+    parser.add_argument("--schedules", type=int, default=10000, help="schedules fired in the dispatch scenario (0 to skip)")
+    parser.add_argument("--groups", type=int, default=0, help="groups in the membership storm scenario (0 to skip)")
+    parser.add_argument("--delivery-log", action="store_true", help="record dispatch sends in the delivery log")
+    parser.add_argument("--media", action="store_true", help="dispatch a shared photo instead of text")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API latency per call in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after returned with 429")
+    parser.add_argument("--send-rate", type=float, default=1000.0, help="global send rate for the dispatch scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="send workers for the dispatch scenario")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
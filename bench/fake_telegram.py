@@ -0,0 +1,284 @@
+"""
+Local stand-in for the Telegram Bot API, for offline benchmarks.
+
+Implements the methods the bot uses (getMe, getUpdates, deleteWebhook,
+sendMessage, the media sends and sendMediaGroup, editMessageText,
+editMessageReplyMarkup, answerCallbackQuery, getFile and file downloads) with
+configurable per-request latency and random 429 "Too Many Requests"
+injection. Updates are fed in with ``push_update`` and files sent by users
+with ``add_file``; every outgoing call is recorded, and file uploads
+(multipart requests) are counted and kept.
+
+Run standalone with: python bench/fake_telegram.py --port 8081 --latency 0.05
+and point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:8081/bot
+"""
+import json
+import time
+import email
+import random
+import logging
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "AutoSendBot", "username": "autosend_bot"}
+
+# Parameters sent as plain strings rather than JSON values
+_STRING_PARAMS = {
+    "text", "caption", "callback_query_id", "url", "secret_token", "parse_mode",
+    "photo", "video", "document", "animation", "audio",
+}
+
+# Media send methods and the parameter holding the file
+MEDIA_METHODS = {
+    "sendPhoto": "photo",
+    "sendVideo": "video",
+    "sendDocument": "document",
+    "sendAnimation": "animation",
+    "sendAudio": "audio",
+}
+# Methods that produce a reply visible to the user
+REPLY_METHODS = {
+    "sendMessage", "sendMediaGroup", "editMessageText", "editMessageReplyMarkup", *MEDIA_METHODS
+}
+
+
+class FakeTelegram:
+    """In-memory Bot API state shared by the HTTP handler threads."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.rate_limited = 0
+        # Requests that uploaded file contents instead of referencing a file_id
+        self.uploads = 0
+        # (filename, content) of every uploaded file
+        self.documents: List[Tuple[str, bytes]] = []
+        # file_id -> content of the files users sent, served for downloads
+        self.files: Dict[str, bytes] = {}
+        # (monotonic time, method, params) of every accepted reply
+        self.sent: List[Tuple[float, str, Dict[str, Any]]] = []
+        # Called with (method, params, result message) after every accepted reply
+        self.on_reply: Optional[Callable[[str, Dict[str, Any], Dict[str, Any]], None]] = None
+        self._updates: List[Dict[str, Any]] = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._cond = threading.Condition()
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        """Queue an update for getUpdates, assigning its update_id."""
+        with self._cond:
+            update = dict(update, update_id=self._next_update_id)
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+            return update["update_id"]
+
+    def add_file(self, content: bytes, file_name: str) -> Dict[str, Any]:
+        """Store a file as if a user sent it, returning its Document object."""
+        with self._cond:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = content
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"unique-{file_id}",
+            "file_name": file_name,
+            "file_size": len(content),
+        }
+
+    def new_message_id(self) -> int:
+        with self._cond:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+            return message_id
+
+    def get_updates(self, offset: int, timeout: float) -> List[Dict[str, Any]]:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return list(self._updates)
+
+    def handle(self, method: str, params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Return (HTTP status, response body) for one Bot API call."""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            updates = self.get_updates(
+                int(params.get("offset", 0)), float(params.get("timeout", 0))
+            )
+            return 200, {"ok": True, "result": updates}
+
+        if self.latency:
+            time.sleep(self.latency)
+        if method in REPLY_METHODS and random.random() < self.error_rate:
+            self.rate_limited += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery"):
+            return 200, {"ok": True, "result": True}
+        if method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+            return 200, {
+                "ok": True,
+                "result": {
+                    "file_id": file_id,
+                    "file_unique_id": f"unique-{file_id}",
+                    "file_size": len(self.files[file_id]),
+                    "file_path": f"documents/{file_id}",
+                },
+            }
+        if method == "sendMediaGroup":
+            messages = [
+                dict(self._message(params), caption=media.get("caption", ""))
+                for media in params["media"]
+            ]
+            self.sent.append((time.monotonic(), method, params))
+            if self.on_reply is not None:
+                self.on_reply(method, params, messages[0])
+            return 200, {"ok": True, "result": messages}
+        if method in REPLY_METHODS:
+            result = self._message(params)
+            if method in MEDIA_METHODS:
+                result["caption"] = params.get("caption", "")
+            self.sent.append((time.monotonic(), method, params))
+            if self.on_reply is not None:
+                self.on_reply(method, params, result)
+            return 200, {"ok": True, "result": result}
+        return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+
+    def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "message_id": int(params.get("message_id") or self.new_message_id()),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+
+def _decode_params(body: bytes) -> Dict[str, Any]:
+    params: Dict[str, Any] = {}
+    for key, value in parse_qsl(body.decode(), keep_blank_values=True):
+        if key in _STRING_PARAMS:
+            params[key] = value
+            continue
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def _decode_multipart(content_type: str, body: bytes, api: FakeTelegram) -> Dict[str, Any]:
+    # Uploaded files are kept on the API and replaced by their name
+    message = email.message_from_bytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    fields = []
+    for part in message.get_payload():
+        content = part.get_payload(decode=True) or b""
+        filename = part.get_filename()
+        if filename:
+            api.documents.append((filename, content))
+            content = filename.encode()
+        fields.append((part.get_param("name", header="content-disposition"), content.decode()))
+    return _decode_params(urlencode(fields).encode())
+
+
+def make_handler(api: FakeTelegram):
+    """Build a request handler class bound to one FakeTelegram instance."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            content_type = self.headers.get("Content-Type", "")
+            body = self.rfile.read(length)
+            if content_type.startswith("multipart/"):
+                api.uploads += 1
+                params = _decode_multipart(content_type, body, api)
+            else:
+                params = _decode_params(body)
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            status, body = api.handle(method, params)
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            try:
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                # Long polls are abandoned when the bot stops polling
+                pass
+
+        def do_GET(self) -> None:
+            if not self.path.startswith("/file/"):
+                self.do_POST()
+                return
+            # File downloads: /file/bot<token>/documents/<file_id>
+            content = api.files.get(self.path.rsplit("/", 1)[-1])
+            self.send_response(200 if content is not None else 404)
+            self.send_header("Content-Length", str(len(content or b"")))
+            self.end_headers()
+            self.wfile.write(content or b"")
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+def serve(api: FakeTelegram, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Start the fake API in a background thread and return the server."""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    """Run the fake API until interrupted."""
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after returned with 429")
+    args = parser.parse_args()
+
+    api = FakeTelegram(args.latency, args.error_rate, args.retry_after)
+    server = serve(api, args.host, args.port)
+    logging.info(f"Fake Bot API listening on http://{args.host}:{server.server_port}/bot")
+    try:
+        while True:
+            time.sleep(60)
+            logging.info(f"Calls so far: {dict(api.calls)}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
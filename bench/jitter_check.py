@@ -0,0 +1,123 @@
+"""
+Check that jittered fires of day-filtered schedules follow their planned day.
+
+A Monday-to-Friday schedule at 23:50 UTC is sent with a per-chat jitter of
+up to --jitter minutes. For a chat whose delay pushes the send past
+midnight, Friday's fire goes out on Saturday and must still be sent, while
+Sunday's goes out on Monday and must not be. A chat whose sends stay on the
+planned day is checked alongside. Both the regular per-minute fire and the
+missed-fire replay (recover) are checked, over Thursday to Sunday. Needs no
+database.
+
+Usage: python bench/jitter_check.py [--jitter 30]
+"""
+import os
+import sys
+import asyncio
+import argparse
+from datetime import date, datetime, timezone
+from typing import Dict, List, Set
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import dispatcher as dispatch  # noqa: E402
+from dispatcher import MINUTES_PER_DAY, Dispatcher, chat_offset, minute_of_day  # noqa: E402
+from recurrence import day_filter  # noqa: E402
+from schedules import Schedule, minutes_of  # noqa: E402
+
+# Planned fire time, minutes after midnight UTC
+FIRE_MINUTE = 23 * 60 + 50
+# Thursday to Sunday; the schedule fires Monday to Friday
+DAYS = [date(2026, 10, 15), date(2026, 10, 16), date(2026, 10, 17), date(2026, 10, 18)]
+WEEKDAYS = 0b0011111
+
+
+def schedule(schedule_id: int, chat_id: int) -> Schedule:
+    return Schedule(
+        schedule_id,
+        1,
+        chat_id,
+        f"Message {schedule_id}",
+        minutes_of(["23:50"]),
+        "UTC",
+        rule="weekdays 23:50",
+        days=day_filter("UTC", WEEKDAYS, None, None, None),
+        utc_minute=FIRE_MINUTE,
+        last_fired_at=datetime(2026, 1, 1, tzinfo=timezone.utc),
+    )
+
+
+def chat_with_offset(jitter: int, late: bool) -> int:
+    """Return a chat id whose jitter does (or does not) cross midnight."""
+    chat_id = -1001
+    while (chat_offset(chat_id, jitter) >= MINUTES_PER_DAY - FIRE_MINUTE) != late:
+        chat_id -= 1
+    return chat_id
+
+
+def planned(day: date) -> int:
+    return (day.toordinal() - date(1970, 1, 1).toordinal()) * MINUTES_PER_DAY + FIRE_MINUTE
+
+
+async def sent_days(schedules: List[Schedule], jitter: int, replay: bool) -> Dict[int, Set[str]]:
+    """Return the planned days each chat was sent on, by chat id."""
+    sent: Dict[int, Set[str]] = {}
+
+    async def send(chat_id: int, message: str, schedule_id: int, planned_at: float) -> None:
+        epoch_minute = int(planned_at // 60) - chat_offset(chat_id, jitter)
+        day = datetime.fromtimestamp(epoch_minute * 60, timezone.utc)
+        sent.setdefault(chat_id, set()).add(day.strftime("%a"))
+
+    async def run_async(func, *args):
+        return schedules
+
+    original = dispatch.run_async
+    dispatch.run_async = run_async
+    try:
+        for day in DAYS:
+            for item in schedules:
+                epoch_minute = planned(day) + chat_offset(item.chat_id, jitter)
+                # A fresh dispatcher per fire, so no fire masks another
+                dispatcher = Dispatcher(send, jitter_minutes=jitter, misfire_grace=3600)
+                if replay:
+                    await dispatcher.recover(epoch_minute)
+                else:
+                    dispatcher.load([item])
+                    await dispatcher.fire(minute_of_day(epoch_minute), epoch_minute)
+    finally:
+        dispatch.run_async = original
+    return sent
+
+
+def main() -> None:
+    """Fire the schedules on each day and compare the days they were sent on."""
+    parser = argparse.ArgumentParser(description="Day filter and jitter across midnight check")
+    parser.add_argument("--jitter", type=int, default=30, help="jitter window in minutes")
+    args = parser.parse_args()
+    if args.jitter <= MINUTES_PER_DAY - FIRE_MINUTE:
+        parser.error(f"--jitter must be over {MINUTES_PER_DAY - FIRE_MINUTE} to cross midnight")
+
+    chats = {
+        "crosses midnight": chat_with_offset(args.jitter, True),
+        "same day": chat_with_offset(args.jitter, False),
+    }
+    schedules = [schedule(i, chat_id) for i, chat_id in enumerate(chats.values(), 1)]
+    names = [day.strftime("%a") for day in DAYS]
+    expected = {"Thu", "Fri"}
+    failed = False
+    for path, replay in (("fire", False), ("recover", True)):
+        sent = asyncio.run(sent_days(schedules, args.jitter, replay))
+        for name, chat_id in chats.items():
+            days = sent.get(chat_id, set())
+            ok = days == expected
+            failed |= not ok
+            shown = ", ".join(d for d in names if d in days)
+            print(
+                f"  {path:<8} {name:<17} (+{chat_offset(chat_id, args.jitter):2d} min) "
+                f"sent for {shown or 'no days'}, expected Thu, Fri  {'ok' if ok else 'FAIL'}"
+            )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Memory and load-time benchmark of the in-memory schedule representations.
+
+Builds N synthetic schedules, as rows shaped like the ones the database
+returns, into each representation:
+
+- ``legacy``: the nested dicts of user_data.json,
+  ``{user_id: {chat_id: [{"message", "times"}]}}``, with string keys and times
+- ``dicts``: one dict per schedule with "HH:MM" string times, as db.py
+  returned them before schedules.Schedule
+- ``schedules``: schedules.Schedule objects, built through db.py's row mapping
+
+Each (representation, size) pair runs in a fresh process. The resident set
+growth is measured there, so one run does not inflate the next. As in real
+data, most schedules reuse a limited set of message texts and times, and
+every row carries its own string objects, as psycopg2 or json.load would
+return them.
+
+Usage: python bench/memory_model.py [--sizes 10000 100000 1000000]
+"""
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+from typing import Any, Dict, Iterator, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+REPRESENTATIONS = ("legacy", "dicts", "schedules")
+ZONES = ("UTC", "Europe/Berlin", "America/New_York", "Asia/Kolkata")
+COMMON_TIMES = ("08:00", "09:00", "09:30", "12:00", "13:00", "17:30", "18:00", "20:00")
+
+
+def rss_bytes() -> int:
+    """Return the current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak, not current, outside Linux; still fine for a one-shot child
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _fresh(text: str) -> str:
+    # A new str object with the same value, as a database driver returns it
+    return text.encode("utf-8").decode("utf-8")
+
+
+def generate_rows(count: int, texts: int, unique: float, seed: int = 1) -> Iterator[tuple]:
+    """Yield synthetic schedule rows in db.py's _SCHEDULE_COLUMNS order."""
+    rng = random.Random(seed)
+    pool = [
+        f"Daily reminder #{i}: stand-up in the main channel, please post your updates before noon."
+        for i in range(texts)
+    ]
+    for i in range(count):
+        owner_id = 1_000_000 + i // 20
+        chat_id = -1_000_000_000 - i // 5
+        if rng.random() < unique:
+            message = f"One-off note {i} for the group, written by hand."
+        else:
+            message = _fresh(rng.choice(pool))
+        times = [_fresh(t) for t in sorted(rng.sample(COMMON_TIMES, rng.randint(1, 3)))]
+        # A few broadcasts to several chats
+        chat_ids = [chat_id, chat_id - 1, chat_id - 2] if rng.random() < 0.05 else None
+        tz = _fresh(rng.choice(ZONES))
+        yield (i + 1, owner_id, chat_id, message, times, chat_ids, tz, None,
+               None, None, None, None, None)
+
+
+def build_legacy(rows: Iterator[tuple]) -> Dict[str, Any]:
+    data: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+    for row in rows:
+        _, owner_id, chat_id, message, times = row[:5]
+        data.setdefault(str(owner_id), {}).setdefault(str(chat_id), []).append(
+            {"message": message, "times": list(times)}
+        )
+    return data
+
+
+def build_dicts(rows: Iterator[tuple]) -> List[Dict[str, Any]]:
+    result = []
+    for row in rows:
+        (schedule_id, owner_id, chat_id, message, times, chat_ids, tz, payload_id,
+         rule, _, _, _, _) = row
+        result.append(
+            {
+                "id": schedule_id,
+                "owner_id": owner_id,
+                "chat_id": chat_id,
+                "message": message,
+                "times": list(times),
+                "chat_ids": list(chat_ids) if chat_ids else [chat_id],
+                "timezone": tz,
+                "payload_id": payload_id,
+                "rule": rule,
+                "days": None,
+            }
+        )
+    return result
+
+
+def build_schedules(rows: Iterator[tuple]) -> List[Any]:
+    # The real mapping, so the benchmark follows db.py
+    from db import _schedule_row
+
+    return [_schedule_row(row) for row in rows]
+
+
+def child(representation: str, count: int, texts: int, unique: float) -> Dict[str, Any]:
+    """Build one representation and return its RSS growth and load time."""
+    builders = {"legacy": build_legacy, "dicts": build_dicts, "schedules": build_schedules}
+    if representation == "schedules":
+        # Import outside the measurement
+        import db  # noqa: F401
+    build = builders[representation]
+    # Memory: rows are streamed, so only the built representation stays resident
+    gc.collect()
+    before = rss_bytes()
+    built = build(generate_rows(count, texts, unique))
+    gc.collect()
+    grown = rss_bytes() - before
+    # Load time: from rows produced beforehand, so generating them is not counted
+    rows = list(generate_rows(count, texts, unique, seed=2))
+    started = time.perf_counter()
+    build(rows)
+    seconds = time.perf_counter() - started
+    assert built
+    return {"rss_mb": grown / 2**20, "seconds": seconds, "bytes_per_schedule": grown / count}
+
+
+def run_child(representation: str, count: int, texts: int, unique: float) -> Optional[Dict[str, Any]]:
+    result = subprocess.run(
+        [
+            sys.executable, os.path.abspath(__file__), "--child", representation,
+            "--sizes", str(count), "--texts", str(texts), "--unique", str(unique),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1] if result.stderr else "child failed")
+        return None
+    return json.loads(result.stdout)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--texts", type=int, default=200, help="distinct shared message texts")
+    parser.add_argument("--unique", type=float, default=0.2, help="share of one-off messages")
+    parser.add_argument("--child", choices=REPRESENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child, args.sizes[0], args.texts, args.unique)))
+        return
+
+    print(f"{args.texts} shared texts, {args.unique:.0%} one-off messages")
+    print(f"{'schedules':>10}  {'representation':<10} {'RSS MB':>9} {'B/sched':>8} {'load s':>8}")
+    for count in args.sizes:
+        baseline = None
+        for representation in REPRESENTATIONS:
+            stats = run_child(representation, count, args.texts, args.unique)
+            if stats is None:
+                continue
+            baseline = baseline or stats
+            ratio = stats["rss_mb"] / baseline["rss_mb"] if baseline["rss_mb"] else 0
+            print(
+                f"{count:>10}  {representation:<10} {stats['rss_mb']:>9.1f} "
+                f"{stats['bytes_per_schedule']:>8.0f} {stats['seconds']:>8.2f}"
+                f"  ({ratio:.2f}x legacy RSS)"
+            )
+
+
+if __name__ == "__main__":
+    main()
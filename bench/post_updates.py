@@ -0,0 +1,125 @@
+"""
+Webhook test harness: POSTs synthetic updates to a locally served webhook.
+
+Starts the fake Bot API and the real application in webhook mode on
+localhost, checks that a request with a wrong secret token is rejected,
+then POSTs /start updates from many users concurrently and waits until the
+bot has answered every one. Reports the webhook acknowledgement latency and
+end-to-end throughput. No database is needed.
+
+Usage: python bench/post_updates.py --updates 2000 --clients 32 --concurrency 64
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fake_telegram import FakeTelegram, serve  # noqa: E402
+from benchmark import BENCH_TOKEN, USER_ID_BASE, message_update, percentiles  # noqa: E402
+from bot import build_application  # noqa: E402
+
+WEBHOOK_PATH = "telegram"
+SECRET = "local-test-secret"
+
+
+def post(url: str, update: dict, secret: str) -> Tuple[int, float]:
+    """POST one update and return (HTTP status, seconds until acknowledged)."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode(),
+        headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": secret,
+        },
+    )
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.monotonic() - started
+
+
+async def run(args: argparse.Namespace) -> None:
+    api = FakeTelegram(args.latency)
+    server = serve(api)
+    app = build_application(
+        BENCH_TOKEN,
+        f"http://127.0.0.1:{server.server_port}/bot",
+        concurrent_updates=args.concurrency,
+    )
+    url = f"http://127.0.0.1:{args.port}/{WEBHOOK_PATH}"
+    loop = asyncio.get_running_loop()
+
+    async with app:
+        await app.start()
+        await app.updater.start_webhook(
+            listen="127.0.0.1",
+            port=args.port,
+            url_path=WEBHOOK_PATH,
+            webhook_url=url,
+            secret_token=SECRET,
+        )
+        try:
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                update = dict(message_update(api, USER_ID_BASE, "/start"), update_id=0)
+                status, _ = await loop.run_in_executor(pool, post, url, update, "wrong-secret")
+                print(f"Wrong secret token -> HTTP {status} ({'ok' if status == 403 else 'UNEXPECTED'})")
+
+                updates = [
+                    dict(message_update(api, USER_ID_BASE + i, "/start"), update_id=i + 1)
+                    for i in range(args.updates)
+                ]
+                before = api.calls["sendMessage"]
+                started = time.monotonic()
+                results: List[Tuple[int, float]] = await asyncio.gather(
+                    *(loop.run_in_executor(pool, post, url, u, SECRET) for u in updates)
+                )
+                acked = time.monotonic() - started
+                while api.calls["sendMessage"] - before < args.updates:
+                    if time.monotonic() - started > 120:
+                        break
+                    await asyncio.sleep(0.01)
+                elapsed = time.monotonic() - started
+        finally:
+            await app.updater.stop()
+            await app.stop()
+    server.shutdown()
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    replies = api.calls["sendMessage"] - before
+    ack = percentiles([seconds for _, seconds in results])
+    print(f"POSTed {args.updates} updates with {args.clients} clients: statuses {statuses}")
+    print("  ack latency " + "  ".join(f"{k}={v:.1f}ms" for k, v in ack.items()))
+    print(f"  all acknowledged in {acked:.2f}s ({args.updates / acked:.1f} updates/s)")
+    print(f"  {replies} replies in {elapsed:.2f}s ({replies / elapsed:.1f} updates/s end to end)")
+
+
+def main() -> None:
+    """Run the webhook harness."""
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="POST synthetic updates to a local webhook")
+    parser.add_argument("--updates", type=int, default=1000, help="number of updates to POST")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent HTTP clients")
+    parser.add_argument("--concurrency", type=int, default=32, help="updates processed at once by the bot")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake API latency per call in seconds")
+    parser.add_argument("--port", type=int, default=8443, help="local webhook port")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Check missed-fire handling of a sharded dispatcher against a local PostgreSQL.
+
+Three cases, each with a schedule that fires every minute for the last few
+minutes and last fired some minutes ago:
+
+- restart: the dispatcher starts with its first shard leases, with the
+  misfire grace off. recover() sends nothing then, and the first tick must
+  not replay the missed fires for the "gained" initial shards either.
+- takeover: shards are gained later. The catch-up must skip fires at or
+  before last_fired_at, coalesce like recover() (or send each missed fire,
+  oldest first, with coalescing off), and come before the current minute.
+- lapse: the replica's own leases lapse (renewals failing) for longer than
+  the usual catch-up window, so its due fires are dropped. When a renewal
+  gets the same shards back, every fire since the lapse must be replayed.
+
+The restart case waits for the first tick, so it takes up to a minute.
+
+Usage: DATABASE_URL=... python bench/restart_check.py
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List
+
+os.environ.setdefault("DATABASE_SSLMODE", "disable")
+# Seeded times are UTC minutes
+os.environ["DEFAULT_TIMEZONE"] = "UTC"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from db import close_pool, connection, import_schedules, init_db, run_async  # noqa: E402
+from dispatcher import Dispatcher, minute_of_day  # noqa: E402
+from recurrence import format_minute  # noqa: E402
+from sharding import ShardCoordinator, shard_of  # noqa: E402
+
+# Synthetic owner of the seeded schedules
+OWNER_ID = 9_400_000_000
+
+
+def clear() -> None:
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "DELETE FROM schedule_fires WHERE schedule_id IN "
+                    "(SELECT id FROM schedules WHERE owner_id = %s);",
+                    (OWNER_ID,),
+                )
+                curs.execute("DELETE FROM schedules WHERE owner_id = %s;", (OWNER_ID,))
+
+
+def seed(chat_id: int, minutes: List[int], last_fired_minute: int) -> int:
+    """Store a schedule firing at the given epoch minutes, last fired at another."""
+    times = [format_minute(minute_of_day(minute)) for minute in minutes]
+    import_schedules([(OWNER_ID, chat_id, f"restart-check {chat_id}", times)])
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "UPDATE schedules SET last_fired_at = %s WHERE owner_id = %s AND chat_id = %s "
+                    "RETURNING id;",
+                    (datetime.fromtimestamp(last_fired_minute * 60, timezone.utc), OWNER_ID, chat_id),
+                )
+                return curs.fetchone()[0]
+
+
+def report(name: str, sent: List[int], expected: List[int], base: int) -> bool:
+    ok = sent == expected
+    shown = [minute - base for minute in sent]
+    print(f"  {name:<34} sent at minutes {shown}, expected {[m - base for m in expected]}  {'ok' if ok else 'FAIL'}")
+    return ok
+
+
+async def check() -> bool:
+    # schedule id -> planned epoch minutes, in send order
+    sends: Dict[int, List[int]] = {}
+
+    async def send(chat_id: int, message: str, schedule_id: int, planned_at: float) -> None:
+        sends.setdefault(schedule_id, []).append(int(planned_at // 60))
+
+    now = int(time.time() // 60)
+    restarted = seed(-9_400_000_001, list(range(now - 10, now)), now - 10)
+
+    coordinator = ShardCoordinator(shard_count=4, lease_seconds=30)
+    dispatcher = Dispatcher(
+        send, jitter_minutes=0, coordinator=coordinator, persistent=True, misfire_grace=0
+    )
+    await coordinator.start()
+    dispatcher.start()
+    try:
+        # Wait for the first tick after recover()
+        deadline = (now + 1) * 60 + 5
+        while time.time() < deadline:
+            await asyncio.sleep(0.5)
+        ok = report("restart, misfire grace off", sends.get(restarted, []), [], now)
+
+        # A takeover: every held shard counts as newly gained
+        tick = int(time.time() // 60)
+        coalesced = seed(-9_400_000_002, list(range(tick - 6, tick)), tick - 3)
+        coordinator._gained |= coordinator.shards
+        replay = Dispatcher(
+            send, jitter_minutes=0, coordinator=coordinator, persistent=True, coalesce=True
+        )
+        await replay._catch_up_gained_shards(tick)
+        ok &= report("takeover, coalesced", sends.get(coalesced, []), [tick - 1], tick)
+
+        each = seed(-9_400_000_003, list(range(tick - 6, tick)), tick - 3)
+        replay = Dispatcher(
+            send, jitter_minutes=0, coordinator=coordinator, persistent=True, coalesce=False
+        )
+        coordinator._gained |= coordinator.shards
+        await replay._catch_up_gained_shards(tick)
+        ok &= report("takeover, each missed fire", sends.get(each, []), [tick - 2, tick - 1], tick)
+    finally:
+        await dispatcher.stop()
+        await coordinator.stop()
+    return ok & await lapse(send, sends)
+
+
+async def lapse(send, sends: Dict[int, List[int]]) -> bool:
+    """Drop fires while the leases have lapsed, then renew the same shards."""
+    # Renewed by hand only, so the lapse lasts exactly as long as intended
+    coordinator = ShardCoordinator(shard_count=4, lease_seconds=30)
+    await run_async(coordinator.renew)
+    coordinator.pop_gained()
+    chat_id = -9_400_000_004
+    while shard_of(chat_id, coordinator.shard_count) not in coordinator.shards:
+        chat_id -= 1
+    tick = int(time.time() // 60)
+    lapsed = seed(chat_id, list(range(tick - 9, tick)), tick - 10)
+    dispatcher = Dispatcher(
+        send, jitter_minutes=0, coordinator=coordinator, persistent=True, coalesce=False
+    )
+    try:
+        # Renewals have failed for ten minutes
+        coordinator._valid_until = time.monotonic() - 600
+        await dispatcher.fire(minute_of_day(tick - 1), tick - 1)
+        ok = report("lapse, nothing sent while lapsed", sends.get(lapsed, []), [], tick)
+        await run_async(coordinator.renew)
+        await dispatcher._catch_up_gained_shards(tick)
+        ok &= report("lapse, replayed after renewal", sends.get(lapsed, []), list(range(tick - 9, tick)), tick)
+    finally:
+        await coordinator.stop()
+    return ok
+
+
+def main() -> None:
+    """Seed the schedules, run the cases and exit non-zero on a failure."""
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    init_db()
+    clear()
+    try:
+        ok = asyncio.run(check())
+    finally:
+        clear()
+        close_pool()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
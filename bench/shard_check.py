@@ -0,0 +1,162 @@
+"""
+Multi-process check of sharded dispatch against a local PostgreSQL.
+
+Seeds schedules, then starts several replica processes that each lease
+shards and fire a virtual clock (one minute per --tick seconds). One replica
+is killed part-way through; the survivors must take over its shards. At the
+end every (schedule, minute) must have been sent exactly once.
+
+Usage: DATABASE_URL=... python bench/shard_check.py --replicas 3 --minutes 30
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import logging
+import argparse
+import subprocess
+from collections import Counter
+
+os.environ.setdefault("DATABASE_SSLMODE", "disable")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from db import close_pool, connection, import_schedules, init_db  # noqa: E402
+from dispatcher import Dispatcher, minute_of_day  # noqa: E402
+from sharding import ShardCoordinator  # noqa: E402
+
+# Synthetic owner and message prefix for the seeded schedules
+OWNER_ID = 9_100_000_000
+PREFIX = "shard-check:"
+
+
+def seed(schedules: int, first_minute: int, minutes: int) -> None:
+    """Replace the synthetic schedules; message i fires at first_minute + i % minutes."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "DELETE FROM schedule_fires WHERE schedule_id IN "
+                    "(SELECT id FROM schedules WHERE owner_id = %s);",
+                    (OWNER_ID,),
+                )
+                curs.execute("DELETE FROM schedules WHERE owner_id = %s;", (OWNER_ID,))
+    plan = [first_minute + i % minutes for i in range(schedules)]
+    rows = []
+    for i, epoch_minute in enumerate(plan):
+        minute = minute_of_day(epoch_minute)
+        rows.append(
+            (OWNER_ID, -random.randrange(10**12), f"{PREFIX}{i}", [f"{minute // 60:02d}:{minute % 60:02d}"])
+        )
+    import_schedules(rows)
+
+
+async def replica(args: argparse.Namespace) -> None:
+    """Run one replica on the shared virtual clock, logging every send."""
+    out = open(args.out, "a", buffering=1)
+
+    async def send(chat_id: int, text: str, schedule_id: int, planned_at: float) -> None:
+        # Other schedules in the database may share these minutes of day
+        if text.startswith(PREFIX):
+            out.write(json.dumps([int(text[len(PREFIX):]), current[0]]) + "\n")
+
+    coordinator = ShardCoordinator(args.shards, args.lease)
+    dispatcher = Dispatcher(send, max_catchup=args.minutes, coordinator=coordinator)
+    current = [args.first_minute]
+    await coordinator.start()
+    try:
+        while True:
+            elapsed = time.time() - args.start
+            epoch_minute = args.first_minute + int(elapsed / args.tick)
+            if epoch_minute >= args.first_minute + args.minutes + args.minutes:
+                break
+            while current[0] <= epoch_minute:
+                await dispatcher.tick(current[0])
+                current[0] += 1
+            await asyncio.sleep(args.tick / 4)
+    finally:
+        await coordinator.stop()
+        close_pool()
+
+
+def main() -> None:
+    """Seed, run replicas, kill one, and verify exactly-once delivery."""
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Sharded dispatch exactly-once check")
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--schedules", type=int, default=3000)
+    parser.add_argument("--minutes", type=int, default=20, help="virtual minutes holding schedules")
+    parser.add_argument("--tick", type=float, default=1.0, help="real seconds per virtual minute")
+    parser.add_argument("--shards", type=int, default=32)
+    parser.add_argument("--lease", type=float, default=3.0, help="shard lease seconds")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    parser.add_argument("--start", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--first-minute", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        logging.getLogger().setLevel(logging.WARNING)
+        asyncio.run(replica(args))
+        return
+
+    init_db()
+    # Virtual minutes start far in the future so they never collide with real fires
+    first_minute = int(time.time() // 60) + 10**6 + random.randrange(10**6)
+    seed(args.schedules, first_minute, args.minutes)
+    close_pool()
+
+    start = time.time() + 1
+    outputs = [f"/tmp/shard_check_{os.getpid()}_{i}.jsonl" for i in range(args.replicas)]
+    procs = [
+        subprocess.Popen(
+            [
+                sys.executable, __file__, "--worker",
+                "--out", out,
+                "--start", str(start),
+                "--first-minute", str(first_minute),
+                "--minutes", str(args.minutes),
+                "--tick", str(args.tick),
+                "--shards", str(args.shards),
+                "--lease", str(args.lease),
+            ]
+        )
+        for out in outputs
+    ]
+    # Kill one replica a third of the way through without releasing its leases
+    time.sleep(1 + args.minutes * args.tick / 3)
+    procs[0].send_signal(signal.SIGKILL)
+    logging.info("Killed replica 0")
+    for proc in procs[1:]:
+        proc.wait()
+
+    sent = Counter()
+    late = 0
+    per_replica = []
+    for out in outputs:
+        count = 0
+        if os.path.exists(out):
+            with open(out) as f:
+                for line in f:
+                    index, epoch_minute = json.loads(line)
+                    sent[index] += 1
+                    late = max(late, epoch_minute - (first_minute + index % args.minutes))
+                    count += 1
+            os.remove(out)
+        per_replica.append(count)
+
+    missing = [i for i in range(args.schedules) if sent[i] == 0]
+    duplicates = [i for i in range(args.schedules) if sent[i] > 1]
+    print(f"Sends per replica: {per_replica}")
+    print(f"Expected {args.schedules}, delivered {sum(sent.values())}, "
+          f"missing {len(missing)}, duplicated {len(duplicates)}, "
+          f"latest takeover delay {late} virtual minute(s)")
+    sys.exit(0 if not missing and not duplicates else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Stress test for concurrent update processing against the fake Bot API.
+
+Every user pipelines several complete add-schedule conversations
+(/groups -> group -> Add schedule -> message -> time) without waiting for
+the bot's replies, the way a fast user or a burst of webhook deliveries
+would. The run is repeated with sequential processing, with concurrent
+processing serialized per user and chat (the default), and optionally with
+plain unordered concurrency for comparison. Afterwards the stored schedules
+are compared with what each user entered: a lost or mixed-up schedule
+counts as lost.
+
+A last run floods the bot with /start from one user, then has every other
+user send one /start. Updates waiting behind the flooding user must not
+hold concurrency slots, so the other users' replies should take about one
+API round trip, not the time to drain the flood.
+
+Needs a scratch PostgreSQL database in DATABASE_URL.
+
+Usage: python bench/stress_updates.py --users 50 --rounds 4 --concurrency 32 --unordered --flood 300
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+os.environ.setdefault("DATABASE_SSLMODE", "disable")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fake_telegram import BOT_USER, FakeTelegram, serve  # noqa: E402
+from benchmark import BENCH_TOKEN, CHAT_ID_BASE, USER_ID_BASE, callback_update, message_update  # noqa: E402
+from bot import build_application  # noqa: E402
+from db import add_chat, close_pool, connection, get_schedules, init_db  # noqa: E402
+
+# Replies the bot sends for one complete add-schedule conversation
+REPLIES_PER_ROUND = 5
+
+
+def expected_schedule(user_id: int, round_no: int) -> Tuple[str, List[str]]:
+    """Return the (message, times) a user enters in a round."""
+    return f"stress {user_id} #{round_no}", [f"{round_no % 24:02d}:{user_id % 60:02d}"]
+
+
+def reset(users: int) -> None:
+    """Remove the synthetic users' schedules and give each one a group."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(
+                    "DELETE FROM schedules WHERE owner_id >= %s AND owner_id < %s;",
+                    (USER_ID_BASE, USER_ID_BASE + users),
+                )
+    for i in range(users):
+        add_chat(CHAT_ID_BASE - i, f"Stress group {i}", USER_ID_BASE + i)
+
+
+def conversation(api: FakeTelegram, user_id: int, group_id: int, round_no: int) -> List[Dict[str, Any]]:
+    """Build the updates of one add-schedule conversation."""
+    # Callback queries only need a message in the user's chat to edit
+    menu = {
+        "message_id": api.new_message_id(),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": BOT_USER,
+        "text": "menu",
+    }
+    message, times = expected_schedule(user_id, round_no)
+    return [
+        message_update(api, user_id, "/groups"),
+        callback_update(user_id, menu, f"group_{group_id}"),
+        callback_update(user_id, menu, "add"),
+        message_update(api, user_id, message),
+        message_update(api, user_id, ", ".join(times)),
+    ]
+
+
+def lost_schedules(users: int, rounds: int) -> int:
+    """Count entered schedules that are missing or stored with the wrong content."""
+    lost = 0
+    for i in range(users):
+        user_id = USER_ID_BASE + i
+        stored = Counter(
+            (schedule.message, tuple(schedule.times))
+            for schedule in get_schedules(user_id, CHAT_ID_BASE - i)
+        )
+        for round_no in range(rounds):
+            message, times = expected_schedule(user_id, round_no)
+            if stored[(message, tuple(times))] > 0:
+                stored[(message, tuple(times))] -= 1
+            else:
+                lost += 1
+    return lost
+
+
+async def run_mode(api: FakeTelegram, base_url: str, args: argparse.Namespace, concurrency: int, keyed: bool) -> None:
+    """Push every user's conversations at once and wait for all replies."""
+    reset(args.users)
+    app = build_application(BENCH_TOKEN, base_url, concurrent_updates=concurrency, keyed_updates=keyed)
+    replies: Counter = Counter()
+    last_reply = [0.0]
+    done = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    target = args.users * args.rounds * REPLIES_PER_ROUND
+
+    def on_reply(method: str, params: Dict[str, Any], result: Dict[str, Any]) -> None:
+        def count() -> None:
+            replies[int(params["chat_id"])] += 1
+            last_reply[0] = time.monotonic()
+            if sum(replies.values()) >= target:
+                done.set()
+
+        if int(params["chat_id"]) > 0:
+            loop.call_soon_threadsafe(count)
+
+    api.on_reply = on_reply
+    async with app:
+        await app.start()
+        await app.updater.start_polling(poll_interval=0.0, timeout=1)
+        started = time.monotonic()
+        # Interleave users round by round, as deliveries from many users would be
+        for round_no in range(args.rounds):
+            for i in range(args.users):
+                for update in conversation(api, USER_ID_BASE + i, CHAT_ID_BASE - i, round_no):
+                    api.push_update(update)
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        # Stopping lets updates still queued finish, so they count as well
+        await app.updater.stop()
+        await app.stop()
+    api.on_reply = None
+    elapsed = last_reply[0] - started
+
+    updates = args.users * args.rounds * REPLIES_PER_ROUND
+    label = f"concurrency={concurrency}" + (", keyed" if keyed and concurrency > 1 else "")
+    if not keyed:
+        label += ", unordered"
+    lost = lost_schedules(args.users, args.rounds)
+    print(
+        f"{label:28s} {updates} updates in {elapsed:6.2f}s ({updates / elapsed:7.1f} updates/s)  "
+        f"replies {sum(replies.values())}/{target}  lost schedules {lost}/{args.users * args.rounds}"
+    )
+
+
+async def run_flood(api: FakeTelegram, base_url: str, args: argparse.Namespace) -> None:
+    """Queue a burst from one user ahead of one update per other user."""
+    app = build_application(BENCH_TOKEN, base_url, concurrent_updates=args.concurrency)
+    flooder = USER_ID_BASE
+    others = [USER_ID_BASE + i for i in range(1, args.users)]
+    # chat id -> monotonic time of each reply
+    replied: Dict[int, List[float]] = {}
+    done = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    target = args.flood + len(others)
+
+    def on_reply(method: str, params: Dict[str, Any], result: Dict[str, Any]) -> None:
+        def count() -> None:
+            replied.setdefault(int(params["chat_id"]), []).append(time.monotonic())
+            if sum(len(times) for times in replied.values()) >= target:
+                done.set()
+
+        if int(params["chat_id"]) > 0:
+            loop.call_soon_threadsafe(count)
+
+    api.on_reply = on_reply
+    async with app:
+        await app.start()
+        await app.updater.start_polling(poll_interval=0.0, timeout=1)
+        started = time.monotonic()
+        for _ in range(args.flood):
+            api.push_update(message_update(api, flooder, "/start"))
+        for user_id in others:
+            api.push_update(message_update(api, user_id, "/start"))
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        await app.updater.stop()
+        await app.stop()
+    api.on_reply = None
+
+    latencies = sorted(replied[user_id][0] - started for user_id in others if user_id in replied)
+    if not latencies:
+        print(f"flood of {args.flood} from one user: no replies to the other users")
+        return
+    drained = max(replied.get(flooder, [started])) - started
+    print(
+        f"flood of {args.flood} from one user, drained in {drained:6.2f}s; "
+        f"{len(latencies)}/{len(others)} other users answered, "
+        f"latency p50 {latencies[len(latencies) // 2] * 1000:.0f}ms max {latencies[-1] * 1000:.0f}ms"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    api = FakeTelegram(args.latency)
+    server = serve(api)
+    base_url = f"http://127.0.0.1:{server.server_port}/bot"
+    print(f"{args.users} users x {args.rounds} pipelined conversations, API latency {args.latency * 1000:.0f}ms")
+    try:
+        await run_mode(api, base_url, args, 1, True)
+        await run_mode(api, base_url, args, args.concurrency, True)
+        if args.unordered:
+            # Handlers fail on out-of-order updates here; that is the point
+            logging.disable(logging.ERROR)
+            await run_mode(api, base_url, args, args.concurrency, False)
+            logging.disable(logging.NOTSET)
+        if args.flood:
+            await run_flood(api, base_url, args)
+    finally:
+        server.shutdown()
+        close_pool()
+
+
+def main() -> None:
+    """Run the stress test."""
+    logging.basicConfig(
+        level=logging.ERROR, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Concurrent update processing stress test")
+    parser.add_argument("--users", type=int, default=50, help="users sending updates at once")
+    parser.add_argument("--rounds", type=int, default=4, help="conversations pipelined per user")
+    parser.add_argument("--concurrency", type=int, default=32, help="updates processed at once")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake API latency per call in seconds")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for every reply")
+    parser.add_argument("--unordered", action="store_true", help="also run without per-user ordering")
+    parser.add_argument("--flood", type=int, default=300, help="updates from one flooding user (0 = skip)")
+    args = parser.parse_args()
+    init_db()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
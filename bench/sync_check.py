@@ -0,0 +1,133 @@
+"""
+Check that editing one schedule touches only that schedule's index entries.
+
+Loads N schedules into an in-memory Dispatcher, then adds, replaces and
+removes one schedule. Each edit must touch as many minute buckets as the
+edited schedule has fire times (old plus new for a replace), never the
+whole index. Every other schedule must stay due at its minutes throughout,
+so there is no window in which their fires could be missed.
+
+It also interleaves edits with a bucket refresh: schedules added, moved or
+removed while the refresh reads (stale) rows must end up as edited. Needs
+no database.
+
+Usage: python bench/sync_check.py [--schedules 10000] [--times 3]
+"""
+import os
+import sys
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Set, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import dispatcher as dispatch  # noqa: E402
+from dispatcher import Dispatcher  # noqa: E402
+from recurrence import format_minute  # noqa: E402
+from schedules import Schedule, minutes_of  # noqa: E402
+
+
+def schedule(schedule_id: int, minutes: List[int]) -> Schedule:
+    return Schedule(
+        schedule_id,
+        1,
+        -1_000_000 - schedule_id,
+        f"Message {schedule_id}",
+        minutes_of([format_minute(minute) for minute in minutes]),
+        "UTC",
+    )
+
+
+def snapshot(dispatcher: Dispatcher, minutes: Set[int]) -> Dict[int, Set[int]]:
+    """Schedule ids due at each of the given minutes."""
+    return {minute: {item[0] for item in dispatcher.due(minute)} for minute in minutes}
+
+
+async def refresh_race() -> bool:
+    """Edit schedules while a refresh of their minute awaits the database."""
+    minute = 600
+    dispatcher = Dispatcher(lambda *_: None, jitter_minutes=0)
+    kept, moved, deleted, added = (schedule(i, [minute]) for i in (1, 2, 3, 4))
+    for item in (kept, moved, deleted):
+        dispatcher.upsert(item)
+    # The rows as read before the edits below were made
+    rows = [kept, moved, deleted]
+    for item in rows:
+        item.utc_minute = minute
+    reading = asyncio.Event()
+    edited = asyncio.Event()
+
+    async def run_async(func, *args):
+        reading.set()
+        await edited.wait()
+        return rows
+
+    async def edit() -> None:
+        await reading.wait()
+        dispatcher.upsert(schedule(moved.id, [minute + 1]))
+        dispatcher.remove(deleted.id)
+        dispatcher.upsert(added)
+        edited.set()
+
+    original = dispatch.run_async
+    dispatch.run_async = run_async
+    try:
+        await asyncio.gather(dispatcher.refresh(minute), edit())
+    finally:
+        dispatch.run_async = original
+    due = snapshot(dispatcher, {minute, minute + 1})
+    return (
+        due == {minute: {kept.id, added.id}, minute + 1: {moved.id}}
+        and dispatcher.stats()["schedules"] == 3
+        and dispatcher.remove(moved.id) == 1
+    )
+
+
+def main() -> None:
+    """Run the edits and report the buckets each one touched."""
+    parser = argparse.ArgumentParser(description="Per-schedule index sync check")
+    parser.add_argument("--schedules", type=int, default=10000)
+    parser.add_argument("--times", type=int, default=3, help="fire times of the edited schedule")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    dispatcher = Dispatcher(lambda *_: None)
+    dispatcher.load(
+        schedule(i, rng.sample(range(24 * 60), rng.randint(1, 4))) for i in range(1, args.schedules + 1)
+    )
+    before = dispatcher.stats()
+    others = snapshot(dispatcher, set(range(24 * 60)))
+    edited = args.schedules + 1
+    old = rng.sample(range(24 * 60), args.times)
+    new = rng.sample(range(24 * 60), args.times)
+
+    steps: List[Tuple[str, int, int]] = [
+        ("add", dispatcher.upsert(schedule(edited, old)), args.times),
+        ("replace", dispatcher.upsert(schedule(edited, new)), 2 * args.times),
+    ]
+    # Mid-sync: every other schedule is still where it was
+    during = snapshot(dispatcher, set(range(24 * 60)))
+    for minute in during:
+        during[minute].discard(edited)
+    steps.append(("remove", dispatcher.remove(edited), args.times))
+    after = dispatcher.stats()
+
+    print(f"{before['schedules']} schedules, {before['entries']} index entries")
+    failed = False
+    for name, touched, expected in steps:
+        ok = touched == expected
+        failed |= not ok
+        print(f"  {name:<8} touched {touched} bucket(s), expected {expected}  {'ok' if ok else 'FAIL'}")
+    for name, ok in (
+        ("other schedules untouched during the edit", during == others),
+        ("index back to its original state", after == before and snapshot(dispatcher, set(others)) == others),
+        ("edits during a refresh kept", asyncio.run(refresh_race())),
+    ):
+        failed |= not ok
+        print(f"  {name}  {'ok' if ok else 'FAIL'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import os
+import asyncio
 import logging
-import json
-from typing import Dict, List, Tuple, Optional
+import time
+import tempfile
+from typing import Dict, List, Optional
 
-from apscheduler.schedulers.background import BackgroundScheduler
+# First, so the startup profile covers the imports below
+import startup
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Chat
 from telegram.ext import (
     Application,
@@ -15,88 +18,97 @@ from telegram.ext import (
     filters,
     ChatMemberHandler,
 )
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from db import init_db, add_chat, remove_chat, get_chats, get_chat_owner, get_chats_by_owner
+from db import (
+    init_db,
+    close_pool,
+    run_async,
+    add_chat,
+    get_chats_by_owner,
+    add_schedule,
+    get_schedules,
+    get_all_schedules,
+    delete_schedule,
+    get_deliveries,
+    get_chat_timezone,
+    set_chat_timezone,
+)
+from dispatcher import DISPATCH_JITTER_MINUTES, Dispatcher, Message
+from sender import SendQueue
+from planner import format_report
+from metrics import HANDLER_LATENCY, start_metrics_server
+from chat_cache import ChatDirectory
+from sharding import DISPATCH_SHARDS, ShardCoordinator
+from update_processor import KeyedUpdateProcessor
+from membership import MembershipWriter
+from paging import Page, PageCache
+from delivery_log import DeliveryLog
+from timezones import normalize as normalize_timezone
+from payloads import ALBUM_MAX_ITEMS, album, from_message, media_item, send as send_payload
+from recurrence import parse as parse_recurrence
+from schedules import Schedule
+from bulk import (
+    BULK_IMPORT_MAX_BYTES,
+    BULK_IMPORT_WAIT_SECONDS,
+    EXPORT_FORMATS,
+    REPORT_MAX_ERRORS,
+    error_file,
+    export_file,
+    import_file,
+    report as import_report,
+)
 
 
 # States for conversation handler
-CHOOSING_GROUP, CHOOSING_ACTION, SET_MESSAGE, SET_TIME = range(4)
-
-# Data structure to store schedules
-# Format: {user_id: {chat_id: [{"message": "text", "times": ["HH:MM", ...]}]}}
-USER_DATA_FILE = "user_data.json"
-
-
-def load_user_data() -> Dict:
-    """Load user data from file or return empty dict if file doesn't exist"""
-    try:
-        with open(USER_DATA_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-
-def save_user_data(data: Dict) -> None:
-    """Save user data to file"""
-    with open(USER_DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
-
-
-async def send_message(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a message to a specific chat"""
-    job = context.job
-    chat_id, message_text = job.data
+CHOOSING_GROUP, CHOOSING_ACTION, SET_MESSAGE, SET_TIME, CHOOSING_TARGETS, SET_TIMEZONE = range(6)
+
+# Examples of recurrence rules, shown when asking for times
+RECURRENCE_HELP = (
+    "You can also limit the days or repeat at an interval, e.g.:\n"
+    "mon-fri 09:00, 17:30\n"
+    "every 30m 09:00-12:00 weekends\n"
+    "10:00 on 1,15 from 2026-11-01 until 2026-12-31"
+)
 
-    try:
-        await context.bot.send_message(chat_id=chat_id, text=message_text)
-        logging.info(f"Message sent successfully to {chat_id}: {message_text}")
-    except Exception as e:
-        logging.error(f"Error sending message to {chat_id}: {e}")
-
-
-def schedule_all_messages(scheduler: BackgroundScheduler, app: Application) -> None:
-    """Schedule all messages for all users from the saved data"""
-    user_data = load_user_data()
-
-    # Clear existing jobs
-    scheduler.remove_all_jobs()
-
-    for user_id, chats in user_data.items():
-        for chat_id, schedules in chats.items():
-            for schedule in schedules:
-                message = schedule.get("message", "")
-                for time_str in schedule.get("times", []):
-                    try:
-                        hour_str, minute_str = time_str.split(":")
-                        hour, minute = int(hour_str), int(minute_str)
-
-                        scheduler.add_job(
-                            send_scheduled_message,
-                            "cron",
-                            hour=hour,
-                            minute=minute,
-                            args=[app, chat_id, message],
-                        )
-                        logging.info(
-                            f"Scheduled message for chat {chat_id} at {time_str}"
-                        )
-                    except ValueError:
-                        logging.error(
-                            f"Invalid time format '{time_str}' for chat {chat_id}"
-                        )
+# How updates are received: "polling" (default) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Webhook settings; WEBHOOK_URL is the public base URL Telegram posts to
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Confirms every update of a user reaches the same replica (one ingress
+# replica, or routing by sender); required with DISPATCH_SHARDS in webhook mode
+WEBHOOK_STICKY = os.environ.get("WEBHOOK_STICKY", "0") == "1"
+# Number of updates processed at the same time; each user's and chat's
+# updates still run one at a time, in order
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "16"))
+# Media that can be scheduled, and so can follow as further album items
+SCHEDULE_MEDIA = (
+    filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.AUDIO | filters.Document.ALL
+)
+# Delivery attempts shown per schedule in the history view
+DELIVERY_HISTORY_LIMIT = int(os.environ.get("DELIVERY_HISTORY_LIMIT", "10"))
 
+# Telegram user ids allowed to run admin commands, comma separated
+ADMIN_IDS = {
+    int(user_id)
+    for user_id in os.environ.get("ADMIN_IDS", "").split(",")
+    if user_id.strip()
+}
 
 async def send_scheduled_message(
-    app: Application, chat_id: str, message_text: str
+    app: Application,
+    chat_id: str,
+    message: Message,
+    schedule_id: Optional[int] = None,
+    planned_at: Optional[float] = None,
 ) -> None:
-    """Send a scheduled message through the application"""
-    try:
-        await app.bot.send_message(chat_id=chat_id, text=message_text)
-        logging.info(
-            f"Scheduled message sent successfully to {chat_id}: {message_text}"
-        )
-    except Exception as e:
-        logging.error(f"Error sending scheduled message to {chat_id}: {e}")
+    """Queue a scheduled message (text or rich payload) for rate-limited delivery"""
+    # Delivery failures are retried and dead-lettered by the send queue,
+    # and every attempt lands in the delivery log
+    app.bot_data["send_queue"].submit(int(chat_id), message, schedule_id, planned_at)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -107,37 +119,125 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+def _short(text: str, limit: int) -> str:
+    """Cut text to ``limit`` characters for buttons and listings."""
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def _nav_row(page: Page, prefix: str) -> List[InlineKeyboardButton]:
+    """Prev/next buttons for a paged keyboard; empty for a single page."""
+    row = []
+    if page.number > 0:
+        row.append(InlineKeyboardButton("« Prev", callback_data=f"{prefix}{page.number - 1}"))
+    if page.has_next:
+        row.append(InlineKeyboardButton("Next »", callback_data=f"{prefix}{page.number + 1}"))
+    return row
+
+
+def _page_note(page: Page) -> str:
+    """Page number for message texts, or nothing for a single page."""
+    if page.number == 0 and not page.has_next:
+        return ""
+    return f" (page {page.number + 1})"
+
+
+async def _chat_page(context: ContextTypes.DEFAULT_TYPE, owner_id: int, number: int) -> Page:
+    """Return a page of the chats an owner added the bot to."""
+    return await context.application.bot_data["keyboard_pages"].page(
+        ("chats", owner_id, None),
+        number,
+        lambda after, limit: get_chats_by_owner(owner_id, after, limit),
+        lambda chat: chat[0],
+    )
+
+
+async def _schedule_page(
+    context: ContextTypes.DEFAULT_TYPE, owner_id: int, chat_id: int, number: int
+) -> Page:
+    """Return a page of an owner's schedules for one chat."""
+    return await context.application.bot_data["keyboard_pages"].page(
+        ("schedules", owner_id, chat_id),
+        number,
+        lambda after, limit: get_schedules(owner_id, chat_id, after, limit),
+        lambda schedule: schedule.id,
+    )
+
+
+def _groups_keyboard(page: Page) -> InlineKeyboardMarkup:
+    """Group buttons for one page of /groups."""
+    keyboard = []
+    for chat_id, title in page.items:
+        keyboard.append([InlineKeyboardButton(title or str(chat_id), callback_data=f"group_{chat_id}")])
+    nav = _nav_row(page, "page_")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _schedules_keyboard(
+    page: Page, action: str, nav_prefix: Optional[str] = None
+) -> InlineKeyboardMarkup:
+    """Schedule buttons for one page of the delete menu or the schedule listing."""
+    keyboard = []
+    for i, schedule in enumerate(page.items, start=page.first + 1):
+        label = f"{i}. {_short(schedule.message, 40)} at {_short(schedule.when(), 30)}"
+        if len(schedule.chat_ids) > 1:
+            label += f" ({len(schedule.chat_ids)} groups)"
+        keyboard.append(
+            [InlineKeyboardButton(label, callback_data=f"{action}_{schedule.id}")]
+        )
+    nav = _nav_row(page, nav_prefix or f"{action}_page_")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+@HANDLER_LATENCY.time("list_groups")
 async def list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """List groups where the bot is a member"""
+    return await _show_groups(update, context, 0)
+
+
+async def _show_groups(update: Update, context: ContextTypes.DEFAULT_TYPE, number: int) -> int:
+    """Show one page of the user's groups, as a new message or in place of a menu."""
+    query = update.callback_query
     # Get chats (groups) that this user added the bot to
     user_id_int = update.effective_user.id
     try:
-        bot_chats = get_chats_by_owner(user_id_int)
+        # Groups the bot just joined may still be buffered
+        await context.application.bot_data["membership"].settle()
+        page = await _chat_page(context, user_id_int, number)
     except Exception as e:
         logging.error(f"Error fetching groups for user {user_id_int}: {e}")
-        bot_chats = []
+        page = None
 
-    if not bot_chats:
-        await update.message.reply_text(
-            "You don't manage any groups yet. Add me to a group (you must be the one to add me) and I'll remember!"
-        )
+    if page is None or not page.items:
+        text = "You don't manage any groups yet. Add me to a group (you must be the one to add me) and I'll remember!"
+        if query:
+            await query.edit_message_text(text)
+        else:
+            await update.message.reply_text(text)
         return ConversationHandler.END
 
-    # Create inline keyboard with groups
-    keyboard = []
-    for chat_id, title in bot_chats:
-        keyboard.append([InlineKeyboardButton(title, callback_data=f"group_{chat_id}")])
-
-    keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Warm the chat directory so selecting a group needs no DB round trip
+    directory = context.application.bot_data["chat_directory"]
+    for chat_id, title in page.items:
+        directory.put(chat_id, title or "", user_id_int)
 
-    await update.message.reply_text(
-        "Select a group to manage schedules:", reply_markup=reply_markup
-    )
+    # The keyboard is rendered once per cached page
+    reply_markup = page.render("groups", _groups_keyboard)
+    text = f"Select a group to manage schedules{_page_note(page)}:"
+    if query:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup)
 
     return CHOOSING_GROUP
 
 
+@HANDLER_LATENCY.time("group_selected")
 async def group_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle group selection"""
     query = update.callback_query
@@ -147,19 +247,22 @@ async def group_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text("Operation cancelled.")
         return ConversationHandler.END
 
+    if query.data.startswith("page_"):
+        return await _show_groups(update, context, int(query.data.split("_", 1)[1]))
+
     # Extract chat_id from callback data and save
     chat_id_str = query.data.split("_", 1)[1]
     context.user_data["selected_chat_id"] = chat_id_str
+    context.user_data.pop("broadcast_chat_ids", None)
+    context.user_data.pop("broadcast_page", None)
     # expose chat_id variable for use below
     chat_id = chat_id_str
 
-    # Retrieve chat title from database, fallback to ID if missing
+    # Retrieve chat title from the chat directory, fallback to ID if missing
     chat_title = chat_id_str
     try:
-        for cid, title in get_chats():
-            if cid == int(chat_id_str):
-                chat_title = title or chat_title
-                break
+        directory = context.application.bot_data["chat_directory"]
+        chat_title = await directory.title(int(chat_id_str)) or chat_title
     except Exception as e:
         logging.error(f"Error fetching chat title from DB for {chat_id_str}: {e}")
     context.user_data["selected_chat_title"] = chat_title
@@ -169,6 +272,7 @@ async def group_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         [InlineKeyboardButton("View schedules", callback_data="view")],
         [InlineKeyboardButton("Add schedule", callback_data="add")],
         [InlineKeyboardButton("Delete schedule", callback_data="delete")],
+        [InlineKeyboardButton("Set timezone", callback_data="timezone")],
         [InlineKeyboardButton("Back to groups", callback_data="back")],
         [InlineKeyboardButton("Cancel", callback_data="cancel")],
     ]
@@ -182,6 +286,7 @@ async def group_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return CHOOSING_ACTION
 
 
+@HANDLER_LATENCY.time("action_selected")
 async def action_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle action selection"""
     query = update.callback_query
@@ -192,200 +297,556 @@ async def action_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
 
     if query.data == "back":
-        return await list_groups(update, context)
+        return await _show_groups(update, context, 0)
 
     chat_id = context.user_data.get("selected_chat_id")
     chat_title = context.user_data.get("selected_chat_title", chat_id)
     # Current user identifiers
     current_user_id_int = update.effective_user.id
-    user_id = str(current_user_id_int)
-
-    # Load or initialize schedule data for this user and chat
-    user_data = load_user_data()
-    if user_id not in user_data:
-        user_data[user_id] = {}
-    if chat_id not in user_data[user_id]:
-        user_data[user_id][chat_id] = []
 
     # Permission check: only the chat owner (who added the bot) can add/delete schedules
+    directory = context.application.bot_data["chat_directory"]
     try:
-        chat_owner = get_chat_owner(int(chat_id))
+        chat_owner = await directory.owner(int(chat_id))
     except Exception as e:
         logging.error(f"Error retrieving owner for chat {chat_id}: {e}")
         chat_owner = None
     # If no owner recorded, assign current user as owner
     if chat_owner is None:
         try:
-            add_chat(int(chat_id), chat_title or '', current_user_id_int)
-            chat_owner = current_user_id_int
+            await run_async(add_chat, int(chat_id), chat_title or '', current_user_id_int)
+            directory.invalidate(int(chat_id))
+            context.application.bot_data["keyboard_pages"].invalidate_owner(current_user_id_int, "chats")
+            # add_chat keeps an owner set concurrently by someone else, so
+            # read back who actually owns the chat
+            chat_owner = await directory.owner(int(chat_id))
         except Exception as e:
             logging.error(f"Error setting owner for chat {chat_id}: {e}")
     # Restrict add/delete actions to owner only
-    if query.data in ("add", "delete") or query.data.startswith("delete_"):
+    if query.data in ("add", "delete", "timezone") or query.data.startswith("delete_"):
         if chat_owner != current_user_id_int:
             await query.edit_message_text(
                 "⚠️ Only the user who added the bot can manage schedules for this group."
             )
             return ConversationHandler.END
 
-    if query.data == "view":
-        # Show existing schedules
-        schedules = user_data[user_id][chat_id]
-        if not schedules:
+    if query.data == "view" or query.data.startswith("view_page_"):
+        # Show existing schedules, a page at a time
+        number = 0 if query.data == "view" else int(query.data.rsplit("_", 1)[1])
+        try:
+            page = await _schedule_page(context, current_user_id_int, int(chat_id), number)
+        except Exception as e:
+            logging.error(f"Error fetching schedules for chat {chat_id}: {e}")
+            page = None
+        if page is None or not page.items:
             await query.edit_message_text(
                 f"No schedules for {chat_title}.\n" f"Use /groups to go back."
             )
         else:
-            schedule_text = f"Schedules for {chat_title}:\n\n"
-            for i, schedule in enumerate(schedules):
-                times = ", ".join(schedule.get("times", []))
+            schedule_text = f"Schedules for {chat_title}{_page_note(page)}:\n\n"
+            for i, schedule in enumerate(page.items, start=page.first + 1):
+                # Long messages are cut so a page stays within Telegram's limit
                 schedule_text += (
-                    f"{i+1}. Message: {schedule.get('message')}\n"
-                    f"   Times: {times}\n\n"
+                    f"{i}. Message: {_short(schedule.message, 300)}\n"
+                    f"   Times: {_short(schedule.when(), 200)} ({schedule.timezone})\n"
+                    f"{_broadcast_note(schedule)}\n"
                 )
-
-            await query.edit_message_text(schedule_text + "Use /groups to go back.")
+            # Each schedule's button shows its delivery history
+            await query.edit_message_text(
+                schedule_text
+                + "Tap a schedule to see its latest deliveries, or use /groups to go back.",
+                reply_markup=page.render(
+                    "view", lambda p: _schedules_keyboard(p, "history", "view_page_")
+                ),
+            )
+            return CHOOSING_ACTION
         return ConversationHandler.END
 
+    elif query.data == "timezone":
+        # Ask for the zone the group's schedule times are in
+        try:
+            current = await run_async(get_chat_timezone, int(chat_id))
+        except Exception as e:
+            logging.error(f"Error fetching timezone for chat {chat_id}: {e}")
+            current = None
+        note = f"Current timezone: {current}\n" if current else ""
+        await query.edit_message_text(
+            f"{note}Send me the timezone for {chat_title}, as an IANA name "
+            f"such as Europe/Berlin or America/New_York.\n"
+            f"Schedule times are read in this timezone and follow its daylight saving changes."
+        )
+        return SET_TIMEZONE
+
     elif query.data == "add":
         # Start process to add a new schedule
         context.user_data["action"] = "add"
         await query.edit_message_text(
             f"Adding new schedule for {chat_title}.\n"
-            f"Send me the message text you want to schedule:"
+            f"Send me the message you want to schedule: text (formatting is kept), "
+            f"a photo, video, GIF, audio file, document or album:"
         )
         return SET_MESSAGE
 
-    elif query.data == "delete":
-        # Show schedules to delete
-        schedules = user_data[user_id][chat_id]
-        if not schedules:
+    elif query.data == "delete" or query.data.startswith("delete_page_"):
+        # Show schedules to delete, a page at a time
+        number = 0 if query.data == "delete" else int(query.data.rsplit("_", 1)[1])
+        try:
+            page = await _schedule_page(context, current_user_id_int, int(chat_id), number)
+        except Exception as e:
+            logging.error(f"Error fetching schedules for chat {chat_id}: {e}")
+            page = None
+        if page is None or not page.items:
             await query.edit_message_text(
                 f"No schedules to delete for {chat_title}.\n" f"Use /groups to go back."
             )
             return ConversationHandler.END
 
-        keyboard = []
-        for i, schedule in enumerate(schedules):
-            times = ", ".join(schedule.get("times", []))
-            label = f"{i+1}. {schedule.get('message')} at {times}"
-            keyboard.append([InlineKeyboardButton(label, callback_data=f"delete_{i}")])
-
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await query.edit_message_text(
-            f"Select a schedule to delete from {chat_title}:", reply_markup=reply_markup
+            f"Select a schedule to delete from {chat_title}{_page_note(page)}:",
+            reply_markup=page.render("delete", lambda p: _schedules_keyboard(p, "delete")),
         )
         return CHOOSING_ACTION
 
+    elif query.data.startswith("history_"):
+        # Show the latest delivery attempts of one schedule
+        schedule_id = int(query.data.split("_")[1])
+        try:
+            deliveries = await run_async(
+                get_deliveries, current_user_id_int, schedule_id, DELIVERY_HISTORY_LIMIT
+            )
+        except Exception as e:
+            logging.error(f"Error fetching deliveries of schedule {schedule_id}: {e}")
+            await query.edit_message_text(
+                "Could not load the delivery history, please try again later."
+            )
+            return ConversationHandler.END
+        if not deliveries:
+            await query.edit_message_text(
+                "No deliveries recorded for this schedule yet.\n" "Use /groups to go back."
+            )
+            return ConversationHandler.END
+        await query.edit_message_text(
+            await _history_text(context, deliveries) + "\nUse /groups to go back."
+        )
+        return ConversationHandler.END
+
     elif query.data.startswith("delete_"):
         # Delete the selected schedule
-        index = int(query.data.split("_")[1])
-        schedules = user_data[user_id][chat_id]
-        if 0 <= index < len(schedules):
-            deleted = schedules.pop(index)
-            save_user_data(user_data)
-
-            # Reschedule all jobs
-            app = context.application
-            schedule_all_messages(app.bot_data["scheduler"], app)
+        schedule_id = int(query.data.split("_")[1])
+        try:
+            deleted = await run_async(
+                delete_schedule, current_user_id_int, int(chat_id), schedule_id
+            )
+        except Exception as e:
+            logging.error(f"Error deleting schedule {schedule_id}: {e}")
+            deleted = None
+        if deleted:
+            # Drop only this schedule from the dispatch index
+            context.application.bot_data["dispatcher"].remove(deleted.id)
+            context.application.bot_data["keyboard_pages"].invalidate_owner(
+                current_user_id_int, "schedules"
+            )
 
-            times = ", ".join(deleted.get("times", []))
             await query.edit_message_text(
-                f"Schedule deleted: {deleted.get('message')} at {times}.\n"
+                f"Schedule deleted: {deleted.message} at {deleted.when()}.\n"
                 f"Use /groups to go back."
             )
         else:
             await query.edit_message_text(
-                "Invalid schedule index.\n" "Use /groups to go back."
+                "Schedule not found.\n" "Use /groups to go back."
             )
         return ConversationHandler.END
 
     return ConversationHandler.END
 
 
+_STATUS_ICONS = {"sent": "✅", "retry": "🔁", "failed": "❌"}
+
+
+async def _history_text(context: ContextTypes.DEFAULT_TYPE, deliveries: List[Dict]) -> str:
+    """Describe delivery attempts, newest first, in the server's local time."""
+    directory = context.application.bot_data["chat_directory"]
+    lines = [f"Last {len(deliveries)} delivery attempt(s):", ""]
+    for delivery in deliveries:
+        planned = delivery["planned_at"].astimezone()
+        sent = delivery["sent_at"].astimezone()
+        try:
+            title = await directory.title(delivery["chat_id"]) or delivery["chat_id"]
+        except Exception:
+            title = delivery["chat_id"]
+        line = (
+            f"{_STATUS_ICONS.get(delivery['status'], '')} {planned:%Y-%m-%d %H:%M} → "
+            f"{sent:%H:%M:%S} {delivery['status']} in {title} ({delivery['latency_ms']} ms)"
+        )
+        if delivery["error"]:
+            line += f"\n   {_short(delivery['error'], 100)}"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def _broadcast_note(schedule: Schedule) -> str:
+    """Describe the other target chats of a broadcast, or nothing for a single chat."""
+    chat_ids = schedule.chat_ids
+    if len(chat_ids) < 2:
+        return ""
+    return f"   Broadcast to {len(chat_ids)} groups\n"
+
+
+def _targets_keyboard(page: Page, selected: List[int]) -> InlineKeyboardMarkup:
+    """Toggle buttons for picking broadcast chats, one page of groups at a time."""
+    # Not cached: the marks change with every toggle
+    keyboard = []
+    for chat_id, title in page.items:
+        mark = "✅ " if chat_id in selected else ""
+        keyboard.append(
+            [InlineKeyboardButton(f"{mark}{title or chat_id}", callback_data=f"target_{chat_id}")]
+        )
+    nav = _nav_row(page, "page_")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(f"Done ({len(selected)} selected)", callback_data="targets_done")])
+    keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+@HANDLER_LATENCY.time("start_broadcast")
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start a schedule that sends one message to several groups."""
+    user_id_int = update.effective_user.id
+    try:
+        # Groups the bot just joined may still be buffered
+        await context.application.bot_data["membership"].settle()
+        page = await _chat_page(context, user_id_int, 0)
+    except Exception as e:
+        logging.error(f"Error fetching groups for user {user_id_int}: {e}")
+        page = None
+
+    if page is None or not page.items:
+        await update.message.reply_text(
+            "You don't manage any groups yet. Add me to a group (you must be the one to add me) and I'll remember!"
+        )
+        return ConversationHandler.END
+
+    context.user_data["broadcast_chat_ids"] = []
+    context.user_data["broadcast_page"] = 0
+    await update.message.reply_text(
+        "Select the groups to send the message to:",
+        reply_markup=_targets_keyboard(page, []),
+    )
+    return CHOOSING_TARGETS
+
+
+@HANDLER_LATENCY.time("target_toggled")
+async def target_toggled(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Toggle a group in the broadcast selection, or finish selecting."""
+    query = update.callback_query
+    user_id_int = update.effective_user.id
+    selected = context.user_data.setdefault("broadcast_chat_ids", [])
+
+    if query.data == "cancel":
+        await query.answer()
+        await query.edit_message_text("Operation cancelled.")
+        return ConversationHandler.END
+
+    if query.data == "targets_done":
+        if not selected:
+            await query.answer("Select at least one group.", show_alert=True)
+            return CHOOSING_TARGETS
+        await query.answer()
+        context.user_data["action"] = "add"
+        await query.edit_message_text(
+            f"Broadcasting to {len(selected)} group(s).\n"
+            f"Send me the message you want to schedule: text (formatting is kept), "
+            f"a photo, video, GIF, audio file, document or album:"
+        )
+        return SET_MESSAGE
+
+    await query.answer()
+    try:
+        if query.data.startswith("page_"):
+            context.user_data["broadcast_page"] = int(query.data.split("_", 1)[1])
+        else:
+            chat_id = int(query.data.split("_", 1)[1])
+            # Only the owner's own groups can be picked
+            directory = context.application.bot_data["chat_directory"]
+            if await directory.owner(chat_id) != user_id_int:
+                return CHOOSING_TARGETS
+            if chat_id in selected:
+                selected.remove(chat_id)
+            else:
+                selected.append(chat_id)
+        page = await _chat_page(context, user_id_int, context.user_data.get("broadcast_page", 0))
+    except Exception as e:
+        logging.error(f"Error fetching groups for user {user_id_int}: {e}")
+        return CHOOSING_TARGETS
+    context.user_data["broadcast_page"] = page.number
+    await query.edit_message_reply_markup(reply_markup=_targets_keyboard(page, selected))
+    return CHOOSING_TARGETS
+
+
+@HANDLER_LATENCY.time("message_entered")
 async def message_entered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle the entered message for scheduling"""
-    context.user_data["message"] = update.message.text
+    try:
+        payload = from_message(update.message)
+    except ValueError:
+        await update.message.reply_text(
+            "This kind of message cannot be scheduled. Please send text or media, or /cancel."
+        )
+        return SET_MESSAGE
+    # Only the file_id of media is kept; nothing is downloaded or re-uploaded
+    context.user_data["payload"] = payload
+    context.user_data["message"] = payload.summary() if payload else update.message.text
+    context.user_data["album"] = None
+    if update.message.media_group_id:
+        # The other items of an album arrive as separate messages after this one
+        context.user_data["album"] = (update.message.media_group_id, [media_item(update.message)])
 
     await update.message.reply_text(
         "Now send me the time(s) to schedule this message.\n"
         "Format: HH:MM (24-hour format)\n"
-        "For multiple times, separate with commas (e.g., 09:00, 15:30)"
+        "For multiple times, separate with commas (e.g., 09:00, 15:30)\n\n"
+        f"{RECURRENCE_HELP}"
     )
 
     return SET_TIME
 
 
-async def time_entered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle the entered time(s) for scheduling"""
-    times_text = update.message.text
-    times = [t.strip() for t in times_text.split(",") if t.strip()]
-
-    # Validate times
-    valid_times = []
-    invalid_times = []
-    for t in times:
-        try:
-            hour_str, minute_str = t.split(":")
-            hour, minute = int(hour_str), int(minute_str)
-            if 0 <= hour < 24 and 0 <= minute < 60:
-                valid_times.append(f"{hour:02d}:{minute:02d}")
-            else:
-                invalid_times.append(t)
-        except ValueError:
-            invalid_times.append(t)
-
-    if invalid_times:
+@HANDLER_LATENCY.time("album_item")
+async def album_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Add a further item of the album being scheduled."""
+    pending = context.user_data.get("album")
+    if not pending or pending[0] != update.message.media_group_id:
         await update.message.reply_text(
-            f"Invalid time format(s): {', '.join(invalid_times)}.\n"
-            f"Please try again with the format HH:MM (24-hour format)."
+            "Please send the time(s) for the message first, or /cancel."
         )
         return SET_TIME
+    items = pending[1]
+    if len(items) >= ALBUM_MAX_ITEMS:
+        return SET_TIME
+    try:
+        payload = album(items + [media_item(update.message)])
+    except ValueError as e:
+        # Telegram would refuse to send this mix; keep the album without the item
+        logging.error(f"Dropped album item from user {update.effective_user.id}: {e}")
+        return SET_TIME
+    items.append(payload.items[-1])
+    context.user_data["payload"] = payload
+    context.user_data["message"] = payload.summary()
+    return SET_TIME
 
-    if not valid_times:
-        await update.message.reply_text("No valid times provided. Please try again.")
+
+@HANDLER_LATENCY.time("time_entered")
+async def time_entered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle the entered time(s) for scheduling"""
+    try:
+        recurrence = parse_recurrence(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"Could not read those times: {e}.\n"
+            f"Please try again with the format HH:MM (24-hour format).\n\n"
+            f"{RECURRENCE_HELP}"
+        )
         return SET_TIME
+    valid_times = recurrence.times()
 
     # Save the schedule
-    user_id = str(update.effective_user.id)
-    chat_id = context.user_data.get("selected_chat_id")
+    user_id = update.effective_user.id
     message = context.user_data.get("message", "")
-
-    user_data = load_user_data()
-    if user_id not in user_data:
-        user_data[user_id] = {}
-    if chat_id not in user_data[user_id]:
-        user_data[user_id][chat_id] = []
-
-    chat_title = context.user_data.get("selected_chat_title", chat_id)
+    payload = context.user_data.pop("payload", None)
+    context.user_data.pop("album", None)
+    broadcast_chat_ids = context.user_data.pop("broadcast_chat_ids", None)
+    if broadcast_chat_ids:
+        # One schedule for all picked groups, keyed on the first one
+        chat_id = broadcast_chat_ids[0]
+        chat_title = f"{len(broadcast_chat_ids)} group(s)"
+    else:
+        chat_id = context.user_data.get("selected_chat_id")
+        chat_title = context.user_data.get("selected_chat_title", chat_id)
 
     # Add the new schedule
-    new_schedule = {"message": message, "times": valid_times}
-    user_data[user_id][chat_id].append(new_schedule)
-    save_user_data(user_data)
+    try:
+        schedule = await run_async(
+            add_schedule,
+            user_id,
+            int(chat_id),
+            message,
+            valid_times,
+            broadcast_chat_ids,
+            payload,
+            recurrence,
+        )
+    except Exception as e:
+        logging.error(f"Error saving schedule for chat {chat_id}: {e}")
+        await update.message.reply_text(
+            "Could not save the schedule, please try again later."
+        )
+        return ConversationHandler.END
 
-    # Reschedule all jobs
-    app = context.application
-    schedule_all_messages(app.bot_data["scheduler"], app)
+    # Index the new schedule only
+    context.application.bot_data["dispatcher"].upsert(schedule)
+    context.application.bot_data["keyboard_pages"].invalidate_owner(user_id, "schedules")
 
     await update.message.reply_text(
         f"Schedule added for {chat_title}:\n"
         f"Message: {message}\n"
-        f"Times: {', '.join(valid_times)}\n\n"
+        f"Times: {_short(schedule.when(), 200)} ({schedule.timezone})\n\n"
         f"Use /groups to manage more schedules."
     )
 
     return ConversationHandler.END
 
 
+@HANDLER_LATENCY.time("timezone_entered")
+async def timezone_entered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Set the timezone of the selected group's schedules."""
+    try:
+        name = normalize_timezone(update.message.text)
+    except ValueError:
+        await update.message.reply_text(
+            f"Unknown timezone: {update.message.text.strip()}.\n"
+            f"Please send an IANA name such as Europe/Berlin, or /cancel."
+        )
+        return SET_TIMEZONE
+
+    chat_id = context.user_data.get("selected_chat_id")
+    chat_title = context.user_data.get("selected_chat_title", chat_id)
+    try:
+        moved = await run_async(set_chat_timezone, int(chat_id), name)
+    except Exception as e:
+        logging.error(f"Error setting timezone for chat {chat_id}: {e}")
+        await update.message.reply_text(
+            "Could not set the timezone, please try again later."
+        )
+        return ConversationHandler.END
+
+    # Fire minutes of the moved schedules changed; buckets are reread as they come due
+    context.application.bot_data["dispatcher"].invalidate()
+    context.application.bot_data["keyboard_pages"].invalidate_owner(update.effective_user.id, "schedules")
+
+    await update.message.reply_text(
+        f"Timezone for {chat_title} set to {name}.\n"
+        f"{moved} existing schedule(s) now fire at their times in {name}.\n\n"
+        f"Use /groups to manage more schedules."
+    )
+    return ConversationHandler.END
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
     await update.message.reply_text("Operation cancelled.")
     return ConversationHandler.END
 
 
+async def load_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Report projected send load per minute (admins only)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("This command is only available to admins.")
+        return
+
+    # Optional argument: jitter window in minutes to project
+    jitter = DISPATCH_JITTER_MINUTES
+    if context.args:
+        try:
+            jitter = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Usage: /load [jitter_minutes]")
+            return
+
+    try:
+        schedules = await run_async(get_all_schedules)
+    except Exception as e:
+        logging.error(f"Error loading schedules for load report: {e}")
+        await update.message.reply_text("Could not load schedules, please try again later.")
+        return
+    await update.message.reply_text(format_report(schedules, jitter, top=5))
+
+
+async def forget_import(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drop a pending /import when the user sends any other command."""
+    # Runs before the command's own handler, so /import sets it again
+    if context.user_data is not None:
+        context.user_data.pop("import_pending", None)
+
+
+@HANDLER_LATENCY.time("import_command")
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ask for a file of schedules to import."""
+    # When it was asked for; a file sent much later is not an import
+    context.user_data["import_pending"] = time.time()
+    await update.message.reply_text(
+        "Send me a CSV or JSON Lines file with one schedule per row:\n"
+        "chat,message,times\n"
+        '-1001234567890,"Good morning!","mon-fri 09:00"\n\n'
+        "chat is a group id (several separated by spaces for a broadcast), and times use "
+        "the same format as when adding a schedule. /export gives a file in this format."
+    )
+
+
+@HANDLER_LATENCY.time("import_document")
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Import the schedules in a file sent after /import (or captioned /import)."""
+    caption = (update.message.caption or "").strip()
+    requested = context.user_data.pop("import_pending", None)
+    pending = requested is not None and time.time() - requested <= BULK_IMPORT_WAIT_SECONDS
+    if not pending and not caption.startswith("/import"):
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"The file is too large; the limit is {BULK_IMPORT_MAX_BYTES // 1024} KB."
+        )
+        return
+
+    user_id = update.effective_user.id
+    try:
+        with tempfile.TemporaryFile() as upload:
+            telegram_file = await document.get_file()
+            await telegram_file.download_to_memory(out=upload)
+            upload.seek(0)
+            # Groups the bot just joined may still be buffered
+            await context.application.bot_data["membership"].settle()
+            result, added = await import_file(user_id, upload, document.file_name or "")
+    except Exception as e:
+        logging.error(f"Error importing schedules for user {user_id}: {e}")
+        await update.message.reply_text("Could not import the file, please try again later.")
+        return
+
+    dispatcher = context.application.bot_data["dispatcher"]
+    for schedule in added:
+        dispatcher.upsert(schedule)
+    if added:
+        context.application.bot_data["keyboard_pages"].invalidate_owner(user_id, "schedules")
+    await update.message.reply_text(import_report(result, len(added)))
+    if len(result.errors) > REPORT_MAX_ERRORS:
+        with error_file(result.errors) as errors:
+            await update.message.reply_document(errors, filename="import_errors.csv")
+
+
+@HANDLER_LATENCY.time("export_command")
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the user's schedules as a CSV (default) or JSON Lines file."""
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Usage: /export [{'|'.join(EXPORT_FORMATS)}]")
+        return
+
+    user_id = update.effective_user.id
+    try:
+        out, count = await export_file(user_id, fmt)
+    except Exception as e:
+        logging.error(f"Error exporting schedules for user {user_id}: {e}")
+        await update.message.reply_text("Could not export schedules, please try again later.")
+        return
+    with out:
+        if not count:
+            await update.message.reply_text("You have no schedules to export.")
+            return
+        await update.message.reply_document(
+            out, filename=f"schedules.{fmt}", caption=f"{count} schedule(s)"
+        )
+
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log errors caused by updates."""
     logging.error(f"Update {update} caused error {context.error}")
@@ -399,93 +860,231 @@ async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Only track bot's own membership changes
     if result.new_chat_member.user.id != context.bot.id:
         return
+    directory = context.application.bot_data["chat_directory"]
+    # Changes are buffered and written in batches; readers settle them first
+    membership = context.application.bot_data["membership"]
     # Added to chat: record chat and owner (user who added the bot)
     if new_status in ('member', 'administrator'):
-        try:
-            owner_id = result.from_user.id
-            add_chat(chat.id, chat.title or '', owner_id)
-            logging.info(f"Added chat {chat.id} - {chat.title} by user {owner_id}")
-        except Exception as e:
-            logging.error(f"Error adding chat {chat.id}: {e}")
+        owner_id = result.from_user.id
+        membership.add(chat.id, chat.title or '', owner_id)
+        logging.info(f"Added chat {chat.id} - {chat.title} by user {owner_id}")
     # Removed from chat
     elif new_status in ('kicked', 'left'):
-        try:
-            remove_chat(chat.id)
-            logging.info(f"Removed chat {chat.id}")
-        except Exception as e:
-            logging.error(f"Error removing chat {chat.id}: {e}")
-
-
-def main() -> None:
-    """Run the bot."""
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
-    )
-    # Initialize database for tracking chats
-    try:
-        init_db()
-        logging.info("Database initialized successfully")
-    except Exception as e:
-        logging.error(f"Error initializing database: {e}")
-        return
-
-    # Get the token from environment variable
-    token = os.environ.get("TELEGRAM_BOT_TOKEN")
-    if not token:
-        logging.error("Environment variable TELEGRAM_BOT_TOKEN must be set")
-        return
-
-    # Create the scheduler for scheduled messages (asyncio-based)
-    scheduler = AsyncIOScheduler()
-    # Start scheduler once the bot's asyncio loop is running
-    async def start_scheduler(app: Application) -> None:
-        scheduler.start()
-
-    # Create the application with post-init hook to start the scheduler
-    application = (
+        membership.remove(chat.id)
+        logging.info(f"Removed chat {chat.id}")
+    # Drop cached title/owner; the next lookup writes the change and rereads the row
+    directory.invalidate(chat.id)
+
+
+async def _start_dispatch(app: Application) -> None:
+    """Take shard leases, then start the dispatcher (which sends missed fires first)."""
+    coordinator = app.bot_data.get("shard_coordinator")
+    if coordinator is not None:
+        with startup.phase("shard_leases"):
+            await coordinator.start()
+    app.bot_data["dispatcher"].start()
+
+
+async def start_dispatcher(app: Application) -> None:
+    """Start the send queue and dispatcher once the bot's asyncio loop is running."""
+    app.bot_data["send_queue"].start()
+    app.bot_data["delivery_log"].start()
+    app.bot_data["membership"].start()
+    if startup.FAST_BOOT:
+        # Serve updates right away; dispatch catches up in the background
+        app.bot_data["dispatch_start"] = asyncio.get_running_loop().create_task(
+            _start_dispatch(app)
+        )
+    else:
+        await _start_dispatch(app)
+    startup.checkpoint("initialize")
+    startup.ready()
+
+
+async def stop_dispatcher(app: Application) -> None:
+    """Stop the dispatcher and send queue when the application shuts down."""
+    starting = app.bot_data.pop("dispatch_start", None)
+    if starting is not None and not starting.done():
+        starting.cancel()
+        await asyncio.gather(starting, return_exceptions=True)
+    await app.bot_data["dispatcher"].stop()
+    coordinator = app.bot_data.get("shard_coordinator")
+    if coordinator is not None:
+        await coordinator.stop()
+    await app.bot_data["send_queue"].stop()
+    await app.bot_data["delivery_log"].stop()
+    await app.bot_data["membership"].stop()
+
+
+def build_application(
+    token: str,
+    base_url: Optional[str] = None,
+    concurrent_updates: int = UPDATE_CONCURRENCY,
+    keyed_updates: bool = True,
+) -> Application:
+    """Create the application with its dispatcher, send queue and handlers.
+
+    ``keyed_updates=False`` drops the per-user/per-chat ordering and is only
+    meant for comparisons in the benchmarks.
+    """
+    if keyed_updates:
+        processor = KeyedUpdateProcessor(concurrent_updates)
+    else:
+        processor = concurrent_updates
+    builder = (
         Application.builder()
         .token(token)
-        .post_init(start_scheduler)
-        .build()
+        .concurrent_updates(processor)
+        .post_init(start_dispatcher)
+        .post_shutdown(stop_dispatcher)
+    )
+    # Point the bot at another Bot API server, e.g. a local fake for benchmarks
+    if base_url:
+        builder = builder.base_url(base_url)
+        if base_url.rstrip("/").endswith("/bot"):
+            # Files are served from /file/bot<token>/ next to the API
+            builder = builder.base_file_url(base_url.rstrip("/")[: -len("/bot")] + "/file/bot")
+    application = builder.build()
+
+    # With DISPATCH_SHARDS set, replicas split the chats between them
+    coordinator = ShardCoordinator() if DISPATCH_SHARDS else None
+    application.bot_data["shard_coordinator"] = coordinator
+    # Dispatcher for scheduled messages, firing once per minute
+    application.bot_data["dispatcher"] = Dispatcher(
+        lambda chat_id, text, schedule_id, planned_at: send_scheduled_message(
+            application, chat_id, text, schedule_id, planned_at
+        ),
+        coordinator=coordinator,
+        persistent=True,
+    )
+    # Cached pages of group and schedule lists, and their keyboards
+    pages = PageCache()
+    application.bot_data["keyboard_pages"] = pages
+    # Cached chat titles and owners
+    # Buffered, batched writes of the bot's membership changes
+    membership = MembershipWriter(on_written=pages.invalidate_owners)
+    application.bot_data["membership"] = membership
+    application.bot_data["chat_directory"] = ChatDirectory(settle=membership.settle)
+    # Batched record of every scheduled send attempt
+    delivery_log = DeliveryLog()
+    application.bot_data["delivery_log"] = delivery_log
+    # Outbound queue shared by every send path
+    application.bot_data["send_queue"] = SendQueue(
+        lambda chat_id, message: send_payload(application.bot, chat_id, message),
+        on_attempt=delivery_log.record,
     )
-    application.bot_data["scheduler"] = scheduler
 
     # Register handlers
     # Track bot being added/removed from chats
     application.add_handler(
         ChatMemberHandler(chat_member_update, ChatMemberHandler.MY_CHAT_MEMBER)
     )
+    # Any command, /cancel included, ends a pending /import
+    application.add_handler(MessageHandler(filters.COMMAND, forget_import), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("load", load_report))
 
     # Conversation handler for managing groups and schedules
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("groups", list_groups)],
+        entry_points=[
+            CommandHandler("groups", list_groups),
+            CommandHandler("broadcast", start_broadcast),
+        ],
         states={
+            CHOOSING_TARGETS: [CallbackQueryHandler(target_toggled)],
             CHOOSING_GROUP: [CallbackQueryHandler(group_selected)],
             CHOOSING_ACTION: [CallbackQueryHandler(action_selected)],
+            # Any message; content that cannot be scheduled gets an explanation
             SET_MESSAGE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_entered)
+                MessageHandler(filters.UpdateType.MESSAGE & ~filters.COMMAND, message_entered)
+            ],
+            SET_TIME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, time_entered),
+                MessageHandler(SCHEDULE_MEDIA, album_item),
             ],
-            SET_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, time_entered)],
+            SET_TIMEZONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timezone_entered)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
     application.add_handler(conv_handler)
 
+    # Bulk import and export, in private chats only; registered after the
+    # conversation so files sent while adding a schedule stay schedule content
+    private = filters.ChatType.PRIVATE
+    application.add_handler(CommandHandler("import", import_command, filters=private))
+    application.add_handler(CommandHandler("export", export_command, filters=private))
+    application.add_handler(MessageHandler(private & filters.Document.ALL, import_document))
+    # /cancel outside a conversation, e.g. of a pending /import
+    application.add_handler(CommandHandler("cancel", cancel, filters=private))
+
     # Register error handler
     application.add_error_handler(error_handler)
+    return application
 
-    # Load and schedule all messages
-    schedule_all_messages(scheduler, application)
 
-    # Start the Bot
-    logging.info("Starting bot")
+def main() -> None:
+    """Run the bot."""
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    startup.checkpoint("imports")
+    # Initialize database for tracking chats
+    try:
+        init_db()
+        logging.info("Database initialized successfully")
+    except Exception as e:
+        logging.error(f"Error initializing database: {e}")
+        return
+    startup.checkpoint("db_init")
+
+    # Get the token from environment variable
+    token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not token:
+        logging.error("Environment variable TELEGRAM_BOT_TOKEN must be set")
+        return
+
+    application = build_application(token, os.environ.get("TELEGRAM_API_URL"))
+    startup.checkpoint("build")
+
+    # Expose /metrics when METRICS_PORT is set
+    start_metrics_server()
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(stop_signals=None)
+    # Schedules are read per minute as they come due; fires missed while
+    # the bot was down are sent when the dispatcher starts
+
+    # Start the Bot
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL or not WEBHOOK_SECRET:
+            logging.error("WEBHOOK_URL and WEBHOOK_SECRET must be set in webhook mode")
+            close_pool()
+            return
+        if DISPATCH_SHARDS and not WEBHOOK_STICKY:
+            # Conversations and user_data live in this process only
+            logging.error(
+                "Conversation state is not shared between replicas; route every update of a "
+                "user to the same replica and set WEBHOOK_STICKY=1 to confirm"
+            )
+            close_pool()
+            return
+        logging.info(f"Starting bot in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+        # Telegram sends the secret in X-Telegram-Bot-Api-Secret-Token;
+        # requests without it are rejected with 403
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            stop_signals=None,
+        )
+    else:
+        logging.info("Starting bot")
+        # Run the bot until the user presses Ctrl-C
+        application.run_polling(stop_signals=None)
 
-    # Shutdown scheduler when bot is stopped
-    scheduler.shutdown()
+    # Release database connections when bot is stopped
+    close_pool()
 
 if __name__ == "__main__":
     main()
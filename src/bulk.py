@@ -0,0 +1,282 @@
+"""
+Bulk import and export of an owner's schedules as CSV or JSON Lines files.
+
+An import file holds one schedule per row with three fields:
+
+- ``chat``: a group id, or several separated by spaces for a broadcast
+- ``message``: the text to send
+- ``times``: when to send it, in the same syntax as the add-schedule
+  conversation (see recurrence.parse)
+
+The upload goes to a temporary file and is parsed one row at a time.
+Every row is checked against the owner's groups, which come from a single
+lookup, and the valid rows are written in one batch. Invalid rows
+are reported by line number and do not stop the others.
+
+Exports page through the owner's schedules by id and write each page to a
+temporary file as it arrives, so the whole export is never held as Python
+objects.
+"""
+import io
+import os
+import csv
+import json
+import tempfile
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO, Dict, Iterator, List, Set, Tuple, Union
+
+from db import add_schedules, get_chats_by_owner, get_owner_schedules, run_async
+from recurrence import Recurrence, parse as parse_recurrence
+from schedules import Schedule
+
+# Largest import file accepted, in bytes
+BULK_IMPORT_MAX_BYTES = int(os.environ.get("BULK_IMPORT_MAX_BYTES", str(2 * 1024 * 1024)))
+# Rows read from one import file; the rest are reported as not imported
+BULK_IMPORT_MAX_ROWS = int(os.environ.get("BULK_IMPORT_MAX_ROWS", "5000"))
+# How long after /import a file is still taken as the import, in seconds
+BULK_IMPORT_WAIT_SECONDS = int(os.environ.get("BULK_IMPORT_WAIT_SECONDS", "600"))
+
+# Fields of a row, in CSV column order without a header
+FIELDS = ("chat", "message", "times", "rich")
+EXPORT_FORMATS = ("csv", "jsonl")
+# Schedules read from the database per export page
+EXPORT_PAGE_SIZE = 500
+# Errors listed in the reply; a longer report is attached as a file
+REPORT_MAX_ERRORS = 20
+# Telegram's limit on the length of a text message
+MESSAGE_MAX_CHARS = 4096
+_HEADER_ALIASES = {"chat_id": "chat", "time": "times"}
+_TRUE = {"1", "true", "yes", "y"}
+
+
+@dataclass(frozen=True)
+class ImportRow:
+    """A validated row of an import file."""
+
+    line: int
+    chat_ids: Tuple[int, ...]
+    message: str
+    recurrence: Recurrence
+
+
+@dataclass
+class ImportResult:
+    """Valid rows and (line, reason) errors of an import file."""
+
+    rows: List[ImportRow] = field(default_factory=list)
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+    # Whether the file had more than BULK_IMPORT_MAX_ROWS rows
+    truncated: bool = False
+
+
+def _is_jsonl(stream: io.TextIOBase, filename: str) -> bool:
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in (".jsonl", ".ndjson", ".json"):
+        return True
+    if extension == ".csv":
+        return False
+    # No telling extension: JSON Lines start with an object
+    start = stream.read(64).lstrip()
+    stream.seek(0)
+    return start.startswith("{")
+
+
+def _csv_records(stream: io.TextIOBase) -> Iterator[Tuple[int, Union[Dict[str, Any], str]]]:
+    reader = csv.reader(stream)
+    header = None
+    first = True
+    line = 1
+    try:
+        for record in reader:
+            # A quoted message may span lines; report where the row starts
+            start, line = line, reader.line_num + 1
+            if not any(cell.strip() for cell in record):
+                continue
+            columns = [_HEADER_ALIASES.get(c.strip().lower(), c.strip().lower()) for c in record]
+            if first and "chat" in columns:
+                # An optional header row names the columns
+                header = columns
+                first = False
+                continue
+            first = False
+            names = header or FIELDS
+            if len(record) > len(names):
+                yield start, (
+                    f"{len(record)} columns, expected at most {len(names)} "
+                    f"(quote messages that contain commas)"
+                )
+                continue
+            yield start, dict(zip(names, record))
+    except csv.Error as e:
+        yield line, f"unreadable CSV: {e}"
+
+
+def _jsonl_records(stream: io.TextIOBase) -> Iterator[Tuple[int, Union[Dict[str, Any], str]]]:
+    for line, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            yield line, f"invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line, "expected a JSON object"
+            continue
+        yield line, {_HEADER_ALIASES.get(key, key): value for key, value in record.items()}
+
+
+def _chat_ids(value: Any) -> Tuple[int, ...]:
+    if isinstance(value, str):
+        value = value.replace(";", " ").split()
+    elif not isinstance(value, list):
+        value = [value]
+    try:
+        chat_ids = tuple(
+            int(chat_id) for chat_id in value if not isinstance(chat_id, (bool, float))
+        )
+    except (TypeError, ValueError):
+        chat_ids = ()
+    if not chat_ids or len(chat_ids) != len(value):
+        raise ValueError("chat must be a group id, or several separated by spaces")
+    return chat_ids
+
+
+def _row(line: int, record: Dict[str, Any], owned: Set[int]) -> ImportRow:
+    """Validate one record, raising ValueError with the reason it is rejected."""
+    chat_ids = _chat_ids(record.get("chat"))
+    missing = [str(chat_id) for chat_id in chat_ids if chat_id not in owned]
+    if missing:
+        raise ValueError(f"not one of your groups: {', '.join(missing)}")
+    if str(record.get("rich") or "").strip().lower() in _TRUE or record.get("rich") is True:
+        raise ValueError("formatted and media messages can only be scheduled in the chat")
+    message = record.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise ValueError("message is empty")
+    if len(message) > MESSAGE_MAX_CHARS:
+        raise ValueError(f"message is longer than {MESSAGE_MAX_CHARS} characters")
+    times = record.get("times")
+    if isinstance(times, list):
+        times = ", ".join(str(time_str) for time_str in times)
+    if not isinstance(times, str):
+        raise ValueError("times are missing")
+    # The same rules as times entered in the conversation
+    return ImportRow(line, chat_ids, message, parse_recurrence(times))
+
+
+def read_import(stream: BinaryIO, filename: str, owned: Set[int]) -> ImportResult:
+    """Parse and validate an import file row by row."""
+    result = ImportResult()
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        records = _jsonl_records(text) if _is_jsonl(text, filename) else _csv_records(text)
+        count = 0
+        for line, record in records:
+            count += 1
+            if count > BULK_IMPORT_MAX_ROWS:
+                result.truncated = True
+                break
+            if isinstance(record, str):
+                result.errors.append((line, record))
+                continue
+            try:
+                result.rows.append(_row(line, record, owned))
+            except ValueError as e:
+                result.errors.append((line, str(e)))
+    except UnicodeDecodeError:
+        result.errors.append((0, "the file is not UTF-8 text"))
+    finally:
+        # Leave closing the upload to the caller
+        text.detach()
+    return result
+
+
+async def import_file(
+    owner_id: int, stream: BinaryIO, filename: str
+) -> Tuple[ImportResult, List[Schedule]]:
+    """Import an uploaded file for an owner, returning the result and the added schedules."""
+    owned = {chat_id for chat_id, _ in await run_async(get_chats_by_owner, owner_id)}
+    result = await run_async(read_import, stream, filename, owned)
+    added = await run_async(
+        add_schedules,
+        owner_id,
+        [(list(row.chat_ids), row.message, row.recurrence) for row in result.rows],
+    )
+    return result, added
+
+
+def report(result: ImportResult, added: int) -> str:
+    """Describe an import: the count added and the first errors by line."""
+    lines = [f"Imported {added} schedule(s)."]
+    if result.truncated:
+        lines.append(f"Only the first {BULK_IMPORT_MAX_ROWS} rows were read.")
+    if result.errors:
+        lines.append(f"{len(result.errors)} row(s) were skipped:")
+        for line, reason in result.errors[:REPORT_MAX_ERRORS]:
+            lines.append(f"Line {line}: {reason}" if line else reason)
+        if len(result.errors) > REPORT_MAX_ERRORS:
+            lines.append("The full list is attached.")
+    return "\n".join(lines)
+
+
+def error_file(errors: List[Tuple[int, str]]) -> BinaryIO:
+    """Return every (line, reason) error as a CSV file."""
+    out = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(("line", "error"))
+    writer.writerows(errors)
+    text.flush()
+    text.detach()
+    out.seek(0)
+    return out
+
+
+def export_record(schedule: Schedule) -> Dict[str, Any]:
+    """Return a schedule as an import row; ``times`` is its rule or its daily times."""
+    return {
+        # One group id, or the list of a broadcast's groups
+        "chat": list(schedule.chat_ids) if len(schedule.chat_ids) > 1 else schedule.chat_id,
+        "message": schedule.message,
+        "times": schedule.when(),
+        # Formatted and media content is exported by its description only
+        "rich": schedule.payload_id is not None,
+    }
+
+
+async def export_file(owner_id: int, fmt: str) -> Tuple[BinaryIO, int]:
+    """Write an owner's schedules to a temporary file a page at a time.
+
+    Returns the file, rewound, and the number of schedules in it.
+    """
+    out = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    writer = csv.writer(text) if fmt == "csv" else None
+    count = 0
+    after = None
+    try:
+        if writer is not None:
+            writer.writerow(FIELDS)
+        while True:
+            page = await run_async(get_owner_schedules, owner_id, after, EXPORT_PAGE_SIZE)
+            for schedule in page:
+                record = export_record(schedule)
+                if writer is not None:
+                    if isinstance(record["chat"], list):
+                        record["chat"] = " ".join(str(chat_id) for chat_id in record["chat"])
+                    record["rich"] = "1" if record["rich"] else ""
+                    writer.writerow([record[name] for name in FIELDS])
+                else:
+                    text.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += len(page)
+            if len(page) < EXPORT_PAGE_SIZE:
+                break
+            after = page[-1].id
+        text.flush()
+    except BaseException:
+        # Closes the temporary file too; only a complete export is returned
+        text.close()
+        raise
+    text.detach()
+    out.seek(0)
+    return out, count
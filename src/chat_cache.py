@@ -0,0 +1,93 @@
+"""
+In-process cache of chat metadata (title and owner) keyed by chat_id.
+
+Entries expire after CHAT_CACHE_TTL seconds and the least recently used
+entries are evicted beyond CHAT_CACHE_SIZE. Misses fall back to a point
+lookup in the database; membership changes invalidate the affected chat.
+Buffered membership changes for a chat are written before it is looked up.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+
+from db import get_chat, run_async
+from metrics import Counter
+
+# Seconds a cached chat entry stays valid
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", "300"))
+# Maximum number of cached chats
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", "10000"))
+
+CHAT_CACHE_LOOKUPS = Counter(
+    "autosend_chat_cache_lookups_total", "Chat directory lookups by result", ["result"]
+)
+
+# (title, owner_id), or None for chats the bot does not know
+ChatInfo = Optional[Tuple[str, Optional[int]]]
+
+
+class ChatDirectory:
+    """TTL + LRU cache of chat_id -> (title, owner_id)."""
+
+    def __init__(
+        self,
+        ttl: float = CHAT_CACHE_TTL,
+        max_size: int = CHAT_CACHE_SIZE,
+        settle: Optional[Callable[[int], Awaitable[bool]]] = None,
+    ) -> None:
+        self._ttl = ttl
+        self._max_size = max_size
+        # Writes pending changes for a chat; True if there were any
+        self._settle = settle
+        # chat_id -> (expires_at, info)
+        self._entries: "OrderedDict[int, Tuple[float, ChatInfo]]" = OrderedDict()
+
+    def cached(self, chat_id: int) -> Tuple[bool, ChatInfo]:
+        """Return (hit, info) without touching the database."""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return False, None
+        expires_at, info = entry
+        if expires_at < time.monotonic():
+            del self._entries[chat_id]
+            return False, None
+        self._entries.move_to_end(chat_id)
+        return True, info
+
+    def put(self, chat_id: int, title: str, owner_id: Optional[int]) -> None:
+        """Store fresh metadata for a chat."""
+        self._store(chat_id, (title, owner_id))
+
+    def invalidate(self, chat_id: int) -> None:
+        """Forget a chat so the next lookup reads the database."""
+        self._entries.pop(chat_id, None)
+
+    def _store(self, chat_id: int, info: ChatInfo) -> None:
+        self._entries[chat_id] = (time.monotonic() + self._ttl, info)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    async def lookup(self, chat_id: int) -> ChatInfo:
+        """Return (title, owner_id) for a chat, reading the database on a miss."""
+        if self._settle is not None and await self._settle(chat_id):
+            self.invalidate(chat_id)
+        hit, info = self.cached(chat_id)
+        if hit:
+            CHAT_CACHE_LOOKUPS.inc("hit")
+            return info
+        CHAT_CACHE_LOOKUPS.inc("miss")
+        info = await run_async(get_chat, chat_id)
+        self._store(chat_id, info)
+        return info
+
+    async def title(self, chat_id: int) -> Optional[str]:
+        """Return the chat title, or None if unknown."""
+        info = await self.lookup(chat_id)
+        return info[0] if info else None
+
+    async def owner(self, chat_id: int) -> Optional[int]:
+        """Return the chat owner's user id, or None if not set."""
+        info = await self.lookup(chat_id)
+        return info[1] if info else None
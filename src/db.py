@@ -1,28 +1,263 @@
 """
 Database module for tracking chats where the bot is added.
+
+Connections come from a bounded, process-wide pool instead of being opened
+per query. Every pooled connection keeps its own set of server-side prepared
+statements, so hot queries are parsed and planned once per connection.
+Blocking calls can be pushed off the event loop with ``run_async``.
 """
 import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+import weakref
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 
 # Ensure psycopg2 returns tuples for fetchall
-from psycopg2.extras import RealDictCursor
-from typing import Optional
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from metrics import DB_POOL, DB_QUERY_LATENCY
+from timezones import DEFAULT_TIMEZONE, current_offset, utc_minute
+from payloads import Payload, load as load_payload
+from recurrence import Recurrence, day_filter
+from schedules import Schedule, minutes_of
+from startup import FAST_BOOT
 
 # Expected environment variable DATABASE_URL, e.g., from Railway
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# sslmode=require helps on some hosted environments; override for local servers
+DATABASE_SSLMODE = os.environ.get("DATABASE_SSLMODE", "require")
+
+# Pool sizing and health checks. DB_POOL_MIN connections are opened up front
+# and kept while idle; ones opened beyond it under load are closed when
+# returned, and their prepared statements with them
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "4"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# Connections idle for longer than this many seconds are pinged before reuse
+DB_HEALTHCHECK_IDLE = float(os.environ.get("DB_HEALTHCHECK_IDLE", "30"))
+
+# Version of the schema init_db creates; bump it whenever init_db's statements
+# change, or databases already at the old version skip the new migrations
+SCHEMA_VERSION = 3
+# Advisory lock key held while migrating, so replicas migrate one at a time
+_MIGRATION_LOCK = 0x6175746F73656E64
+
+# Keyset start below every chat_id
+_MIN_BIGINT = -(2 ** 63)
+
+_pool: Optional[ThreadedConnectionPool] = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_executor: Optional[ThreadPoolExecutor] = None
+
+# Per-connection bookkeeping, keyed by the connection itself: an entry goes
+# away with its connection, so a new connection never inherits another's
+# prepared statements (as it could through a reused id())
+_last_used: "weakref.WeakKeyDictionary[Any, float]" = weakref.WeakKeyDictionary()
+_prepared: "weakref.WeakKeyDictionary[Any, Set[str]]" = weakref.WeakKeyDictionary()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "checkouts": 0,
+    "in_use": 0,
+    "wait_seconds": 0.0,
+    "timeouts": 0,
+    "healthcheck_failures": 0,
+    "discarded": 0,
+    "prepared": 0,
+}
+
 
 def get_connection():
+    """Open a new, unpooled connection to the database."""
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL environment variable not set")
-    # sslmode=require helps on some hosted environments
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+    return psycopg2.connect(DATABASE_URL, sslmode=DATABASE_SSLMODE)
+
 
-def init_db():
-    """Initialize the database, creating tables if they do not exist."""
-    conn = get_connection()
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL environment variable not set")
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, sslmode=DATABASE_SSLMODE
+                )
+    return _pool
+
+
+def _bump(key: str, amount=1) -> None:
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def _forget(conn) -> None:
+    _last_used.pop(conn, None)
+    _prepared.pop(conn, None)
+
+
+def _is_healthy(conn) -> bool:
+    """Check a connection before handing it out."""
+    if conn.closed:
+        return False
+    idle = time.monotonic() - _last_used.get(conn, 0.0)
+    if idle < DB_HEALTHCHECK_IDLE:
+        return True
     try:
+        with conn.cursor() as curs:
+            curs.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool: ThreadedConnectionPool):
+    conn = pool.getconn()
+    if not _is_healthy(conn):
+        _bump("healthcheck_failures")
+        _forget(conn)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+
+def _checkin(pool: ThreadedConnectionPool, conn, broken: bool) -> None:
+    if broken or conn.closed:
+        _bump("discarded")
+        _forget(conn)
+        pool.putconn(conn, close=True)
+        return
+    _last_used[conn] = time.monotonic()
+    pool.putconn(conn)
+    if conn.closed:
+        # Closed by the pool
+        _forget(conn)
+
+
+@contextmanager
+def connection() -> Iterator[Any]:
+    """Borrow a connection from the pool, waiting up to DB_POOL_TIMEOUT seconds."""
+    pool = _get_pool()
+    started = time.monotonic()
+    if not _slots.acquire(timeout=DB_POOL_TIMEOUT):
+        _bump("timeouts")
+        raise RuntimeError("Timed out waiting for a database connection")
+    _bump("wait_seconds", time.monotonic() - started)
+    conn = None
+    broken = False
+    try:
+        conn = _checkout(pool)
+        _bump("checkouts")
+        _bump("in_use")
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if conn is not None:
+            _bump("in_use", -1)
+            _checkin(pool, conn, broken)
+        _slots.release()
+
+
+def _execute(curs, name: str, query: str, params: tuple = ()) -> None:
+    """Execute a named statement, preparing it once per pooled connection.
+
+    ``query`` uses PostgreSQL ``$n`` placeholders.
+    """
+    prepared = _prepared.setdefault(curs.connection, set())
+    if name not in prepared:
+        curs.execute(f"PREPARE {name} AS {query}")
+        prepared.add(name)
+        _bump("prepared")
+    if params:
+        placeholders = ", ".join(["%s"] * len(params))
+        curs.execute(f"EXECUTE {name} ({placeholders});", params)
+    else:
+        curs.execute(f"EXECUTE {name};")
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Return a snapshot of pool usage counters."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["max_size"] = DB_POOL_MAX
+    return stats
+
+
+for _stat in _stats:
+    DB_POOL.set_function(lambda stat=_stat: _stats[stat], _stat)
+
+
+def close_pool() -> None:
+    """Close every pooled connection and stop the worker threads."""
+    global _pool, _executor
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+    _last_used.clear()
+    _prepared.clear()
+
+
+async def run_async(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a blocking database call in a worker thread sized to the pool."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def _schema_current(curs) -> bool:
+    """Whether the database is at SCHEMA_VERSION or newer (during a rolling deploy)."""
+    # A catalog query rather than to_regclass, whose cached miss would hide a
+    # table another replica created while this one waited for the lock
+    curs.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_tables "
+        "WHERE schemaname = current_schema() AND tablename = 'schema_version');"
+    )
+    if not curs.fetchone()[0]:
+        return False
+    curs.execute("SELECT max(version) FROM schema_version;")
+    version = curs.fetchone()[0]
+    return version is not None and version >= SCHEMA_VERSION
+
+
+def init_db() -> bool:
+    """Initialize the database, creating tables if they do not exist.
+
+    With FAST_BOOT, a database already at SCHEMA_VERSION costs two queries
+    instead of the full migrations. Returns whether the migrations ran.
+    """
+    with connection() as conn:
         with conn:
             with conn.cursor() as curs:
+                if FAST_BOOT and _schema_current(curs):
+                    logging.info(f"Schema at version {SCHEMA_VERSION}, migrations skipped")
+                    return False
+                # Concurrent replicas wait here; the ones after the first find
+                # the schema current and skip
+                curs.execute("SELECT pg_advisory_xact_lock(%s);", (_MIGRATION_LOCK,))
+                if FAST_BOOT and _schema_current(curs):
+                    return False
                 # Create or update chats table to include owner_id
                 curs.execute(
                     """
@@ -41,79 +276,1072 @@ def init_db():
                     ADD COLUMN IF NOT EXISTS owner_id BIGINT;
                     """
                 )
-    finally:
-        conn.close()
+                # Owner's chats in chat_id order, for keyset-paged group lists
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS chats_owner_chat_idx ON chats (owner_id, chat_id);"
+                )
+                curs.execute("DROP INDEX IF EXISTS chats_owner_id_idx;")
+                # IANA timezone the chat's schedule times are in; NULL for DEFAULT_TIMEZONE
+                curs.execute("ALTER TABLE chats ADD COLUMN IF NOT EXISTS timezone TEXT;")
+                # Scheduled messages, one row per schedule
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schedules (
+                        id BIGSERIAL PRIMARY KEY,
+                        owner_id BIGINT NOT NULL,
+                        chat_id BIGINT NOT NULL,
+                        message TEXT NOT NULL,
+                        times TEXT[] NOT NULL,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );
+                    """
+                )
+                # Start of the last minute each schedule fired in; existing rows
+                # count as fired at upgrade time so nothing is replayed
+                curs.execute(
+                    """
+                    ALTER TABLE schedules
+                    ADD COLUMN IF NOT EXISTS last_fired_at TIMESTAMPTZ NOT NULL DEFAULT now();
+                    """
+                )
+                # Every target chat of a broadcast, primary chat first; NULL
+                # for single-chat schedules
+                curs.execute(
+                    """
+                    ALTER TABLE schedules
+                    ADD COLUMN IF NOT EXISTS chat_ids BIGINT[];
+                    """
+                )
+                # Timezone of the schedule's "HH:MM" times, copied from its
+                # primary chat; rows from before timezones get the default
+                curs.execute("ALTER TABLE schedules ADD COLUMN IF NOT EXISTS timezone TEXT;")
+                curs.execute(
+                    "UPDATE schedules SET timezone = %s WHERE timezone IS NULL;",
+                    (DEFAULT_TIMEZONE,),
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedules_timezone_idx ON schedules (timezone);"
+                )
+                # Rich message content (formatted text, media by file_id),
+                # stored once per distinct content and shared by schedules
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS payloads (
+                        id BIGSERIAL PRIMARY KEY,
+                        digest TEXT NOT NULL UNIQUE,
+                        kind TEXT NOT NULL,
+                        body JSONB NOT NULL,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );
+                    """
+                )
+                # NULL for plain text schedules, whose message is all there is
+                curs.execute(
+                    "ALTER TABLE schedules ADD COLUMN IF NOT EXISTS payload_id BIGINT "
+                    "REFERENCES payloads (id);"
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedules_payload_idx ON schedules (payload_id);"
+                )
+                # Recurrence rule in canonical form and its compiled day masks;
+                # NULL for schedules that fire daily at their times
+                curs.execute(
+                    """
+                    ALTER TABLE schedules
+                    ADD COLUMN IF NOT EXISTS rule TEXT,
+                    ADD COLUMN IF NOT EXISTS weekdays SMALLINT,
+                    ADD COLUMN IF NOT EXISTS monthdays INTEGER,
+                    ADD COLUMN IF NOT EXISTS starts_on DATE,
+                    ADD COLUMN IF NOT EXISTS ends_on DATE;
+                    """
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedules_owner_chat_idx "
+                    "ON schedules (owner_id, chat_id, id);"
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedules_chat_idx ON schedules (chat_id);"
+                )
+                # Keyset pages over all of an owner's schedules, for exports
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedules_owner_id_idx ON schedules (owner_id, id);"
+                )
+                # Fire times as minutes since midnight, for lookups by minute
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schedule_times (
+                        schedule_id BIGINT NOT NULL
+                            REFERENCES schedules (id) ON DELETE CASCADE,
+                        fire_minute SMALLINT NOT NULL,
+                        PRIMARY KEY (schedule_id, fire_minute)
+                    );
+                    """
+                )
+                # fire_minute is local to the schedule's timezone; utc_minute is
+                # the compiled UTC minute of day the dispatcher looks up
+                curs.execute(
+                    "ALTER TABLE schedule_times ADD COLUMN IF NOT EXISTS utc_minute SMALLINT;"
+                )
+                curs.execute("DROP INDEX IF EXISTS schedule_times_minute_idx;")
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedule_times_utc_minute_idx "
+                    "ON schedule_times (utc_minute);"
+                )
+                # UTC offset each zone in use was compiled with, valid until
+                # the zone's next transition
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS tz_offsets (
+                        timezone TEXT PRIMARY KEY,
+                        utc_offset SMALLINT NOT NULL,
+                        valid_until TIMESTAMPTZ NOT NULL
+                    );
+                    """
+                )
+                # Compile rows written before timezones existed
+                curs.execute(
+                    "SELECT DISTINCT s.timezone FROM schedule_times t "
+                    "JOIN schedules s ON s.id = t.schedule_id WHERE t.utc_minute IS NULL;"
+                )
+                now = datetime.now(timezone.utc)
+                for (name,) in curs.fetchall():
+                    _compile_zone(curs, name, now)
+                # Dispatch shards leased by running replicas
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS shard_leases (
+                        shard INT PRIMARY KEY,
+                        holder TEXT,
+                        expires_at TIMESTAMPTZ NOT NULL DEFAULT '-infinity'
+                    );
+                    """
+                )
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS replicas (
+                        replica_id TEXT PRIMARY KEY,
+                        heartbeat_at TIMESTAMPTZ NOT NULL
+                    );
+                    """
+                )
+                # One row per (schedule, planned minute) that has been fired
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schedule_fires (
+                        schedule_id BIGINT NOT NULL,
+                        fire_at TIMESTAMPTZ NOT NULL,
+                        PRIMARY KEY (schedule_id, fire_at)
+                    );
+                    """
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS schedule_fires_fire_at_idx "
+                    "ON schedule_fires (fire_at);"
+                )
+                # One row per send attempt of a scheduled message
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS deliveries (
+                        id BIGSERIAL PRIMARY KEY,
+                        schedule_id BIGINT NOT NULL,
+                        chat_id BIGINT NOT NULL,
+                        planned_at TIMESTAMPTZ NOT NULL,
+                        sent_at TIMESTAMPTZ NOT NULL,
+                        status TEXT NOT NULL,
+                        message_id BIGINT,
+                        latency_ms INT NOT NULL,
+                        error TEXT
+                    );
+                    """
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS deliveries_schedule_idx "
+                    "ON deliveries (schedule_id, sent_at DESC);"
+                )
+                curs.execute(
+                    "CREATE INDEX IF NOT EXISTS deliveries_sent_at_idx ON deliveries (sent_at);"
+                )
+                # Versions migrated to, for skipping migrations on later boots
+                curs.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INT PRIMARY KEY,
+                        migrated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );
+                    """
+                )
+                curs.execute(
+                    "INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING;",
+                    (SCHEMA_VERSION,),
+                )
+    logging.info(f"Database pool ready (min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return True
+
 
+@DB_QUERY_LATENCY.time("add_chat")
 def add_chat(chat_id: int, title: str, owner_id: Optional[int] = None) -> None:
     """Add or update a chat record, optionally setting the owner_id."""
-    conn = get_connection()
-    try:
+    with connection() as conn:
         with conn:
             with conn.cursor() as curs:
-                # Insert or update, preserving existing owner_id if already set
                 # Upsert the chat record, preserving existing owner_id when present
-                query = (
+                _execute(
+                    curs,
+                    "add_chat",
                     "INSERT INTO chats (chat_id, title, owner_id) "
-                    "VALUES (%s, %s, %s) "
+                    "VALUES ($1, $2, $3) "
                     "ON CONFLICT (chat_id) DO UPDATE SET "
                     "title = EXCLUDED.title, "
-                    "owner_id = COALESCE(chats.owner_id, EXCLUDED.owner_id);"
+                    "owner_id = COALESCE(chats.owner_id, EXCLUDED.owner_id)",
+                    (chat_id, title, owner_id),
                 )
-                curs.execute(query, (chat_id, title, owner_id))
-    finally:
-        conn.close()
 
+
+@DB_QUERY_LATENCY.time("remove_chat")
 def remove_chat(chat_id: int) -> None:
     """Remove a chat record."""
-    conn = get_connection()
-    try:
+    with connection() as conn:
         with conn:
             with conn.cursor() as curs:
-                curs.execute(
-                    "DELETE FROM chats WHERE chat_id = %s;",
+                _execute(
+                    curs,
+                    "remove_chat",
+                    "DELETE FROM chats WHERE chat_id = $1",
                     (chat_id,),
                 )
-    finally:
-        conn.close()
 
+
+@DB_QUERY_LATENCY.time("get_chats")
 def get_chats() -> list[tuple[int, str]]:
     """Return all recorded chats as a list of (chat_id, title)."""
-    conn = get_connection()
-    try:
+    with connection() as conn:
         with conn:
             with conn.cursor() as curs:
-                curs.execute("SELECT chat_id, title FROM chats;")
+                _execute(curs, "get_chats", "SELECT chat_id, title FROM chats")
                 return curs.fetchall()
-    finally:
-        conn.close()
-    
-def get_chats_by_owner(owner_id: int) -> list[tuple[int, str]]:
-    """Return all recorded chats (chat_id, title) where owner_id matches the given user."""
-    conn = get_connection()
-    try:
+
+
+@DB_QUERY_LATENCY.time("apply_chat_changes")
+def apply_chat_changes(
+    removed: List[int], upserts: List[Tuple[int, str, Optional[int]]]
+) -> Set[int]:
+    """Apply a batch of membership changes in one transaction.
+
+    Chats in ``removed`` are deleted first, then ``upserts`` rows of
+    (chat_id, title, owner_id) are written with the same owner-preserving
+    rule as ``add_chat``. Returns the owners whose chat lists changed.
+    """
+    owners: Set[int] = set()
+    if not removed and not upserts:
+        return owners
+    with connection() as conn:
         with conn:
             with conn.cursor() as curs:
-                curs.execute(
-                    "SELECT chat_id, title FROM chats WHERE owner_id = %s;",
-                    (owner_id,),
-                )
+                if removed:
+                    _execute(
+                        curs,
+                        "remove_chats",
+                        "DELETE FROM chats WHERE chat_id = ANY($1::bigint[]) RETURNING owner_id",
+                        (removed,),
+                    )
+                    owners.update(row[0] for row in curs.fetchall())
+                if upserts:
+                    rows = execute_values(
+                        curs,
+                        "INSERT INTO chats (chat_id, title, owner_id) VALUES %s "
+                        "ON CONFLICT (chat_id) DO UPDATE SET "
+                        "title = EXCLUDED.title, "
+                        "owner_id = COALESCE(chats.owner_id, EXCLUDED.owner_id) "
+                        "RETURNING owner_id",
+                        upserts,
+                        fetch=True,
+                    )
+                    owners.update(row[0] for row in rows)
+    owners.discard(None)
+    return owners
+
+
+@DB_QUERY_LATENCY.time("get_chats_by_owner")
+def get_chats_by_owner(
+    owner_id: int, after: Optional[int] = None, limit: Optional[int] = None
+) -> list[tuple[int, str]]:
+    """Return recorded chats (chat_id, title) where owner_id matches the given user.
+
+    Chats come in chat_id order. With ``limit``, at most that many chats
+    with a chat_id greater than ``after`` are returned (keyset paging).
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                if limit is None:
+                    _execute(
+                        curs,
+                        "get_chats_by_owner",
+                        "SELECT chat_id, title FROM chats WHERE owner_id = $1 ORDER BY chat_id",
+                        (owner_id,),
+                    )
+                else:
+                    _execute(
+                        curs,
+                        "get_chats_by_owner_page",
+                        "SELECT chat_id, title FROM chats "
+                        "WHERE owner_id = $1 AND chat_id > $2 ORDER BY chat_id LIMIT $3",
+                        (owner_id, _MIN_BIGINT if after is None else after, limit),
+                    )
                 return curs.fetchall()
-    finally:
-        conn.close()
-    
+
+
+@DB_QUERY_LATENCY.time("get_chat")
+def get_chat(chat_id: int) -> Optional[tuple[str, Optional[int]]]:
+    """Return (title, owner_id) for a given chat_id, or None if unknown."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_chat",
+                    "SELECT title, owner_id FROM chats WHERE chat_id = $1",
+                    (chat_id,),
+                )
+                row = curs.fetchone()
+                if row:
+                    return row[0] or "", row[1]
+                return None
+
+
+@DB_QUERY_LATENCY.time("get_chat_owner")
 def get_chat_owner(chat_id: int) -> Optional[int]:
     """Return the owner_id for a given chat_id, or None if not set."""
-    conn = get_connection()
-    try:
+    with connection() as conn:
         with conn:
             with conn.cursor() as curs:
-                curs.execute(
-                    "SELECT owner_id FROM chats WHERE chat_id = %s;",
+                _execute(
+                    curs,
+                    "get_chat_owner",
+                    "SELECT owner_id FROM chats WHERE chat_id = $1",
                     (chat_id,),
                 )
                 row = curs.fetchone()
                 if row:
                     return row[0]
                 return None
-    finally:
-        conn.close()
\ No newline at end of file
+
+
+def _fire_minutes(times: List[str]) -> List[int]:
+    """Convert "HH:MM" strings to minutes since midnight."""
+    minutes = []
+    for time_str in times:
+        hour_str, minute_str = time_str.split(":")
+        minutes.append(int(hour_str) * 60 + int(minute_str))
+    return minutes
+
+
+def _schedule_row(row: tuple) -> Schedule:
+    (
+        schedule_id, owner_id, chat_id, message, times, chat_ids, tz, payload_id,
+        rule, weekdays, monthdays, starts_on, ends_on,
+    ) = row
+    tz = tz or DEFAULT_TIMEZONE
+    return Schedule(
+        schedule_id,
+        owner_id,
+        chat_id,
+        message,
+        minutes_of(times),
+        tz,
+        chat_ids=tuple(chat_ids) if chat_ids else None,
+        payload_id=payload_id,
+        rule=rule,
+        # Shared by every schedule with the same zone and day masks
+        days=day_filter(tz, weekdays, monthdays, starts_on, ends_on),
+    )
+
+
+_SCHEDULE_COLUMNS = (
+    "id, owner_id, chat_id, message, times, chat_ids, timezone, payload_id, "
+    "rule, weekdays, monthdays, starts_on, ends_on"
+)
+# The same columns of schedules aliased as s, and how many there are
+_S_SCHEDULE_COLUMNS = ", ".join(f"s.{column.strip()}" for column in _SCHEDULE_COLUMNS.split(","))
+_SCHEDULE_WIDTH = _SCHEDULE_COLUMNS.count(",") + 1
+
+
+def _compile_zone(curs, name: str, now: datetime) -> None:
+    """Record a zone's current UTC offset and recompute its schedules' UTC minutes."""
+    offset, valid_until = current_offset(name, now)
+    _execute(
+        curs,
+        "upsert_tz_offset",
+        "INSERT INTO tz_offsets (timezone, utc_offset, valid_until) VALUES ($1, $2, $3) "
+        "ON CONFLICT (timezone) DO UPDATE SET "
+        "utc_offset = EXCLUDED.utc_offset, valid_until = EXCLUDED.valid_until",
+        (name, offset, valid_until),
+    )
+    _execute(
+        curs,
+        "compile_zone",
+        "UPDATE schedule_times t SET utc_minute = ((t.fire_minute - $2) % 1440 + 1440) % 1440 "
+        "FROM schedules s WHERE s.id = t.schedule_id AND s.timezone = $1 "
+        "AND t.utc_minute IS DISTINCT FROM ((t.fire_minute - $2) % 1440 + 1440) % 1440",
+        (name, offset),
+    )
+
+
+def _insert_times(curs, schedules: List[Tuple[int, str, List[str]]]) -> None:
+    """Insert the local and compiled UTC fire minutes of (id, timezone, times) schedules."""
+    now = datetime.now(timezone.utc)
+    rows = []
+    zones = set()
+    for schedule_id, tz, times in schedules:
+        offset, valid_until = current_offset(tz, now)
+        zones.add((tz, offset, valid_until))
+        rows += [
+            (schedule_id, minute, utc_minute(minute, offset))
+            for minute in set(_fire_minutes(times))
+        ]
+    # A zone seen for the first time starts being tracked for transitions
+    execute_values(
+        curs,
+        "INSERT INTO tz_offsets (timezone, utc_offset, valid_until) VALUES %s "
+        "ON CONFLICT DO NOTHING",
+        sorted(zones),
+    )
+    execute_values(
+        curs,
+        "INSERT INTO schedule_times (schedule_id, fire_minute, utc_minute) VALUES %s "
+        "ON CONFLICT DO NOTHING",
+        rows,
+        page_size=1000,
+    )
+
+
+def _rule_columns(recurrence: Optional[Recurrence]) -> tuple:
+    """Return the (rule, weekdays, monthdays, starts_on, ends_on) columns of a recurrence.
+
+    All NULL for plain daily times.
+    """
+    if recurrence is None or recurrence.plain:
+        return None, None, None, None, None
+    return (
+        recurrence.text,
+        recurrence.weekdays,
+        recurrence.monthdays,
+        recurrence.starts_on,
+        recurrence.ends_on,
+    )
+
+
+@DB_QUERY_LATENCY.time("add_schedule")
+def add_schedule(
+    owner_id: int,
+    chat_id: int,
+    message: str,
+    times: List[str],
+    chat_ids: Optional[List[int]] = None,
+    payload: Optional[Payload] = None,
+    recurrence: Optional[Recurrence] = None,
+) -> Schedule:
+    """Insert a schedule and its fire times, returning the stored schedule.
+
+    ``chat_ids`` makes it a broadcast: the message is stored once and sent
+    to every listed chat, with ``chat_id`` as the primary chat. The times
+    are in the primary chat's timezone. With ``payload`` the schedule sends
+    that rich content, shared with every schedule sending the same, and
+    ``message`` only describes it. A ``recurrence`` that is more than daily
+    times limits the days the schedule fires on; ``times`` are its times.
+    """
+    rule, weekdays, monthdays, starts_on, ends_on = _rule_columns(recurrence)
+    if chat_ids:
+        # Primary chat first, without duplicates; one chat is a plain schedule
+        chat_ids = list(dict.fromkeys([chat_id, *chat_ids]))
+    if not chat_ids or len(chat_ids) < 2:
+        chat_ids = None
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                payload_id = None
+                if payload is not None:
+                    # The no-op update returns the id of existing content too,
+                    # and locks it against a concurrent delete_schedule cleanup
+                    _execute(
+                        curs,
+                        "upsert_payload",
+                        "INSERT INTO payloads (digest, kind, body) VALUES ($1, $2, $3) "
+                        "ON CONFLICT (digest) DO UPDATE SET digest = EXCLUDED.digest RETURNING id",
+                        (payload.digest(), payload.kind, Json(payload.body())),
+                    )
+                    payload_id = curs.fetchone()[0]
+                _execute(
+                    curs,
+                    "add_schedule",
+                    "INSERT INTO schedules "
+                    "(owner_id, chat_id, message, times, chat_ids, timezone, payload_id, "
+                    "rule, weekdays, monthdays, starts_on, ends_on) "
+                    "VALUES ($1, $2, $3, $4, $5, "
+                    "COALESCE((SELECT timezone FROM chats WHERE chat_id = $2), $6), $7, "
+                    "$8, $9, $10, $11, $12) "
+                    f"RETURNING {_SCHEDULE_COLUMNS}",
+                    (
+                        owner_id, chat_id, message, times, chat_ids, DEFAULT_TIMEZONE, payload_id,
+                        rule, weekdays, monthdays, starts_on, ends_on,
+                    ),
+                )
+                schedule = _schedule_row(curs.fetchone())
+                if payload is not None:
+                    schedule.payload = load_payload(payload_id, payload.kind, payload.body())
+                _insert_times(curs, [(schedule.id, schedule.timezone, times)])
+                return schedule
+
+
+@DB_QUERY_LATENCY.time("get_schedules")
+def get_schedules(
+    owner_id: int, chat_id: int, after: Optional[int] = None, limit: Optional[int] = None
+) -> List[Schedule]:
+    """Return an owner's schedules sending to one chat, broadcasts included, oldest first.
+
+    With ``limit``, at most that many schedules with an id greater than
+    ``after`` are returned (keyset paging).
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                if limit is None:
+                    _execute(
+                        curs,
+                        "get_schedules",
+                        f"SELECT {_SCHEDULE_COLUMNS} FROM schedules "
+                        "WHERE owner_id = $1 AND (chat_id = $2 OR $2 = ANY(chat_ids)) ORDER BY id",
+                        (owner_id, chat_id),
+                    )
+                else:
+                    _execute(
+                        curs,
+                        "get_schedules_page",
+                        f"SELECT {_SCHEDULE_COLUMNS} FROM schedules "
+                        "WHERE owner_id = $1 AND (chat_id = $2 OR $2 = ANY(chat_ids)) AND id > $3 "
+                        "ORDER BY id LIMIT $4",
+                        (owner_id, chat_id, 0 if after is None else after, limit),
+                    )
+                return [_schedule_row(row) for row in curs.fetchall()]
+
+
+@DB_QUERY_LATENCY.time("add_schedules")
+def add_schedules(
+    owner_id: int, rows: List[Tuple[List[int], str, Recurrence]]
+) -> List[Schedule]:
+    """Insert (chat_ids, message, recurrence) schedules in one transaction.
+
+    The first chat of each row is its primary chat, whose timezone its
+    times are in; rows with several chats are broadcasts.
+    """
+    if not rows:
+        return []
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_chat_timezones",
+                    "SELECT chat_id, timezone FROM chats WHERE chat_id = ANY($1::bigint[])",
+                    (list({chat_ids[0] for chat_ids, _, _ in rows}),),
+                )
+                zones = {chat_id: tz for chat_id, tz in curs.fetchall() if tz}
+                values = []
+                for chat_ids, message, recurrence in rows:
+                    chat_ids = list(dict.fromkeys(chat_ids))
+                    values.append(
+                        (
+                            owner_id,
+                            chat_ids[0],
+                            message,
+                            recurrence.times(),
+                            chat_ids if len(chat_ids) > 1 else None,
+                            zones.get(chat_ids[0], DEFAULT_TIMEZONE),
+                            *_rule_columns(recurrence),
+                        )
+                    )
+                inserted = execute_values(
+                    curs,
+                    "INSERT INTO schedules (owner_id, chat_id, message, times, chat_ids, timezone, "
+                    "rule, weekdays, monthdays, starts_on, ends_on) "
+                    f"VALUES %s RETURNING {_SCHEDULE_COLUMNS}",
+                    values,
+                    template="(%s, %s, %s, %s, %s::bigint[], %s, %s, %s, %s, %s, %s)",
+                    page_size=500,
+                    fetch=True,
+                )
+                schedules = [_schedule_row(row) for row in inserted]
+                _insert_times(
+                    curs, [(schedule.id, schedule.timezone, schedule.times) for schedule in schedules]
+                )
+                return schedules
+
+
+@DB_QUERY_LATENCY.time("get_owner_schedules")
+def get_owner_schedules(owner_id: int, after: Optional[int], limit: int) -> List[Schedule]:
+    """Return up to ``limit`` of an owner's schedules with an id greater than ``after``, by id."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_owner_schedules",
+                    f"SELECT {_SCHEDULE_COLUMNS} FROM schedules "
+                    "WHERE owner_id = $1 AND id > $2 ORDER BY id LIMIT $3",
+                    (owner_id, 0 if after is None else after, limit),
+                )
+                return [_schedule_row(row) for row in curs.fetchall()]
+
+
+@DB_QUERY_LATENCY.time("get_all_schedules")
+def get_all_schedules() -> List[Schedule]:
+    """Return every stored schedule."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_all_schedules",
+                    f"SELECT {_SCHEDULE_COLUMNS} FROM schedules ORDER BY id",
+                )
+                return [_schedule_row(row) for row in curs.fetchall()]
+
+
+@DB_QUERY_LATENCY.time("get_due_schedules")
+def get_due_schedules(fire_minutes: List[int]) -> List[Schedule]:
+    """Return schedules with a fire time in the given UTC minutes of day.
+
+    Each schedule is returned once per matching minute, with the minute in
+    ``utc_minute``, the time it last fired in ``last_fired_at`` and its
+    rich content, if any, in ``payload``.
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_due_schedules",
+                    f"SELECT {_S_SCHEDULE_COLUMNS}, t.utc_minute, s.last_fired_at, p.kind, p.body "
+                    "FROM schedule_times t JOIN schedules s ON s.id = t.schedule_id "
+                    "LEFT JOIN payloads p ON p.id = s.payload_id "
+                    "WHERE t.utc_minute = ANY($1::smallint[])",
+                    (fire_minutes,),
+                )
+                schedules = []
+                for row in curs.fetchall():
+                    schedule = _schedule_row(row[:_SCHEDULE_WIDTH])
+                    utc, last_fired_at, kind, body = row[_SCHEDULE_WIDTH:]
+                    schedule.utc_minute = utc
+                    schedule.last_fired_at = last_fired_at
+                    if schedule.payload_id is not None:
+                        schedule.payload = load_payload(schedule.payload_id, kind, body)
+                    schedules.append(schedule)
+                return schedules
+
+
+@DB_QUERY_LATENCY.time("mark_fired")
+def mark_fired(schedule_ids: List[int], fired_at: datetime) -> None:
+    """Record that the given schedules fired for the minute starting at fired_at."""
+    if not schedule_ids:
+        return
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "mark_fired",
+                    "UPDATE schedules SET last_fired_at = $2 "
+                    "WHERE id = ANY($1::bigint[]) AND last_fired_at < $2",
+                    (schedule_ids, fired_at),
+                )
+
+
+@DB_QUERY_LATENCY.time("delete_schedule")
+def delete_schedule(
+    owner_id: int, chat_id: int, schedule_id: int
+) -> Optional[Schedule]:
+    """Delete one schedule sending to the chat, returning it, or None if it does not exist.
+
+    A broadcast is deleted for all of its chats.
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "delete_schedule",
+                    "DELETE FROM schedules "
+                    "WHERE id = $1 AND owner_id = $2 AND (chat_id = $3 OR $3 = ANY(chat_ids)) "
+                    f"RETURNING {_SCHEDULE_COLUMNS}",
+                    (schedule_id, owner_id, chat_id),
+                )
+                row = curs.fetchone()
+                if not row:
+                    return None
+                schedule = _schedule_row(row)
+                if schedule.payload_id is not None:
+                    # Drop the content once no schedule sends it; the row lock
+                    # waits for an add_schedule reusing it to commit first
+                    _execute(
+                        curs,
+                        "lock_payload",
+                        "SELECT id FROM payloads WHERE id = $1 FOR UPDATE",
+                        (schedule.payload_id,),
+                    )
+                    _execute(
+                        curs,
+                        "delete_unused_payload",
+                        "DELETE FROM payloads WHERE id = $1 AND NOT EXISTS "
+                        "(SELECT 1 FROM schedules WHERE payload_id = $1)",
+                        (schedule.payload_id,),
+                    )
+                return schedule
+
+
+@DB_QUERY_LATENCY.time("count_schedules")
+def count_schedules() -> int:
+    """Return the number of stored schedules."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(curs, "count_schedules", "SELECT count(*) FROM schedules")
+                return curs.fetchone()[0]
+
+
+@DB_QUERY_LATENCY.time("import_schedules")
+def import_schedules(rows: Iterable[tuple[int, int, str, List[str]]]) -> int:
+    """Bulk insert (owner_id, chat_id, message, times) rows in one transaction.
+
+    The times are in DEFAULT_TIMEZONE.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                inserted = execute_values(
+                    curs,
+                    "INSERT INTO schedules (owner_id, chat_id, message, times, timezone) "
+                    "VALUES %s RETURNING id",
+                    [row + (DEFAULT_TIMEZONE,) for row in rows],
+                    fetch=True,
+                )
+                _insert_times(
+                    curs,
+                    [
+                        (schedule_id, DEFAULT_TIMEZONE, times)
+                        for (schedule_id,), (_, _, _, times) in zip(inserted, rows)
+                    ],
+                )
+                return len(inserted)
+
+
+@DB_QUERY_LATENCY.time("heartbeat_replica")
+def heartbeat_replica(replica_id: str, ttl_seconds: float) -> int:
+    """Record a replica heartbeat, expire stale replicas and return the live count."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "heartbeat_replica",
+                    "INSERT INTO replicas (replica_id, heartbeat_at) VALUES ($1, now()) "
+                    "ON CONFLICT (replica_id) DO UPDATE SET heartbeat_at = now()",
+                    (replica_id,),
+                )
+                _execute(
+                    curs,
+                    "expire_replicas",
+                    "DELETE FROM replicas "
+                    "WHERE heartbeat_at < now() - make_interval(secs => $1)",
+                    (ttl_seconds,),
+                )
+                _execute(curs, "count_replicas", "SELECT count(*) FROM replicas")
+                return curs.fetchone()[0]
+
+
+@DB_QUERY_LATENCY.time("claim_shards")
+def claim_shards(
+    replica_id: str, shard_count: int, target: int, ttl_seconds: float
+) -> List[int]:
+    """Renew this replica's shard leases and claim or release shards to reach target.
+
+    Returns the shards held after the call.
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "create_shards",
+                    "INSERT INTO shard_leases (shard) "
+                    "SELECT generate_series(0, $1 - 1) ON CONFLICT DO NOTHING",
+                    (shard_count,),
+                )
+                _execute(
+                    curs,
+                    "renew_shards",
+                    "UPDATE shard_leases "
+                    "SET expires_at = now() + make_interval(secs => $2) "
+                    "WHERE holder = $1 AND expires_at > now() AND shard < $3 "
+                    "RETURNING shard",
+                    (replica_id, ttl_seconds, shard_count),
+                )
+                held = sorted(row[0] for row in curs.fetchall())
+                if len(held) > target:
+                    # Hand surplus shards back so newer replicas can take them
+                    release = held[target:]
+                    held = held[:target]
+                    _execute(
+                        curs,
+                        "release_some_shards",
+                        "UPDATE shard_leases SET holder = NULL, expires_at = '-infinity' "
+                        "WHERE holder = $1 AND shard = ANY($2::int[])",
+                        (replica_id, release),
+                    )
+                elif len(held) < target:
+                    _execute(
+                        curs,
+                        "take_shards",
+                        "UPDATE shard_leases "
+                        "SET holder = $1, expires_at = now() + make_interval(secs => $2) "
+                        "WHERE shard IN ("
+                        "  SELECT shard FROM shard_leases "
+                        "  WHERE expires_at <= now() AND shard < $4 "
+                        "  ORDER BY shard LIMIT $3 FOR UPDATE SKIP LOCKED"
+                        ") RETURNING shard",
+                        (replica_id, ttl_seconds, target - len(held), shard_count),
+                    )
+                    held = sorted(held + [row[0] for row in curs.fetchall()])
+                return held
+
+
+@DB_QUERY_LATENCY.time("release_shards")
+def release_shards(replica_id: str) -> None:
+    """Give up every shard lease and the heartbeat of a replica."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "release_shards",
+                    "UPDATE shard_leases SET holder = NULL, expires_at = '-infinity' "
+                    "WHERE holder = $1",
+                    (replica_id,),
+                )
+                _execute(
+                    curs,
+                    "remove_replica",
+                    "DELETE FROM replicas WHERE replica_id = $1",
+                    (replica_id,),
+                )
+
+
+@DB_QUERY_LATENCY.time("claim_fires")
+def claim_fires(schedule_ids: List[int], fire_at: datetime) -> List[int]:
+    """Record fires for (schedule, fire_at) and return the ids not fired before."""
+    if not schedule_ids:
+        return []
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "claim_fires",
+                    "INSERT INTO schedule_fires (schedule_id, fire_at) "
+                    "SELECT unnest($1::bigint[]), $2 "
+                    "ON CONFLICT DO NOTHING RETURNING schedule_id",
+                    (schedule_ids, fire_at),
+                )
+                return [row[0] for row in curs.fetchall()]
+
+
+@DB_QUERY_LATENCY.time("prune_fires")
+def prune_fires(before: datetime) -> int:
+    """Delete fire records older than the given time, returning the count."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "prune_fires",
+                    "DELETE FROM schedule_fires WHERE fire_at < $1",
+                    (before,),
+                )
+                return curs.rowcount
+
+
+# (schedule_id, chat_id, planned_at, sent_at, status, message_id, latency_ms, error)
+DeliveryRow = Tuple[int, int, datetime, datetime, str, Optional[int], int, Optional[str]]
+
+
+@DB_QUERY_LATENCY.time("insert_deliveries")
+def insert_deliveries(rows: List[DeliveryRow]) -> int:
+    """Insert a batch of delivery log rows in one statement, returning the count."""
+    if not rows:
+        return 0
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                execute_values(
+                    curs,
+                    "INSERT INTO deliveries (schedule_id, chat_id, planned_at, sent_at, "
+                    "status, message_id, latency_ms, error) VALUES %s",
+                    rows,
+                    page_size=1000,
+                )
+                return len(rows)
+
+
+@DB_QUERY_LATENCY.time("get_deliveries")
+def get_deliveries(owner_id: int, schedule_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """Return the latest delivery attempts of an owner's schedule, newest first."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_deliveries",
+                    "SELECT d.chat_id, d.planned_at, d.sent_at, d.status, d.message_id, "
+                    "d.latency_ms, d.error FROM deliveries d "
+                    "JOIN schedules s ON s.id = d.schedule_id AND s.owner_id = $1 "
+                    "WHERE d.schedule_id = $2 ORDER BY d.sent_at DESC LIMIT $3",
+                    (owner_id, schedule_id, limit),
+                )
+                return [
+                    {
+                        "chat_id": row[0],
+                        "planned_at": row[1],
+                        "sent_at": row[2],
+                        "status": row[3],
+                        "message_id": row[4],
+                        "latency_ms": row[5],
+                        "error": row[6],
+                    }
+                    for row in curs.fetchall()
+                ]
+
+
+@DB_QUERY_LATENCY.time("prune_deliveries")
+def prune_deliveries(before: datetime, keep_per_schedule: int) -> int:
+    """Delete delivery rows older than ``before``, beyond the newest
+    ``keep_per_schedule`` of each schedule, or of deleted schedules.
+
+    Returns the number of rows deleted.
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "prune_deliveries_age",
+                    "DELETE FROM deliveries WHERE sent_at < $1",
+                    (before,),
+                )
+                deleted = curs.rowcount
+                # Only schedules over the cap are ranked, via the schedule index
+                _execute(
+                    curs,
+                    "prune_deliveries_cap",
+                    "DELETE FROM deliveries WHERE id IN ("
+                    "  SELECT id FROM ("
+                    "    SELECT id, row_number() OVER "
+                    "      (PARTITION BY schedule_id ORDER BY sent_at DESC) AS n "
+                    "    FROM deliveries WHERE schedule_id IN ("
+                    "      SELECT schedule_id FROM deliveries GROUP BY schedule_id "
+                    "      HAVING count(*) > $1"
+                    "    )"
+                    "  ) ranked WHERE n > $1"
+                    ")",
+                    (keep_per_schedule,),
+                )
+                deleted += curs.rowcount
+                _execute(
+                    curs,
+                    "prune_deliveries_orphans",
+                    "DELETE FROM deliveries d WHERE NOT EXISTS "
+                    "(SELECT 1 FROM schedules s WHERE s.id = d.schedule_id)",
+                )
+                deleted += curs.rowcount
+                return deleted
+
+
+@DB_QUERY_LATENCY.time("get_chat_timezone")
+def get_chat_timezone(chat_id: int) -> str:
+    """Return the timezone of a chat's schedule times."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "get_chat_timezone",
+                    "SELECT timezone FROM chats WHERE chat_id = $1",
+                    (chat_id,),
+                )
+                row = curs.fetchone()
+                return (row and row[0]) or DEFAULT_TIMEZONE
+
+
+@DB_QUERY_LATENCY.time("set_chat_timezone")
+def set_chat_timezone(chat_id: int, name: str) -> int:
+    """Move a chat, and the schedules whose primary chat it is, to a timezone.
+
+    ``name`` must be a valid IANA zone. Returns the number of schedules moved.
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "set_chat_timezone",
+                    "UPDATE chats SET timezone = $2 WHERE chat_id = $1",
+                    (chat_id, name),
+                )
+                _execute(
+                    curs,
+                    "set_schedules_timezone",
+                    "UPDATE schedules SET timezone = $2 WHERE chat_id = $1 AND timezone <> $2",
+                    (chat_id, name),
+                )
+                moved = curs.rowcount
+                # Recompiles every schedule in the zone; ones already there are unchanged
+                _compile_zone(curs, name, datetime.now(timezone.utc))
+                return moved
+
+
+@DB_QUERY_LATENCY.time("recompile_timezones")
+def recompile_timezones(now: datetime) -> List[str]:
+    """Recompile the UTC fire minutes of zones whose offset changed, returning them.
+
+    A zone's row stays locked while it is recompiled, so concurrent replicas
+    wait for the first one and then find nothing left to do.
+    """
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "stale_timezones",
+                    "SELECT timezone FROM tz_offsets WHERE valid_until <= $1 "
+                    "ORDER BY timezone FOR UPDATE",
+                    (now,),
+                )
+                zones = [row[0] for row in curs.fetchall()]
+                for name in zones:
+                    _compile_zone(curs, name, now)
+                return zones
+
+
+@DB_QUERY_LATENCY.time("next_timezone_change")
+def next_timezone_change() -> Optional[datetime]:
+    """Return the earliest moment a compiled UTC offset stops being valid."""
+    with connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                _execute(
+                    curs,
+                    "next_timezone_change",
+                    "SELECT min(valid_until) FROM tz_offsets",
+                )
+                return curs.fetchone()[0]
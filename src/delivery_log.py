@@ -0,0 +1,159 @@
+"""
+Delivery log of scheduled messages.
+
+Every send attempt of a scheduled message (sent, retried or given up) is
+recorded with its schedule, chat, planned and actual time, Telegram
+message_id and API latency. Recording only appends to an in-memory buffer,
+so the send path never waits on the database; the buffer is inserted in
+batches every DELIVERY_LOG_FLUSH_INTERVAL seconds or once
+DELIVERY_LOG_BATCH_SIZE rows are waiting. Rows older than
+DELIVERY_LOG_RETENTION_DAYS, beyond the newest DELIVERY_LOG_KEEP_PER_SCHEDULE
+of a schedule, or belonging to deleted schedules are pruned every hour.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from db import DeliveryRow, insert_deliveries, prune_deliveries, run_async
+from metrics import Counter, Gauge
+
+# Seconds delivery rows may wait before being written
+DELIVERY_LOG_FLUSH_INTERVAL = float(os.environ.get("DELIVERY_LOG_FLUSH_INTERVAL", "2"))
+# Buffered rows that trigger an immediate write
+DELIVERY_LOG_BATCH_SIZE = int(os.environ.get("DELIVERY_LOG_BATCH_SIZE", "1000"))
+# Rows kept in memory while the database is unavailable; the oldest are dropped beyond this
+DELIVERY_LOG_MAX_BUFFER = int(os.environ.get("DELIVERY_LOG_MAX_BUFFER", "50000"))
+# Days of delivery history kept
+DELIVERY_LOG_RETENTION_DAYS = int(os.environ.get("DELIVERY_LOG_RETENTION_DAYS", "30"))
+# Newest delivery rows kept per schedule
+DELIVERY_LOG_KEEP_PER_SCHEDULE = int(os.environ.get("DELIVERY_LOG_KEEP_PER_SCHEDULE", "200"))
+
+DELIVERY_LOG_ROWS = Counter(
+    "autosend_delivery_log_rows_total", "Delivery log rows by outcome", ["outcome"]
+)
+DELIVERY_LOG_PENDING = Gauge("autosend_delivery_log_pending", "Delivery log rows not yet written")
+
+# Seconds between retention runs
+_PRUNE_INTERVAL = 3600
+
+
+class DeliveryLog:
+    """Buffer delivery attempts and write them to the database in batches."""
+
+    def __init__(
+        self,
+        flush_interval: float = DELIVERY_LOG_FLUSH_INTERVAL,
+        batch_size: int = DELIVERY_LOG_BATCH_SIZE,
+        max_buffer: int = DELIVERY_LOG_MAX_BUFFER,
+        retention_days: int = DELIVERY_LOG_RETENTION_DAYS,
+        keep_per_schedule: int = DELIVERY_LOG_KEEP_PER_SCHEDULE,
+    ) -> None:
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._max_buffer = max_buffer
+        self._retention_days = retention_days
+        self._keep_per_schedule = keep_per_schedule
+        self._rows: List[DeliveryRow] = []
+        # Created on first use so it binds to the running loop (Python 3.9)
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        DELIVERY_LOG_PENDING.set_function(lambda: len(self._rows))
+
+    def record(
+        self,
+        schedule_id: Optional[int],
+        chat_id: int,
+        planned_at: Optional[float],
+        status: str,
+        latency: float,
+        message_id: Optional[int] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        """Buffer one send attempt; sends that are not scheduled are ignored."""
+        if schedule_id is None:
+            return
+        now = datetime.now(timezone.utc)
+        planned = now if planned_at is None else datetime.fromtimestamp(planned_at, timezone.utc)
+        self._rows.append(
+            (schedule_id, chat_id, planned, now, status, message_id, int(latency * 1000), error)
+        )
+        DELIVERY_LOG_ROWS.inc("buffered")
+        if len(self._rows) > self._max_buffer:
+            dropped = len(self._rows) - self._max_buffer
+            del self._rows[:dropped]
+            DELIVERY_LOG_ROWS.inc("dropped", amount=dropped)
+        if len(self._rows) >= self._batch_size and self._batch_task is None:
+            self._batch_task = asyncio.get_running_loop().create_task(self._flush_batch())
+
+    def pending(self) -> int:
+        """Number of rows not yet written."""
+        return len(self._rows)
+
+    async def flush(self) -> int:
+        """Write every buffered row, returning the number written."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._rows:
+                return 0
+            batch, self._rows = self._rows, []
+            try:
+                await run_async(insert_deliveries, batch)
+            except Exception:
+                # Keep the rows, oldest first, for the next flush
+                self._rows = batch + self._rows
+                raise
+            DELIVERY_LOG_ROWS.inc("written", amount=len(batch))
+            return len(batch)
+
+    async def _flush_batch(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Error writing delivery log: {e}")
+        finally:
+            self._batch_task = None
+
+    async def prune(self) -> int:
+        """Apply retention to the delivery log, returning the rows deleted."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self._retention_days)
+        deleted = await run_async(prune_deliveries, cutoff, self._keep_per_schedule)
+        if deleted:
+            logging.info(f"Pruned {deleted} delivery log row(s)")
+        return deleted
+
+    async def run(self) -> None:
+        """Flush buffered rows every flush interval and prune every hour."""
+        last_prune = 0.0
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_prune > _PRUNE_INTERVAL:
+                    await self.prune()
+                    last_prune = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error writing delivery log: {e}")
+
+    def start(self) -> None:
+        """Start the periodic flush on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the periodic flush and write what is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Error writing delivery log on shutdown: {e}")
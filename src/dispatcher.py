@@ -0,0 +1,505 @@
+"""
+Minute-bucketed dispatcher for scheduled messages.
+
+Schedules are indexed by minute of day, so the dispatcher wakes once per
+minute and sends everything due in that minute as one batch. Memory and
+wakeups scale with the number of distinct fire minutes, not with the total
+number of (schedule, time) pairs.
+
+A persistent dispatcher reads each minute's bucket from the database the
+first time it is needed instead of loading every schedule at startup, and
+records the last fire of every schedule. On start it sends the fires missed
+while the bot was down, up to MISFIRE_GRACE_SECONDS back, coalescing several
+missed fires of one schedule into a single send.
+
+Buckets are keyed by UTC minute of day. Schedule times are local to their
+chat's timezone and are compiled to UTC minutes when stored, so firing is a
+plain lookup. When a zone's UTC offset changes (DST), its compiled minutes
+are recomputed once in the database and the loaded buckets are reread.
+
+Buckets hold the schedules themselves (see schedules.Schedule), one object
+per schedule shared by all of its minutes. Schedules with a recurrence rule
+(weekdays, days of the month, a date range) are indexed under their minutes
+like daily ones. They carry the rule's compiled day masks, and those not
+due on the fire's planned day (before jitter) are skipped with a few bit
+tests.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import (
+    AbstractSet,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import startup
+from metrics import DISPATCHED, DISPATCH_LAG
+from sharding import ShardCoordinator, shard_of
+from db import get_due_schedules, mark_fired, next_timezone_change, recompile_timezones, run_async
+from timezones import DEFAULT_TIMEZONE, current_offset, utc_minute
+from payloads import Payload
+from schedules import Schedule
+
+MINUTES_PER_DAY = 24 * 60
+
+# Spread each chat's sends over this many minutes after the planned time (0 = off)
+DISPATCH_JITTER_MINUTES = int(os.environ.get("DISPATCH_JITTER_MINUTES", "0"))
+# How far back fires missed during downtime are still sent (0 = never)
+MISFIRE_GRACE_SECONDS = int(os.environ.get("MISFIRE_GRACE_SECONDS", "3600"))
+# Send a schedule once, not once per missed fire, when several were missed
+MISFIRE_COALESCE = os.environ.get("MISFIRE_COALESCE", "1") == "1"
+
+# Message text, or the rich content of schedules that have it
+Message = Union[str, Payload]
+# send(chat_id, message, schedule_id, planned_at epoch seconds)
+SendFunc = Callable[[int, Message, int, float], Awaitable[None]]
+# (schedule_id, target chat ids, message)
+Due = Tuple[int, Tuple[int, ...], Message]
+
+
+def chat_offset(chat_id: int, window: int) -> int:
+    """Return a stable per-chat delay in [0, window) minutes."""
+    if window <= 1:
+        return 0
+    # Knuth multiplicative hash, so neighbouring chat ids spread evenly
+    return ((chat_id * 2654435761) % 2**32) % window
+
+
+def minute_of_day(epoch_minute: int) -> int:
+    """Return the UTC minute of day for an absolute minute since the epoch."""
+    return epoch_minute % MINUTES_PER_DAY
+
+
+def planned_minute(schedule: Schedule, epoch_minute: int, jitter: int) -> int:
+    """Return the planned minute of a fire sent at ``epoch_minute`` after jitter.
+
+    A schedule's days apply to this minute: jitter may push a fire past
+    midnight, onto a day the schedule does not fire on.
+    """
+    return epoch_minute - chat_offset(schedule.chat_id, jitter)
+
+
+def utc_fire_minutes(schedule: Schedule) -> Tuple[Set[int], datetime]:
+    """Return a schedule's UTC fire minutes and when they stop being valid.
+
+    Raises ValueError for an invalid timezone.
+    """
+    offset, valid_until = current_offset(schedule.timezone or DEFAULT_TIMEZONE)
+    minutes = {utc_minute(minute, offset) for minute in schedule.minutes}
+    return minutes, valid_until
+
+
+def _due(bucket: Dict[int, Schedule], epoch_minute: Optional[int], jitter: int) -> List[Due]:
+    # Daily schedules have no filter; the rest cost a few bit tests each
+    return [
+        (sid, schedule.chat_ids, schedule.content)
+        for sid, schedule in bucket.items()
+        if schedule.days is None
+        or epoch_minute is None
+        or schedule.days.allows(planned_minute(schedule, epoch_minute, jitter))
+    ]
+
+
+class Dispatcher:
+    """Fire scheduled messages from a minute-of-day index."""
+
+    def __init__(
+        self,
+        send: SendFunc,
+        max_catchup: int = 5,
+        jitter_minutes: int = DISPATCH_JITTER_MINUTES,
+        coordinator: Optional[ShardCoordinator] = None,
+        persistent: bool = False,
+        misfire_grace: int = MISFIRE_GRACE_SECONDS,
+        coalesce: bool = MISFIRE_COALESCE,
+    ) -> None:
+        self._send = send
+        # Read buckets lazily from the database and record fires there
+        self._persistent = persistent
+        self._misfire_grace = misfire_grace
+        self._coalesce = coalesce
+        # When set, only chats in this replica's shards are fired, each
+        # (schedule, minute) at most once across replicas
+        self._coordinator = coordinator
+        self._jitter = jitter_minutes
+        # Missed minutes (e.g. after a stalled loop) replayed on the next wakeup
+        self._max_catchup = max_catchup
+        # minute of day -> {schedule_id: schedule}
+        self._buckets: Dict[int, Dict[int, Schedule]] = {}
+        # schedule_id -> minutes it is registered under
+        self._minutes: Dict[int, Tuple[int, ...]] = {}
+        # Minutes whose bucket is complete (loaded or read from the database)
+        self._loaded: Set[int] = set()
+        # Ids upserted or removed while each in-flight refresh() was reading
+        self._refresh_changes: List[Set[int]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._last_minute: Optional[int] = None
+        # Earliest moment a compiled UTC offset stops being valid, and when
+        # that was last read from the database
+        self._tz_valid_until: Optional[float] = None
+        self._tz_checked_at = 0.0
+
+    def load(self, schedules: Iterable[Schedule]) -> None:
+        """Replace the whole index with the given schedules."""
+        self._buckets.clear()
+        self._minutes.clear()
+        for schedule in schedules:
+            self.upsert(schedule)
+        self._loaded = set(range(MINUTES_PER_DAY))
+        logging.info(
+            f"Dispatcher loaded {len(self._minutes)} schedules "
+            f"across {len(self._buckets)} distinct minutes"
+        )
+
+    def upsert(self, schedule: Schedule) -> int:
+        """Add or replace one schedule, returning the number of buckets touched.
+
+        A broadcast is one entry for all of its chats.
+        """
+        schedule_id = schedule.id
+        touched = self.remove(schedule_id)
+        offset = chat_offset(schedule.chat_id, self._jitter)
+        try:
+            fire_minutes, valid_until = utc_fire_minutes(schedule)
+        except ValueError as e:
+            logging.error(f"Invalid timezone for schedule {schedule_id}: {e}")
+            return touched
+        minutes = {(minute + offset) % MINUTES_PER_DAY for minute in fire_minutes}
+        # Recompile before this schedule's zone changes its offset
+        expires = valid_until.timestamp()
+        if self._tz_valid_until is None or expires < self._tz_valid_until:
+            self._tz_valid_until = expires
+        for minute in minutes:
+            self._buckets.setdefault(minute, {})[schedule_id] = schedule
+        if minutes:
+            self._minutes[schedule_id] = tuple(sorted(minutes))
+        return touched + len(minutes)
+
+    def remove(self, schedule_id: int) -> int:
+        """Remove one schedule, returning the number of buckets touched."""
+        minutes = self._minutes.pop(schedule_id, ())
+        for changes in self._refresh_changes:
+            changes.add(schedule_id)
+        for minute in minutes:
+            bucket = self._buckets.get(minute)
+            if bucket is None:
+                continue
+            bucket.pop(schedule_id, None)
+            if not bucket:
+                del self._buckets[minute]
+        return len(minutes)
+
+    def due(self, minute: int, epoch_minute: Optional[int] = None) -> List[Due]:
+        """Return (schedule_id, chat_ids, message) for everything due at a minute of day.
+
+        With ``epoch_minute``, schedules that do not fire on that day are left out.
+        """
+        return _due(self._buckets.get(minute, {}), epoch_minute, self._jitter)
+
+    async def fire(
+        self,
+        minute: int,
+        epoch_minute: Optional[int] = None,
+        shards: Optional[AbstractSet[int]] = None,
+    ) -> int:
+        """Send everything due at a minute of day as one batch.
+
+        ``epoch_minute`` identifies the planned fire for exactly-once claims
+        (defaults to the current minute); ``shards`` limits a sharded fire to
+        a subset of the owned shards.
+        """
+        if epoch_minute is None:
+            epoch_minute = int(time.time() // 60)
+        if self._coordinator is not None:
+            # Other replicas may have added or deleted schedules, so the
+            # bucket is re-read from the database before a sharded fire
+            await self.refresh(minute)
+        elif self._persistent and minute not in self._loaded:
+            await self.refresh(minute)
+        due = self.due(minute, epoch_minute)
+        if due and self._coordinator is not None:
+            due = await self._claim(due, epoch_minute, shards)
+        if not due:
+            return 0
+        sent = await self._deliver(due, epoch_minute)
+        logging.info(f"Dispatched {sent} message(s) for minute {minute}")
+        return sent
+
+    async def _deliver(self, due: List[Due], epoch_minute: int) -> int:
+        # Broadcasts fan out here, through the same send path as single chats
+        planned_at = epoch_minute * 60
+        await asyncio.gather(
+            *(
+                self._send(chat_id, message, schedule_id, planned_at)
+                for schedule_id, chat_ids, message in due
+                for chat_id in chat_ids
+            )
+        )
+        sent = sum(len(chat_ids) for _, chat_ids, _ in due)
+        DISPATCHED.inc(amount=sent)
+        if self._persistent:
+            fired_at = datetime.fromtimestamp(epoch_minute * 60, timezone.utc)
+            try:
+                await run_async(mark_fired, [item[0] for item in due], fired_at)
+            except Exception as e:
+                logging.error(f"Error recording fires for minute {epoch_minute}: {e}")
+        return sent
+
+    def _candidates(self, minutes: Iterable[int]) -> List[int]:
+        # Stored fire minutes that land on the given minutes after jitter
+        window = max(self._jitter, 1)
+        return sorted({(minute - j) % MINUTES_PER_DAY for minute in minutes for j in range(window)})
+
+    def _jittered(self, schedule: Schedule) -> int:
+        offset = chat_offset(schedule.chat_id, self._jitter)
+        return (schedule.utc_minute + offset) % MINUTES_PER_DAY
+
+    async def refresh(self, minute: int) -> None:
+        """Rebuild one minute's bucket from the database.
+
+        Schedules upserted or removed while the rows are read keep their
+        in-memory state, which is newer than what was read.
+        """
+        changes: Set[int] = set()
+        self._refresh_changes.append(changes)
+        try:
+            schedules = await run_async(get_due_schedules, self._candidates([minute]))
+        finally:
+            self._refresh_changes = [c for c in self._refresh_changes if c is not changes]
+        bucket = {}
+        for schedule in schedules:
+            if self._jittered(schedule) == minute:
+                bucket[schedule.id] = schedule
+        current = self._buckets.get(minute, {})
+        for schedule_id in changes:
+            if schedule_id in current:
+                bucket[schedule_id] = current[schedule_id]
+            else:
+                bucket.pop(schedule_id, None)
+        # Keep the reverse index in step so remove() still finds these entries
+        for schedule_id in self._buckets.pop(minute, {}):
+            minutes = tuple(m for m in self._minutes.get(schedule_id, ()) if m != minute)
+            if minutes:
+                self._minutes[schedule_id] = minutes
+            else:
+                self._minutes.pop(schedule_id, None)
+        for schedule_id in bucket:
+            minutes = set(self._minutes.get(schedule_id, ()))
+            minutes.add(minute)
+            self._minutes[schedule_id] = tuple(sorted(minutes))
+        if bucket:
+            self._buckets[minute] = bucket
+        self._loaded.add(minute)
+
+    async def recover(self, now_minute: int) -> int:
+        """Send the fires missed within the misfire grace time, returning the count."""
+        span = min(self._misfire_grace // 60, MINUTES_PER_DAY - 1)
+        if span <= 0:
+            return 0
+        sent = await self._send_missed(now_minute - span, now_minute, None)
+        if sent:
+            logging.info(f"Sent {sent} message(s) missed in the last {span} minute(s)")
+        return sent
+
+    async def _send_missed(
+        self, first: int, last: int, shards: Optional[AbstractSet[int]]
+    ) -> int:
+        """Send the fires planned in [first, last] that have not happened yet.
+
+        Fires at or before a schedule's ``last_fired_at`` are skipped; with
+        coalescing only its latest missed fire is sent. They go out oldest
+        first, and ``shards`` limits a sharded replay as in ``fire``.
+        """
+        # minute of day -> absolute minutes in the window falling on it
+        window: Dict[int, List[int]] = {}
+        for epoch_minute in range(first, last + 1):
+            window.setdefault(minute_of_day(epoch_minute), []).append(epoch_minute)
+        schedules = await run_async(get_due_schedules, self._candidates(window))
+        # epoch minute -> {schedule_id: schedule}
+        missed: Dict[int, Dict[int, Schedule]] = {}
+        for schedule in schedules:
+            last_fired = int(schedule.last_fired_at.timestamp() // 60)
+            days = schedule.days
+            for epoch_minute in window.get(self._jittered(schedule), ()):
+                # Fires on days the rule skips were never missed
+                if epoch_minute > last_fired and (
+                    days is None or days.allows(planned_minute(schedule, epoch_minute, self._jitter))
+                ):
+                    missed.setdefault(epoch_minute, {})[schedule.id] = schedule
+        if self._coalesce:
+            # Only the latest missed fire of each schedule is sent
+            latest = {}
+            for epoch_minute in sorted(missed):
+                for schedule_id in missed[epoch_minute]:
+                    latest[schedule_id] = epoch_minute
+            for epoch_minute, bucket in missed.items():
+                for schedule_id in [sid for sid in bucket if latest[sid] != epoch_minute]:
+                    del bucket[schedule_id]
+        sent = 0
+        for epoch_minute in sorted(missed):
+            due = _due(missed[epoch_minute], None, self._jitter)
+            if due and self._coordinator is not None:
+                due = await self._claim(due, epoch_minute, shards)
+            if due:
+                sent += await self._deliver(due, epoch_minute)
+        return sent
+
+    async def _claim(
+        self,
+        due: List[Due],
+        epoch_minute: Optional[int],
+        shards: Optional[AbstractSet[int]],
+    ) -> List[Due]:
+        coordinator = self._coordinator
+        owned = coordinator.owned() if shards is None else shards & coordinator.owned()
+        # A broadcast belongs to the shard of its primary chat, so one
+        # replica sends all of it under a single claim
+        due = [
+            item
+            for item in due
+            if shard_of(item[1][0], coordinator.shard_count) in owned
+        ]
+        if not due:
+            return []
+        if epoch_minute is None:
+            epoch_minute = int(time.time() // 60)
+        claimed = set(await coordinator.claim([item[0] for item in due], epoch_minute))
+        return [item for item in due if item[0] in claimed]
+
+    async def _catch_up_gained_shards(self, now_minute: int) -> None:
+        # Replay recent minutes for shards taken over from a dead replica, or
+        # held again after our own leases lapsed, like recover: fires already
+        # made are skipped by last_fired_at and the exactly-once claim, and
+        # missed ones are coalesced
+        lapsed_at = self._coordinator.lapsed_at
+        gained = self._coordinator.pop_gained()
+        if not gained:
+            return
+        window = max(self._max_catchup, int(self._coordinator.lease_seconds // 60) + 2)
+        if lapsed_at is not None:
+            # Our own leases lapsed: replay back to the lapse, within the misfire grace
+            lapse = now_minute - int(lapsed_at // 60) + 1
+            window = max(window, min(lapse, self._misfire_grace // 60, MINUTES_PER_DAY - 1))
+        sent = await self._send_missed(now_minute - window, now_minute - 1, gained)
+        if sent:
+            logging.info(f"Sent {sent} message(s) missed in {len(gained)} shard(s) taken over")
+
+    def invalidate(self) -> None:
+        """Forget every bucket; a persistent dispatcher rereads them as they come due."""
+        self._buckets.clear()
+        self._minutes.clear()
+        self._loaded.clear()
+
+    async def check_timezones(self) -> bool:
+        """Recompile zones past a DST transition; returns True if buckets were dropped.
+
+        Only dispatchers backed by the database (persistent or sharded) do
+        this; in-memory indexes keep the offsets they were loaded with.
+        """
+        if not self._persistent and self._coordinator is None:
+            return False
+        now = time.time()
+        # Zones added by other replicas are picked up by rereading the
+        # earliest transition: every tick when sharded, else hourly
+        if self._coordinator is not None or now - self._tz_checked_at >= 3600:
+            valid_until = await run_async(next_timezone_change)
+            self._tz_valid_until = valid_until.timestamp() if valid_until else None
+            self._tz_checked_at = now
+        if self._tz_valid_until is None or now < self._tz_valid_until:
+            return False
+        zones = await run_async(recompile_timezones, datetime.now(timezone.utc))
+        if zones:
+            logging.info(f"Recompiled fire times for timezone(s) {', '.join(zones)}")
+        # Another replica may have recompiled first; reread either way
+        self.invalidate()
+        valid_until = await run_async(next_timezone_change)
+        self._tz_valid_until = valid_until.timestamp() if valid_until else None
+        self._tz_checked_at = now
+        return True
+
+    async def tick(self, epoch_minute: int) -> None:
+        """Fire one absolute minute, then catch up on newly gained shards."""
+        DISPATCH_LAG.observe(time.time() - epoch_minute * 60)
+        try:
+            await self.check_timezones()
+        except Exception as e:
+            logging.error(f"Error recompiling timezones: {e}")
+        if self._coordinator is not None:
+            # Before this minute's fire, so older fires never follow newer ones
+            try:
+                await self._catch_up_gained_shards(epoch_minute)
+            except Exception as e:
+                logging.error(f"Error catching up gained shards: {e}")
+        try:
+            await self.fire(minute_of_day(epoch_minute), epoch_minute)
+        except Exception as e:
+            logging.error(f"Error dispatching minute {epoch_minute}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        """Return index sizes."""
+        return {
+            "schedules": len(self._minutes),
+            "minutes": len(self._buckets),
+            "entries": sum(len(bucket) for bucket in self._buckets.values()),
+            "loaded_minutes": len(self._loaded),
+        }
+
+    async def run(self) -> None:
+        """Wake at the start of every minute and fire what is due."""
+        self._last_minute = int(time.time() // 60)
+        if self._coordinator is not None:
+            # The first leases are not a takeover: recover covers their missed
+            # fires under the misfire grace and coalescing settings
+            self._coordinator.pop_gained()
+        if self._persistent:
+            try:
+                with startup.phase("missed_fires"):
+                    await self.recover(self._last_minute)
+            except Exception as e:
+                logging.error(f"Error sending missed fires: {e}")
+        while True:
+            target = self._last_minute + 1
+            delay = target * 60 - time.time()
+            if delay > 0:
+                await self._prefetch(minute_of_day(target))
+                await asyncio.sleep(max(0.0, target * 60 - time.time()))
+                continue
+            now_minute = int(time.time() // 60)
+            first = max(target, now_minute - self._max_catchup + 1)
+            for epoch_minute in range(first, now_minute + 1):
+                await self.tick(epoch_minute)
+            self._last_minute = now_minute
+
+    async def _prefetch(self, minute: int) -> None:
+        # Read the next bucket ahead of its boundary so the fire is not delayed
+        if not self._persistent or self._coordinator is not None or minute in self._loaded:
+            return
+        try:
+            await self.refresh(minute)
+        except Exception as e:
+            logging.error(f"Error loading schedules for minute {minute}: {e}")
+
+    def start(self) -> None:
+        """Start the dispatch loop on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the dispatch loop."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,181 @@
+"""
+Write-behind buffer for the bot's chat membership changes.
+
+``my_chat_member`` updates only record that the bot joined or left a chat.
+Instead of one ``add_chat``/``remove_chat`` round trip per update, changes
+are buffered per chat_id, coalesced, and written in one transaction every
+MEMBERSHIP_FLUSH_INTERVAL seconds or once MEMBERSHIP_BATCH_SIZE chats are
+pending. Readers call ``settle`` first, which flushes pending changes they
+could observe, so a user always sees their own membership changes.
+"""
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from db import apply_chat_changes, run_async
+from metrics import Counter, Gauge
+
+# Seconds membership changes may wait before being written
+MEMBERSHIP_FLUSH_INTERVAL = float(os.environ.get("MEMBERSHIP_FLUSH_INTERVAL", "0.5"))
+# Pending chats that trigger an immediate flush
+MEMBERSHIP_BATCH_SIZE = int(os.environ.get("MEMBERSHIP_BATCH_SIZE", "500"))
+
+MEMBERSHIP_EVENTS = Counter(
+    "autosend_membership_events_total", "Membership changes by outcome", ["outcome"]
+)
+MEMBERSHIP_PENDING = Gauge("autosend_membership_pending", "Chats with unwritten membership changes")
+
+
+@dataclass
+class ChatChange:
+    """Net effect of the buffered changes for one chat."""
+
+    # The chat row is deleted first
+    removed: bool = False
+    # Then (re)written with this title and owner
+    added: bool = False
+    title: str = ""
+    owner_id: Optional[int] = None
+
+
+def merge(old: ChatChange, new: ChatChange) -> ChatChange:
+    """Return the change equivalent to applying ``old`` and then ``new``."""
+    if new.removed:
+        # A delete erases everything buffered before it
+        return new
+    if not new.added:
+        return old
+    # add_chat keeps an existing owner, including one buffered earlier
+    owner_id = old.owner_id if old.added and old.owner_id is not None else new.owner_id
+    return ChatChange(removed=old.removed, added=True, title=new.title, owner_id=owner_id)
+
+
+class MembershipWriter:
+    """Buffer, coalesce and batch-write chat membership changes."""
+
+    def __init__(
+        self,
+        flush_interval: float = MEMBERSHIP_FLUSH_INTERVAL,
+        batch_size: int = MEMBERSHIP_BATCH_SIZE,
+        on_written: Optional[Callable[[Set[int]], None]] = None,
+    ) -> None:
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        # Called with the owners whose chat lists a flush changed
+        self._on_written = on_written
+        self._pending: Dict[int, ChatChange] = {}
+        # Chats in the batch currently being written
+        self._inflight: Set[int] = set()
+        # Created on first use so it binds to the running loop (Python 3.9)
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        MEMBERSHIP_PENDING.set_function(lambda: len(self._pending))
+
+    def _buffer(self, chat_id: int, change: ChatChange) -> None:
+        old = self._pending.get(chat_id)
+        if old is None:
+            self._pending[chat_id] = change
+            MEMBERSHIP_EVENTS.inc("buffered")
+        else:
+            self._pending[chat_id] = merge(old, change)
+            MEMBERSHIP_EVENTS.inc("coalesced")
+        if len(self._pending) >= self._batch_size and self._batch_task is None:
+            self._batch_task = asyncio.get_running_loop().create_task(self._flush_batch())
+
+    def add(self, chat_id: int, title: str, owner_id: Optional[int]) -> None:
+        """Buffer "the bot joined this chat", like ``add_chat``."""
+        self._buffer(chat_id, ChatChange(added=True, title=title, owner_id=owner_id))
+
+    def remove(self, chat_id: int) -> None:
+        """Buffer "the bot left this chat", like ``remove_chat``."""
+        self._buffer(chat_id, ChatChange(removed=True))
+
+    def pending(self) -> int:
+        """Number of chats with unwritten changes."""
+        return len(self._pending)
+
+    async def settle(self, chat_id: Optional[int] = None) -> bool:
+        """Write pending changes before a read; returns True if anything was flushed.
+
+        With ``chat_id`` only changes to that chat force a flush; without it,
+        any pending change does.
+        """
+        if chat_id is None:
+            dirty = bool(self._pending or self._inflight)
+        else:
+            dirty = chat_id in self._pending or chat_id in self._inflight
+        if dirty:
+            await self.flush()
+        return dirty
+
+    async def flush(self) -> int:
+        """Write every pending change in one transaction, returning the chat count."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            self._inflight = set(batch)
+            removed = [chat_id for chat_id, change in batch.items() if change.removed]
+            upserts: List[Tuple[int, str, Optional[int]]] = [
+                (chat_id, change.title, change.owner_id)
+                for chat_id, change in batch.items()
+                if change.added
+            ]
+            try:
+                owners = await run_async(apply_chat_changes, removed, upserts)
+            except Exception:
+                # Put the batch back under anything buffered meanwhile
+                for chat_id, change in batch.items():
+                    newer = self._pending.get(chat_id)
+                    self._pending[chat_id] = change if newer is None else merge(change, newer)
+                raise
+            finally:
+                self._inflight = set()
+            if self._on_written is not None:
+                self._on_written(owners)
+            logging.info(
+                f"Wrote membership changes for {len(batch)} chat(s) "
+                f"({len(removed)} removed, {len(upserts)} added)"
+            )
+            return len(batch)
+
+    async def _flush_batch(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Error writing membership changes: {e}")
+        finally:
+            self._batch_task = None
+
+    async def run(self) -> None:
+        """Flush pending changes every flush interval."""
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error writing membership changes: {e}")
+
+    def start(self) -> None:
+        """Start the periodic flush on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the periodic flush and write what is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Error writing membership changes on shutdown: {e}")
@@ -0,0 +1,75 @@
+"""
+One-shot importer for schedules saved by older versions in user_data.json.
+
+Usage: python src/migrate_json.py [path/to/user_data.json] [--force]
+"""
+import sys
+import json
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+from db import init_db, close_pool, count_schedules, import_schedules
+
+# Legacy format: {user_id: {chat_id: [{"message": "text", "times": ["HH:MM", ...]}]}}
+USER_DATA_FILE = "user_data.json"
+
+
+def iter_legacy_schedules(data: Dict) -> Iterator[Tuple[int, int, str, List[str]]]:
+    """Yield (owner_id, chat_id, message, times) rows from the legacy JSON layout."""
+    for user_id, chats in data.items():
+        for chat_id, schedules in chats.items():
+            for schedule in schedules:
+                valid_times = []
+                for time_str in schedule.get("times", []):
+                    try:
+                        hour_str, minute_str = time_str.split(":")
+                        hour, minute = int(hour_str), int(minute_str)
+                    except ValueError:
+                        logging.error(
+                            f"Skipping invalid time '{time_str}' for chat {chat_id}"
+                        )
+                        continue
+                    if 0 <= hour < 24 and 0 <= minute < 60:
+                        valid_times.append(f"{hour:02d}:{minute:02d}")
+                if valid_times:
+                    yield (
+                        int(user_id),
+                        int(chat_id),
+                        schedule.get("message", ""),
+                        valid_times,
+                    )
+
+
+def main() -> None:
+    """Import the legacy JSON file into the schedules table."""
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    args = [arg for arg in sys.argv[1:] if arg != "--force"]
+    force = "--force" in sys.argv[1:]
+    path = args[0] if args else USER_DATA_FILE
+
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logging.error(f"Could not read {path}: {e}")
+        sys.exit(1)
+
+    try:
+        init_db()
+        existing = count_schedules()
+        if existing and not force:
+            logging.error(
+                f"schedules table already holds {existing} rows; "
+                f"rerun with --force to import anyway"
+            )
+            sys.exit(1)
+        imported = import_schedules(iter_legacy_schedules(data))
+        logging.info(f"Imported {imported} schedules from {path}")
+    finally:
+        close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Keyset-paged lists behind the bot's inline keyboards, with cached pages.
+
+Owners with many groups or schedules get their lists a page at a time:
+each page is read with ``WHERE key > last key of the previous page LIMIT n``
+instead of loading everything, so Telegram's message and keyboard limits
+are never hit. Pages, and the keyboards rendered from them, are cached per
+owner for KEYBOARD_CACHE_TTL seconds, so prev/next taps need no database
+round trip. Any change to an owner's chats or schedules invalidates that
+owner's pages; the TTL bounds staleness from changes made by other replicas.
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from db import run_async
+from metrics import Counter
+
+# Buttons (groups or schedules) per keyboard page
+KEYBOARD_PAGE_SIZE = int(os.environ.get("KEYBOARD_PAGE_SIZE", "8"))
+# Seconds a cached page stays valid
+KEYBOARD_CACHE_TTL = float(os.environ.get("KEYBOARD_CACHE_TTL", "300"))
+# Maximum number of cached pages
+KEYBOARD_CACHE_SIZE = int(os.environ.get("KEYBOARD_CACHE_SIZE", "2000"))
+
+KEYBOARD_PAGES = Counter(
+    "autosend_keyboard_pages_total", "Keyboard page requests by result", ["result"]
+)
+
+# (kind, owner_id, scope), e.g. ("schedules", owner_id, chat_id)
+ListKey = Tuple[str, int, Hashable]
+
+
+@dataclass
+class Page:
+    """One page of a keyset-paged list."""
+
+    number: int
+    items: List[Any]
+    has_next: bool
+    # Position of the first item in the whole list
+    first: int = 0
+    # Keyset cursor: key of the last item, where the next page starts
+    last: Any = None
+    # Rendered forms of this page (keyboard, text), by name
+    rendered: Dict[str, Any] = field(default_factory=dict)
+
+    def render(self, name: str, build: Callable[["Page"], Any]) -> Any:
+        """Return the cached rendering ``name``, building it on first use."""
+        if name not in self.rendered:
+            self.rendered[name] = build(self)
+        return self.rendered[name]
+
+
+class PageCache:
+    """TTL + LRU cache of list pages, invalidated per owner."""
+
+    def __init__(
+        self,
+        page_size: int = KEYBOARD_PAGE_SIZE,
+        ttl: float = KEYBOARD_CACHE_TTL,
+        max_size: int = KEYBOARD_CACHE_SIZE,
+    ) -> None:
+        self.page_size = page_size
+        self._ttl = ttl
+        self._max_size = max_size
+        # (list key, page number) -> (expires_at, page)
+        self._pages: "OrderedDict[Tuple[ListKey, int], Tuple[float, Page]]" = OrderedDict()
+        # owner_id -> cached (list key, page number)s, for invalidation
+        self._by_owner: Dict[int, Set[Tuple[ListKey, int]]] = {}
+        # Bumped by every invalidation; pages read across one are returned
+        # but not cached
+        self._generation = 0
+
+    def _get(self, key: Tuple[ListKey, int]) -> Optional[Page]:
+        entry = self._pages.get(key)
+        if entry is None:
+            return None
+        expires_at, page = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            return None
+        self._pages.move_to_end(key)
+        return page
+
+    def _store(self, key: Tuple[ListKey, int], page: Page) -> None:
+        self._pages[key] = (time.monotonic() + self._ttl, page)
+        self._pages.move_to_end(key)
+        self._by_owner.setdefault(key[0][1], set()).add(key)
+        while len(self._pages) > self._max_size:
+            self._drop(next(iter(self._pages)))
+
+    def _drop(self, key: Tuple[ListKey, int]) -> None:
+        self._pages.pop(key, None)
+        owned = self._by_owner.get(key[0][1])
+        if owned is not None:
+            owned.discard(key)
+            if not owned:
+                del self._by_owner[key[0][1]]
+
+    async def page(
+        self,
+        list_key: ListKey,
+        number: int,
+        fetch: Callable[[Any, int], List[Any]],
+        cursor: Callable[[Any], Any],
+    ) -> Page:
+        """Return page ``number`` of a list, reading the database on a miss.
+
+        ``fetch(after, limit)`` is a blocking keyset query returning up to
+        ``limit`` items after the cursor ``after`` (None for the first page);
+        ``cursor(item)`` returns an item's key. A page past the end of the
+        list comes back as the last page.
+        """
+        number = max(number, 0)
+        page = self._get((list_key, number))
+        if page is not None:
+            KEYBOARD_PAGES.inc("hit")
+            return page
+        KEYBOARD_PAGES.inc("miss")
+        # Resume the keyset walk from the nearest cached page before this one
+        start, after = 0, None
+        for earlier in range(number - 1, -1, -1):
+            previous = self._get((list_key, earlier))
+            if previous is not None:
+                if not previous.has_next:
+                    return previous
+                start, after = earlier + 1, previous.last
+                break
+        generation = self._generation
+        for current in range(start, number + 1):
+            # One extra row tells whether there is a next page
+            rows = await run_async(fetch, after, self.page_size + 1)
+            items = rows[: self.page_size]
+            if not items and current > 0:
+                # The list shrank; reread the previous page, now the last one
+                self._drop((list_key, current - 1))
+                return await self.page(list_key, current - 1, fetch, cursor)
+            page = Page(
+                number=current,
+                items=items,
+                has_next=len(rows) > self.page_size,
+                first=current * self.page_size,
+                last=cursor(items[-1]) if items else None,
+            )
+            if self._generation == generation:
+                self._store((list_key, current), page)
+            if not page.has_next:
+                break
+            after = page.last
+        return page
+
+    def invalidate_owner(self, owner_id: int, kind: Optional[str] = None) -> None:
+        """Forget an owner's cached pages, of one kind of list or all of them."""
+        self._generation += 1
+        for key in list(self._by_owner.get(owner_id, ())):
+            if kind is None or key[0][0] == kind:
+                self._drop(key)
+
+    def invalidate_owners(self, owner_ids: Set[int]) -> None:
+        """Forget every cached page of several owners."""
+        for owner_id in owner_ids:
+            self.invalidate_owner(owner_id)
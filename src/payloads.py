@@ -0,0 +1,220 @@
+"""
+Rich message payloads: formatted text, photos, videos, documents,
+animations, audio and albums.
+
+Media is never stored or re-uploaded. When a user sends media to the bot,
+Telegram already holds the file, and the message carries a ``file_id`` the
+bot can send again any number of times. Only that ``file_id`` is kept.
+Payloads are content addressed: the digest covers each file's
+``file_unique_id`` (stable across uploads of the same file) together with
+captions and formatting. Schedules with identical content therefore share
+one stored payload. In memory they share one interned ``Payload`` object,
+so a popular asset is held once and sent by reference.
+"""
+import json
+import hashlib
+import weakref
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from telegram import (
+    Bot,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Message,
+    MessageEntity,
+)
+
+# Media kinds, in the order they are looked for on a message; animations
+# also carry a document, so they come first
+MEDIA_KINDS = ("animation", "photo", "video", "audio", "document")
+# Media kinds Telegram accepts in an album
+_ALBUM_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "audio": InputMediaAudio,
+    "document": InputMediaDocument,
+}
+# Telegram's album size limit
+ALBUM_MAX_ITEMS = 10
+# Entities Telegram detects on its own in any text; only formatting is kept
+_DETECTED_ENTITIES = {"mention", "hashtag", "cashtag", "bot_command", "url", "email", "phone_number"}
+
+# payload id -> loaded payload, shared while any schedule still uses it
+_interned: "weakref.WeakValueDictionary[int, Payload]" = weakref.WeakValueDictionary()
+
+
+@dataclass(frozen=True)
+class MediaItem:
+    """One file of a payload, referenced by its Telegram file_id."""
+
+    kind: str
+    file_id: str
+    file_unique_id: str
+    caption: str = ""
+    # Caption formatting, as Bot API MessageEntity dicts
+    entities: Tuple[Dict[str, Any], ...] = ()
+
+
+@dataclass(frozen=True)
+class Payload:
+    """Content of a scheduled message that is more than plain text.
+
+    ``kind`` is "text" for formatted text, a media kind for a single file,
+    or "album" for a media group.
+    """
+
+    kind: str
+    text: str = ""
+    # Text formatting, as Bot API MessageEntity dicts
+    entities: Tuple[Dict[str, Any], ...] = ()
+    items: Tuple[MediaItem, ...] = ()
+
+    def body(self) -> Dict[str, Any]:
+        """Return the JSON form stored in the database."""
+        return {
+            "text": self.text,
+            "entities": list(self.entities),
+            "items": [
+                {
+                    "kind": item.kind,
+                    "file_id": item.file_id,
+                    "file_unique_id": item.file_unique_id,
+                    "caption": item.caption,
+                    "entities": list(item.entities),
+                }
+                for item in self.items
+            ],
+        }
+
+    def digest(self) -> str:
+        """Return the content address: same files, text and formatting, same digest."""
+        body = self.body()
+        # file_id differs between uploads of one file; file_unique_id does not
+        for item in body["items"]:
+            del item["file_id"]
+        canonical = json.dumps([self.kind, body], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def summary(self) -> str:
+        """Return a one-line description for listings, e.g. "[photo] caption"."""
+        if self.kind == "text":
+            return self.text
+        caption = next((item.caption for item in self.items if item.caption), "")
+        label = f"[album of {len(self.items)}]" if self.kind == "album" else f"[{self.kind}]"
+        return f"{label} {caption}" if caption else label
+
+    async def send(self, bot: Bot, chat_id: int) -> Message:
+        """Send the payload by file_id, returning the (first) sent message."""
+        if self.kind == "text":
+            return await bot.send_message(
+                chat_id=chat_id, text=self.text, entities=_entities(self.entities)
+            )
+        if self.kind == "album":
+            media = [
+                _ALBUM_MEDIA[item.kind](
+                    item.file_id,
+                    caption=item.caption or None,
+                    caption_entities=_entities(item.entities),
+                )
+                for item in self.items
+            ]
+            messages = await bot.send_media_group(chat_id=chat_id, media=media)
+            return messages[0]
+        item = self.items[0]
+        send = getattr(bot, f"send_{item.kind}")
+        return await send(
+            chat_id,
+            item.file_id,
+            caption=item.caption or None,
+            caption_entities=_entities(item.entities),
+        )
+
+
+def _entities(entities: Tuple[Dict[str, Any], ...]) -> Optional[List[MessageEntity]]:
+    if not entities:
+        return None
+    return [MessageEntity.de_json(dict(entity), None) for entity in entities]
+
+
+def _entity_dicts(entities: Tuple[MessageEntity, ...]) -> Tuple[Dict[str, Any], ...]:
+    return tuple(
+        entity.to_dict() for entity in entities if entity.type not in _DETECTED_ENTITIES
+    )
+
+
+def media_item(message: Message) -> Optional[MediaItem]:
+    """Return the media of a message as an item, or None if it has none."""
+    for kind in MEDIA_KINDS:
+        media = getattr(message, kind)
+        if not media:
+            continue
+        if kind == "photo":
+            # Sizes of one photo, smallest first; the largest keeps full quality
+            media = media[-1]
+        return MediaItem(
+            kind=kind,
+            file_id=media.file_id,
+            file_unique_id=media.file_unique_id,
+            caption=message.caption or "",
+            entities=_entity_dicts(message.caption_entities),
+        )
+    return None
+
+
+def from_message(message: Message) -> Optional[Payload]:
+    """Capture a message sent to the bot as a payload.
+
+    Returns None for plain text without formatting, which is stored as
+    text. Raises ValueError for content that cannot be scheduled.
+    """
+    item = media_item(message)
+    if item is not None:
+        return Payload(kind=item.kind, items=(item,))
+    if message.text is None:
+        raise ValueError("unsupported message content")
+    entities = _entity_dicts(message.entities)
+    if not entities:
+        return None
+    return Payload(kind="text", text=message.text, entities=entities)
+
+
+def album(items: List[MediaItem]) -> Payload:
+    """Build an album payload from the items of a media group, in order."""
+    if len(items) == 1:
+        return Payload(kind=items[0].kind, items=tuple(items))
+    if any(item.kind not in _ALBUM_MEDIA for item in items):
+        raise ValueError("albums can only hold photos, videos, audio and documents")
+    return Payload(kind="album", items=tuple(items))
+
+
+def load(payload_id: int, kind: str, body: Dict[str, Any]) -> Payload:
+    """Return the payload for a stored row, shared with other users of the same id."""
+    payload = _interned.get(payload_id)
+    if payload is None:
+        payload = Payload(
+            kind=kind,
+            text=body.get("text", ""),
+            entities=tuple(body.get("entities", ())),
+            items=tuple(
+                MediaItem(
+                    kind=item["kind"],
+                    file_id=item["file_id"],
+                    file_unique_id=item["file_unique_id"],
+                    caption=item.get("caption", ""),
+                    entities=tuple(item.get("entities", ())),
+                )
+                for item in body.get("items", ())
+            ),
+        )
+        _interned[payload_id] = payload
+    return payload
+
+
+async def send(bot: Bot, chat_id: int, message: Union[str, Payload]) -> Message:
+    """Send plain text or a payload to a chat."""
+    if isinstance(message, Payload):
+        return await message.send(bot, chat_id)
+    return await bot.send_message(chat_id=chat_id, text=message)
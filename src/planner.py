@@ -0,0 +1,102 @@
+"""
+Send-load planner: per-minute histogram of projected sends.
+
+Users mostly pick round times (09:00, 12:00, 18:00), so sends pile up on a
+few minutes. The planner projects how many messages fire in every UTC minute
+of the day (schedule times converted from their chats' timezones), reports
+the peaks, and shows how a per-chat jitter window (see
+DISPATCH_JITTER_MINUTES) would flatten them. Schedules limited to some days
+by a recurrence rule are counted as if they fired every day, so the peaks
+are those of the busiest possible day.
+
+Usage: python src/planner.py [--jitter MINUTES] [--top N]
+"""
+import sys
+import logging
+import argparse
+from typing import Iterable, List, Tuple
+
+from dispatcher import (
+    DISPATCH_JITTER_MINUTES,
+    MINUTES_PER_DAY,
+    chat_offset,
+    utc_fire_minutes,
+)
+from db import close_pool, get_all_schedules
+from recurrence import format_minute
+from schedules import Schedule
+
+
+def build_histogram(schedules: Iterable[Schedule], jitter_minutes: int = 0) -> List[int]:
+    """Count projected sends for every minute of the day."""
+    histogram = [0] * MINUTES_PER_DAY
+    for schedule in schedules:
+        offset = chat_offset(schedule.chat_id, jitter_minutes)
+        try:
+            fire_minutes, _ = utc_fire_minutes(schedule)
+        except ValueError:
+            continue
+        minutes = {(minute + offset) % MINUTES_PER_DAY for minute in fire_minutes}
+        # A broadcast sends once per target chat
+        sends = len(schedule.chat_ids)
+        for minute in minutes:
+            histogram[minute] += sends
+    return histogram
+
+
+def peak_minutes(histogram: List[int], top: int = 10) -> List[Tuple[int, int]]:
+    """Return the busiest (minute, sends) pairs, busiest first."""
+    busy = [(minute, count) for minute, count in enumerate(histogram) if count]
+    busy.sort(key=lambda item: (-item[1], item[0]))
+    return busy[:top]
+
+
+def format_report(schedules: List[Schedule], jitter_minutes: int, top: int = 10) -> str:
+    """Render a plain-text load report, comparing raw and jittered peaks."""
+    raw = build_histogram(schedules)
+    lines = [
+        f"Schedules: {len(schedules)}",
+        f"Sends per day: {sum(raw)}",
+        f"Active minutes: {sum(1 for count in raw if count)}",
+        "",
+        "Peak minutes (UTC):",
+    ]
+    for minute, count in peak_minutes(raw, top):
+        lines.append(f"  {format_minute(minute)}  {count}")
+
+    if jitter_minutes > 1:
+        spread = build_histogram(schedules, jitter_minutes)
+        lines += ["", f"Peak minutes with {jitter_minutes}-minute jitter:"]
+        for minute, count in peak_minutes(spread, top):
+            lines.append(f"  {format_minute(minute)}  {count}")
+        lines.append(f"Peak reduced from {max(raw)} to {max(spread)} sends/minute")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    """Print a load report for the schedules stored in the database."""
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--jitter",
+        type=int,
+        default=DISPATCH_JITTER_MINUTES,
+        help="per-chat jitter window in minutes to project (default: DISPATCH_JITTER_MINUTES)",
+    )
+    parser.add_argument("--top", type=int, default=10, help="number of peak minutes to list")
+    args = parser.parse_args()
+
+    try:
+        schedules = get_all_schedules()
+    except Exception as e:
+        logging.error(f"Error loading schedules: {e}")
+        sys.exit(1)
+    finally:
+        close_pool()
+    print(format_report(schedules, args.jitter, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""
+Recurrence rules for schedules: times of day, intervals, weekdays, days of
+the month and date ranges, compiled to bitmasks.
+
+A rule such as "mon-fri every 30m 09:00-12:00 until 2026-12-31" compiles
+to four parts:
+
+- a minute-of-day mask with 1440 bits
+- a weekday mask with 7 bits
+- a day-of-month mask with 31 bits
+- an optional date range
+
+The minutes become the schedule's fire times. They are indexed by UTC
+minute like those of any other schedule. The day parts travel with the
+dispatcher's bucket entries as an interned ``DayFilter``. Deciding whether
+a schedule fires on a given day then takes a few bit tests, not an
+evaluation of the rule.
+"""
+import os
+import re
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from timezones import current_offset
+
+# Most fire times a single rule may expand to (288 = every 5 minutes all day)
+SCHEDULE_MAX_TIMES = int(os.environ.get("SCHEDULE_MAX_TIMES", "288"))
+
+_MINUTES_PER_DAY = 24 * 60
+ALL_WEEKDAYS = (1 << 7) - 1
+ALL_MONTHDAYS = (1 << 31) - 1
+# date.toordinal() of 1970-01-01, which was a Thursday (weekday 3)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_EPOCH_WEEKDAY = 3
+
+_WEEKDAY_NAMES = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+# Accepted spellings of each weekday: "mon", "monday" and "mondays"
+_WEEKDAY_INDEX = {
+    spelling: i
+    for i, full in enumerate(
+        ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+    )
+    for spelling in (_WEEKDAY_NAMES[i], full, full + "s")
+}
+_WEEKDAY_ALIASES = {
+    "daily": ALL_WEEKDAYS,
+    "weekdays": 0b0011111,
+    "weekends": 0b1100000,
+}
+_TIME = re.compile(r"^(\d{1,2}):(\d{1,2})$")
+_WINDOW = re.compile(r"^(\d{1,2}:\d{2})-(\d{1,2}:\d{2})$")
+_INTERVAL = re.compile(r"^(\d+)\s*(m|min|mins|minutes?|h|hours?)$")
+
+
+def parse_time(time_str: str) -> int:
+    """Convert "HH:MM" to minutes since midnight, raising ValueError if invalid."""
+    match = _TIME.match(time_str.strip())
+    if not match:
+        raise ValueError(f"not a time: {time_str}")
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"time out of range: {time_str}")
+    return hour * 60 + minute
+
+
+def format_minute(minute: int) -> str:
+    """Convert minutes since midnight to "HH:MM"."""
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def _bits(mask: int) -> List[int]:
+    return [i for i in range(mask.bit_length()) if (mask >> i) & 1]
+
+
+def _ranges(bits: List[int]) -> List[Tuple[int, int]]:
+    # Consecutive runs of sorted bit positions, as (first, last)
+    runs: List[Tuple[int, int]] = []
+    for bit in bits:
+        if runs and runs[-1][1] == bit - 1:
+            runs[-1] = (runs[-1][0], bit)
+        else:
+            runs.append((bit, bit))
+    return runs
+
+
+@dataclass(frozen=True)
+class Recurrence:
+    """A compiled recurrence rule."""
+
+    # Bit m set: fires at local minute of day m
+    minutes: int
+    # Bit d set: fires on weekday d (Monday = 0)
+    weekdays: int = ALL_WEEKDAYS
+    # Bit d - 1 set: fires on day d of the month
+    monthdays: int = ALL_MONTHDAYS
+    starts_on: Optional[date] = None
+    ends_on: Optional[date] = None
+    # The rule in canonical form, for listings
+    text: str = ""
+    # Whether the rule is nothing but a list of daily times
+    plain: bool = True
+
+    def times(self) -> List[str]:
+        """Return the fire times as sorted "HH:MM" strings."""
+        return [format_minute(minute) for minute in _bits(self.minutes)]
+
+    def fires_on(self, day: date) -> bool:
+        """Whether the rule fires on a local date."""
+        return _allows(
+            self.weekdays,
+            self.monthdays,
+            _day_number(self.starts_on),
+            _day_number(self.ends_on),
+            day.toordinal() - _EPOCH_ORDINAL,
+        )
+
+
+def _day_number(day: Optional[date]) -> Optional[int]:
+    return None if day is None else day.toordinal() - _EPOCH_ORDINAL
+
+
+@lru_cache(maxsize=4096)
+def _day_of_month(day: int) -> int:
+    return date.fromordinal(day + _EPOCH_ORDINAL).day
+
+
+def _allows(
+    weekdays: int, monthdays: int, first: Optional[int], last: Optional[int], day: int
+) -> bool:
+    # day: local days since the epoch
+    if first is not None and day < first:
+        return False
+    if last is not None and day > last:
+        return False
+    if weekdays != ALL_WEEKDAYS and not (weekdays >> ((day + _EPOCH_WEEKDAY) % 7)) & 1:
+        return False
+    if monthdays != ALL_MONTHDAYS and not (monthdays >> (_day_of_month(day) - 1)) & 1:
+        return False
+    return True
+
+
+@dataclass(frozen=True)
+class DayFilter:
+    """The days a schedule fires on, tested against the local date of a fire."""
+
+    timezone: str
+    weekdays: int
+    monthdays: int
+    # Local days since the epoch, inclusive
+    first_day: Optional[int]
+    last_day: Optional[int]
+
+    def allows(self, epoch_minute: int) -> bool:
+        """Whether the schedule fires on the local date of a UTC minute since the epoch."""
+        offset, _ = current_offset(self.timezone)
+        day = (epoch_minute + offset) // _MINUTES_PER_DAY
+        return _allows(self.weekdays, self.monthdays, self.first_day, self.last_day, day)
+
+
+@lru_cache(maxsize=4096)
+def day_filter(
+    tz: str,
+    weekdays: Optional[int],
+    monthdays: Optional[int],
+    starts_on: Optional[date],
+    ends_on: Optional[date],
+) -> Optional[DayFilter]:
+    """Return the shared filter for a schedule's stored day masks, or None if it fires daily."""
+    weekdays = ALL_WEEKDAYS if weekdays is None else weekdays
+    monthdays = ALL_MONTHDAYS if monthdays is None else monthdays
+    if (
+        weekdays == ALL_WEEKDAYS
+        and monthdays == ALL_MONTHDAYS
+        and starts_on is None
+        and ends_on is None
+    ):
+        return None
+    return DayFilter(tz, weekdays, monthdays, _day_number(starts_on), _day_number(ends_on))
+
+
+def _weekday(name: str) -> int:
+    if name not in _WEEKDAY_INDEX:
+        raise ValueError(f"not a weekday: {name}")
+    return _WEEKDAY_INDEX[name]
+
+
+def _parse_weekdays(token: str) -> Optional[int]:
+    # "mon-fri", "sat,sun", "weekdays"; None if the token is not about weekdays
+    if token in _WEEKDAY_ALIASES:
+        return _WEEKDAY_ALIASES[token]
+    mask = 0
+    for part in token.split(","):
+        first, _, last = part.partition("-")
+        if first not in _WEEKDAY_INDEX:
+            return None
+        start = _weekday(first)
+        end = _weekday(last) if last else start
+        # Ranges may wrap around the week, e.g. fri-mon
+        for i in range((end - start) % 7 + 1):
+            mask |= 1 << ((start + i) % 7)
+    return mask
+
+
+def _parse_monthdays(token: str) -> int:
+    mask = 0
+    for part in token.split(","):
+        first, _, last = part.partition("-")
+        try:
+            start, end = int(first), int(last or first)
+        except ValueError:
+            raise ValueError(f"not a day of the month: {part}") from None
+        if not 1 <= start <= end <= 31:
+            raise ValueError(f"days of the month run from 1 to 31: {part}")
+        for day in range(start, end + 1):
+            mask |= 1 << (day - 1)
+    return mask
+
+
+def _parse_date(token: str) -> date:
+    try:
+        return date.fromisoformat(token)
+    except ValueError:
+        raise ValueError(f"not a date (YYYY-MM-DD): {token}") from None
+
+
+def _weekdays_text(mask: int) -> str:
+    for name, alias in _WEEKDAY_ALIASES.items():
+        if mask == alias:
+            return name
+    parts = []
+    for first, last in _ranges(_bits(mask)):
+        if first == last:
+            parts.append(_WEEKDAY_NAMES[first])
+        elif last == first + 1:
+            parts.append(f"{_WEEKDAY_NAMES[first]},{_WEEKDAY_NAMES[last]}")
+        else:
+            parts.append(f"{_WEEKDAY_NAMES[first]}-{_WEEKDAY_NAMES[last]}")
+    return ",".join(parts)
+
+
+def _monthdays_text(mask: int) -> str:
+    parts = []
+    for first, last in _ranges(_bits(mask)):
+        parts.append(str(first + 1) if first == last else f"{first + 1}-{last + 1}")
+    return ",".join(parts)
+
+
+def parse(text: str) -> Recurrence:
+    """Compile a recurrence rule, raising ValueError with a reason if it is invalid.
+
+    A rule is made of clauses in any order:
+
+    - ``09:00, 17:30``: times of day
+    - ``every 15m 09:00-17:00``: every N minutes (``m``) or hours (``h``)
+      within a window, which defaults to the whole day
+    - ``mon-fri``, ``sat,sun``, ``weekdays``, ``weekends``: days of the week
+    - ``on 1,15`` or ``on 1-5``: days of the month
+    - ``from 2026-11-01`` and ``until 2026-12-31``: first and last day
+
+    A plain list of times, the only rule format before recurrences,
+    compiles to a daily rule as before.
+    """
+    # Glue comma lists into single tokens: "09:00, 15:30" -> "09:00,15:30"
+    normalized = re.sub(r"\s*,\s*", ",", text.strip().lower()).strip(",")
+    normalized = re.sub(r"\s*-\s*", "-", normalized)
+    tokens = normalized.split()
+    if not tokens:
+        raise ValueError("no times given")
+    minutes = 0
+    weekdays: Optional[int] = None
+    monthdays: Optional[int] = None
+    starts_on: Optional[date] = None
+    ends_on: Optional[date] = None
+    # Canonical clauses: explicit times, then intervals
+    fixed: List[int] = []
+    intervals: List[str] = []
+    i = 0
+
+    def argument(keyword: str) -> str:
+        if i + 1 >= len(tokens):
+            raise ValueError(f"'{keyword}' needs a value")
+        return tokens[i + 1]
+
+    while i < len(tokens):
+        token = tokens[i]
+        if _TIME.match(token.split(",")[0]):
+            for part in token.split(","):
+                minute = parse_time(part)
+                fixed.append(minute)
+                minutes |= 1 << minute
+            i += 1
+        elif token == "every":
+            value = argument(token)
+            i += 2
+            match = _INTERVAL.match(value)
+            if not match and i < len(tokens):
+                # "every 30 min": the unit is a token of its own
+                match = _INTERVAL.match(value + tokens[i])
+                i += 1
+            if not match:
+                raise ValueError(f"not an interval: {value} (e.g. 15m or 2h)")
+            step = int(match.group(1)) * (60 if match.group(2).startswith("h") else 1)
+            if not 1 <= step < _MINUTES_PER_DAY:
+                raise ValueError(f"interval out of range: {value}")
+            start, end = 0, _MINUTES_PER_DAY - 1
+            window = _WINDOW.match(tokens[i]) if i < len(tokens) else None
+            if window:
+                start, end = parse_time(window.group(1)), parse_time(window.group(2))
+                if end < start:
+                    raise ValueError(f"window ends before it starts: {tokens[i]}")
+                i += 1
+            for minute in range(start, end + 1, step):
+                minutes |= 1 << minute
+            unit = f"{step // 60}h" if step % 60 == 0 else f"{step}m"
+            span = "" if (start, end) == (0, _MINUTES_PER_DAY - 1) else (
+                f" {format_minute(start)}-{format_minute(end)}"
+            )
+            intervals.append(f"every {unit}{span}")
+        elif token in ("on", "day", "days"):
+            monthdays = (monthdays or 0) | _parse_monthdays(argument(token))
+            i += 2
+        elif token == "from":
+            starts_on = _parse_date(argument(token))
+            i += 2
+        elif token in ("until", "to"):
+            ends_on = _parse_date(argument(token))
+            i += 2
+        else:
+            mask = _parse_weekdays(token)
+            if mask is None:
+                raise ValueError(f"don't understand '{token}'")
+            weekdays = (weekdays or 0) | mask
+            i += 1
+
+    if not minutes:
+        raise ValueError("no times given")
+    count = bin(minutes).count("1")
+    if count > SCHEDULE_MAX_TIMES:
+        raise ValueError(f"{count} times a day, at most {SCHEDULE_MAX_TIMES} are allowed")
+    if starts_on and ends_on and ends_on < starts_on:
+        raise ValueError("the rule ends before it starts")
+
+    weekdays = ALL_WEEKDAYS if weekdays is None else weekdays
+    monthdays = ALL_MONTHDAYS if monthdays is None else monthdays
+    clauses = []
+    if weekdays != ALL_WEEKDAYS:
+        clauses.append(_weekdays_text(weekdays))
+    if fixed:
+        clauses.append(", ".join(format_minute(m) for m in sorted(set(fixed))))
+    clauses += intervals
+    if monthdays != ALL_MONTHDAYS:
+        clauses.append(f"on {_monthdays_text(monthdays)}")
+    if starts_on:
+        clauses.append(f"from {starts_on.isoformat()}")
+    if ends_on:
+        clauses.append(f"until {ends_on.isoformat()}")
+    plain = (
+        not intervals
+        and weekdays == ALL_WEEKDAYS
+        and monthdays == ALL_MONTHDAYS
+        and starts_on is None
+        and ends_on is None
+    )
+    return Recurrence(
+        minutes=minutes,
+        weekdays=weekdays,
+        monthdays=monthdays,
+        starts_on=starts_on,
+        ends_on=ends_on,
+        text=" ".join(clauses),
+        plain=plain,
+    )
@@ -0,0 +1,115 @@
+"""
+Compact in-memory model of a stored schedule.
+
+Schedules used to be passed around as dicts with string keys and "HH:MM"
+string times, and before the database as nested dicts of lists of dicts.
+Each schedule then cost a dict, a list of time strings and its own copy of
+the message text. ``Schedule`` is a slotted class instead:
+
+- times are minutes since midnight, in a tuple shared by every schedule
+  with the same times
+- message texts and timezone names are interned, so a text sent by
+  thousands of schedules is held once
+
+The dispatcher's buckets hold these objects directly.
+bench/memory_model.py compares the memory use and load time of the old
+and new representations.
+"""
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from payloads import Payload
+from recurrence import DayFilter, format_minute, parse_time
+
+# "HH:MM" times as stored -> the shared tuple of minutes since midnight
+_minutes: Dict[Tuple[str, ...], Tuple[int, ...]] = {}
+# Sorted minutes -> the shared tuple, so different spellings share one too
+_shared: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+
+
+def minutes_of(times: Iterable[str]) -> Tuple[int, ...]:
+    """Return the shared, sorted minutes since midnight of "HH:MM" times.
+
+    Raises ValueError for an invalid time.
+    """
+    key = tuple(times)
+    minutes = _minutes.get(key)
+    if minutes is None:
+        minutes = tuple(sorted({parse_time(time_str) for time_str in key}))
+        minutes = _shared.setdefault(minutes, minutes)
+        _minutes[key] = minutes
+    return minutes
+
+
+class Schedule:
+    """One stored schedule."""
+
+    __slots__ = (
+        "id",
+        "owner_id",
+        "chat_id",
+        "chat_ids",
+        "message",
+        "minutes",
+        "timezone",
+        "payload_id",
+        "payload",
+        "rule",
+        "days",
+        "utc_minute",
+        "last_fired_at",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        owner_id: int,
+        chat_id: int,
+        message: str,
+        minutes: Tuple[int, ...],
+        timezone: str,
+        chat_ids: Optional[Tuple[int, ...]] = None,
+        payload_id: Optional[int] = None,
+        payload: Optional[Payload] = None,
+        rule: Optional[str] = None,
+        days: Optional[DayFilter] = None,
+        utc_minute: Optional[int] = None,
+        last_fired_at: Optional[datetime] = None,
+    ) -> None:
+        self.id = id
+        self.owner_id = owner_id
+        self.chat_id = chat_id
+        # Every target chat, primary chat first
+        self.chat_ids: Tuple[int, ...] = chat_ids or (chat_id,)
+        self.message = sys.intern(message)
+        # Local minutes since midnight, sorted
+        self.minutes = minutes
+        self.timezone = sys.intern(timezone)
+        self.payload_id = payload_id
+        # Rich content, shared with every schedule sending the same
+        self.payload = payload
+        # Canonical recurrence rule and the days it fires on; None for daily times
+        self.rule = rule
+        self.days = days
+        # Set on schedules read for dispatch: the UTC minute of day they
+        # matched and the start of the minute they last fired in
+        self.utc_minute = utc_minute
+        self.last_fired_at = last_fired_at
+
+    @property
+    def times(self) -> List[str]:
+        """Return the fire times as "HH:MM" strings."""
+        return [format_minute(minute) for minute in self.minutes]
+
+    @property
+    def content(self) -> Union[str, Payload]:
+        """Return what is sent: the payload, or else the message text."""
+        return self.payload or self.message
+
+    def when(self) -> str:
+        """Describe when the schedule fires: its recurrence rule, or its daily times."""
+        return self.rule or ", ".join(self.times)
+
+    def __repr__(self) -> str:
+        return f"Schedule(id={self.id}, chat_id={self.chat_id}, when={self.when()!r})"
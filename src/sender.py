@@ -0,0 +1,359 @@
+"""
+Rate-limited outbound delivery queue for Telegram messages.
+
+Sends go through a global token bucket (the Bot API allows roughly 30
+messages per second) and a per-chat bucket (about 20 messages per minute in
+groups, one per second in private chats). A fixed pool of workers bounds
+concurrency. Flood-control errors (429 RetryAfter) and network failures are
+retried with backoff; anything that still fails ends up in a dead-letter list
+instead of being dropped silently. Every attempt can be reported to a
+delivery log through the ``on_attempt`` hook.
+
+Each chat has its own FIFO and at most one of its messages is sent at a
+time, so a chat's messages arrive in the order they were queued even when
+one of them waits for the chat's limit or a retry. The shared queue holds
+chats that have a message ready, not the messages themselves.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+from metrics import SEND_LATENCY, SEND_QUEUE_DEPTH, SENDS
+
+# Global send rate (messages per second) and burst size
+SEND_RATE = float(os.environ.get("SEND_RATE", "30"))
+SEND_BURST = float(os.environ.get("SEND_BURST", "30"))
+# Per-chat limits
+SEND_GROUP_PER_MINUTE = float(os.environ.get("SEND_GROUP_PER_MINUTE", "20"))
+SEND_PRIVATE_PER_SECOND = float(os.environ.get("SEND_PRIVATE_PER_SECOND", "1"))
+# Number of concurrent send workers
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", "8"))
+# Attempts per message before it is dead-lettered
+SEND_MAX_ATTEMPTS = int(os.environ.get("SEND_MAX_ATTEMPTS", "5"))
+# Dead letters kept in memory
+DEAD_LETTER_LIMIT = int(os.environ.get("DEAD_LETTER_LIMIT", "1000"))
+# Seconds stop() waits for queued messages before dead-lettering the rest
+SEND_STOP_GRACE_SECONDS = float(os.environ.get("SEND_STOP_GRACE_SECONDS", "5"))
+
+# Per-chat buckets idle for this long are dropped
+_BUCKET_IDLE_SECONDS = 600
+
+# send(chat_id, message) -> sent message; message is text, or rich content
+# the send function knows how to deliver (see payloads.py)
+SendFunc = Callable[[int, Any], Awaitable[Any]]
+# on_attempt(schedule_id, chat_id, planned_at, status, latency, message_id, error)
+AttemptHook = Callable[
+    [Optional[int], int, Optional[float], str, float, Optional[int], Optional[str]], None
+]
+
+
+class TokenBucket:
+    """Token bucket that reports how long a caller has to wait for a token."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: Optional[float] = None) -> float:
+        """Take a token if one is available, otherwise return the seconds to wait."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float, now: Optional[float] = None) -> None:
+        """Drain the bucket so the next token is not available for the given time."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+@dataclass
+class Delivery:
+    """One queued message."""
+
+    chat_id: int
+    message: Any
+    future: asyncio.Future
+    attempts: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Set for scheduled messages, for the delivery log
+    schedule_id: Optional[int] = None
+    planned_at: Optional[float] = None
+
+
+@dataclass
+class DeadLetter:
+    """A message that could not be delivered."""
+
+    chat_id: int
+    message: Any
+    attempts: int
+    error: str
+    failed_at: float = field(default_factory=time.time)
+
+
+def chat_bucket(chat_id: int) -> TokenBucket:
+    """Return a fresh bucket with the limit Telegram applies to this kind of chat."""
+    if chat_id < 0:
+        return TokenBucket(SEND_GROUP_PER_MINUTE / 60, SEND_GROUP_PER_MINUTE)
+    return TokenBucket(SEND_PRIVATE_PER_SECOND, SEND_PRIVATE_PER_SECOND)
+
+
+def _mark_retrieved(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.exception()
+
+
+class SendQueue:
+    """Outbound queue honouring global and per-chat limits."""
+
+    def __init__(
+        self,
+        send: SendFunc,
+        rate: float = SEND_RATE,
+        burst: float = SEND_BURST,
+        concurrency: int = SEND_CONCURRENCY,
+        max_attempts: int = SEND_MAX_ATTEMPTS,
+        on_attempt: Optional[AttemptHook] = None,
+    ) -> None:
+        self._send = send
+        # Told about every attempt: "sent", "retry" or "failed"
+        self._on_attempt = on_attempt
+        self._global = TokenBucket(rate, burst)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._concurrency = concurrency
+        self._max_attempts = max_attempts
+        # Chats with a message ready to send, each listed at most once
+        self._queue: "asyncio.Queue[int]" = asyncio.Queue()
+        # chat_id -> its messages in order, while any is queued or in flight
+        self._chat_queues: Dict[int, Deque[Delivery]] = {}
+        self._workers: List[asyncio.Task] = []
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.dead_letters: Deque[DeadLetter] = deque(maxlen=DEAD_LETTER_LIMIT)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        SEND_QUEUE_DEPTH.set_function(lambda: self.depth)
+
+    @property
+    def depth(self) -> int:
+        """Messages queued or waiting for a retry."""
+        return self._pending
+
+    def submit(
+        self,
+        chat_id: int,
+        message: Any,
+        schedule_id: Optional[int] = None,
+        planned_at: Optional[float] = None,
+    ) -> asyncio.Future:
+        """Queue a message; the returned future resolves with the sent message.
+
+        ``schedule_id`` and ``planned_at`` (epoch seconds) tag scheduled
+        messages in the delivery log.
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Failures are recorded as dead letters, so fire-and-forget callers
+        # should not trigger "exception was never retrieved" warnings
+        future.add_done_callback(_mark_retrieved)
+        self._pending += 1
+        self._idle.clear()
+        pending = self._chat_queues.get(chat_id)
+        if pending is None:
+            # Otherwise the chat is already queued, waiting or sending
+            pending = self._chat_queues[chat_id] = deque()
+            self._queue.put_nowait(chat_id)
+        pending.append(
+            Delivery(chat_id, message, future, schedule_id=schedule_id, planned_at=planned_at)
+        )
+        return future
+
+    async def send(self, chat_id: int, message: Any) -> Any:
+        """Queue a message and wait until it is delivered."""
+        return await self.submit(chat_id, message)
+
+    async def drain(self) -> None:
+        """Wait until every queued message is delivered or dead-lettered."""
+        await self._idle.wait()
+
+    def start(self) -> None:
+        """Start the worker tasks on the running event loop."""
+        if not self._workers:
+            self._workers = [
+                asyncio.get_running_loop().create_task(self._worker())
+                for _ in range(self._concurrency)
+            ]
+
+    async def stop(self, grace: float = SEND_STOP_GRACE_SECONDS) -> None:
+        """Send what is queued for up to ``grace`` seconds, then stop the workers.
+
+        Messages still undelivered are dead-lettered, so they are logged and
+        reported to the delivery log rather than dropped silently.
+        """
+        if self._workers and self._pending:
+            try:
+                await asyncio.wait_for(self.drain(), grace)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        dropped = [delivery for pending in self._chat_queues.values() for delivery in pending]
+        self._chat_queues.clear()
+        self._queue = asyncio.Queue()
+        if dropped:
+            logging.error(f"Send queue stopped with {len(dropped)} undelivered message(s)")
+        error = RuntimeError("send queue stopped")
+        for delivery in dropped:
+            self._dead_letter(delivery, error, time.monotonic())
+
+    def _wake(self, chat_id: int, delay: float) -> None:
+        # Put a waiting chat back in line once its delay is over
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, chat_id)
+
+    def _finish(self, delivery: Delivery) -> None:
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {
+                    cid: b
+                    for cid, b in self._chats.items()
+                    if now - b.updated < _BUCKET_IDLE_SECONDS
+                }
+            bucket = self._chats[chat_id] = chat_bucket(chat_id)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._queue.get()
+            pending = self._chat_queues[chat_id]
+            # A chat over its limit is put aside so it cannot block other
+            # chats; its messages wait behind it in order
+            now = time.monotonic()
+            wait = self._chat_bucket(chat_id, now).reserve(now)
+            if wait > 0:
+                self._wake(chat_id, wait)
+                continue
+            delivery = pending.popleft()
+            try:
+                wait = self._global.reserve()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self._global.reserve()
+                retry_in = await self._deliver(delivery)
+            except asyncio.CancelledError:
+                # Stopped mid-send; stop() dead-letters it with the rest
+                pending.appendleft(delivery)
+                raise
+            if retry_in is not None:
+                # Retried before anything queued after it
+                pending.appendleft(delivery)
+                self._wake(chat_id, retry_in)
+            elif pending:
+                self._queue.put_nowait(chat_id)
+            else:
+                del self._chat_queues[chat_id]
+
+    def _report(
+        self,
+        delivery: Delivery,
+        status: str,
+        started: float,
+        message_id: Optional[int] = None,
+        error: Optional[Exception] = None,
+    ) -> None:
+        if self._on_attempt is None:
+            return
+        try:
+            self._on_attempt(
+                delivery.schedule_id,
+                delivery.chat_id,
+                delivery.planned_at,
+                status,
+                time.monotonic() - started,
+                message_id,
+                None if error is None else str(error),
+            )
+        except Exception as e:
+            logging.error(f"Error recording delivery to {delivery.chat_id}: {e}")
+
+    async def _deliver(self, delivery: Delivery) -> Optional[float]:
+        """Send one message; returns the delay before a retry, if one is due."""
+        delivery.attempts += 1
+        started = time.monotonic()
+        try:
+            result = await self._send(delivery.chat_id, delivery.message)
+        except RetryAfter as e:
+            # Flood control: hold back this chat and the global bucket
+            self._chat_bucket(delivery.chat_id, time.monotonic()).pause(e.retry_after)
+            self._global.pause(min(e.retry_after, 1.0))
+            return self._retry(delivery, e.retry_after, e, started)
+        except (TimedOut, NetworkError) as e:
+            backoff = min(60.0, 2 ** delivery.attempts) * (0.5 + random.random() / 2)
+            return self._retry(delivery, backoff, e, started)
+        except Exception as e:
+            self._dead_letter(delivery, e, started)
+        else:
+            self._report(delivery, "sent", started, getattr(result, "message_id", None))
+            self.sent += 1
+            SENDS.inc("sent")
+            SEND_LATENCY.observe(time.monotonic() - delivery.enqueued_at)
+            logging.info(f"Message sent successfully to {delivery.chat_id}")
+            self._finish(delivery)
+            if not delivery.future.done():
+                delivery.future.set_result(result)
+        return None
+
+    def _retry(
+        self, delivery: Delivery, delay: float, error: Exception, started: float
+    ) -> Optional[float]:
+        if delivery.attempts >= self._max_attempts:
+            self._dead_letter(delivery, error, started)
+            return None
+        self._report(delivery, "retry", started, error=error)
+        self.retried += 1
+        SENDS.inc("retried")
+        logging.warning(
+            f"Retrying message to {delivery.chat_id} in {delay:.1f}s "
+            f"(attempt {delivery.attempts}): {error}"
+        )
+        return delay
+
+    def _dead_letter(self, delivery: Delivery, error: Exception, started: float) -> None:
+        self._report(delivery, "failed", started, error=error)
+        self.failed += 1
+        SENDS.inc("failed")
+        self.dead_letters.append(
+            DeadLetter(delivery.chat_id, delivery.message, delivery.attempts, str(error))
+        )
+        logging.error(
+            f"Giving up on message to {delivery.chat_id} after "
+            f"{delivery.attempts} attempt(s): {error}"
+        )
+        self._finish(delivery)
+        if not delivery.future.done():
+            delivery.future.set_exception(error)
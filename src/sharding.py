@@ -0,0 +1,152 @@
+"""
+Split scheduled dispatch across several bot replicas.
+
+Chats are mapped to DISPATCH_SHARDS shards by chat_id. Each replica keeps a
+heartbeat in the ``replicas`` table and leases roughly its fair share of
+shards in ``shard_leases``; leases of a dead replica expire after
+SHARD_LEASE_SECONDS and are picked up by the survivors. Before sending, the
+dispatcher records every (schedule, minute) in ``schedule_fires`` so a fire
+happens exactly once even while a shard changes hands.
+"""
+import os
+import math
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import FrozenSet, List, Optional, Set
+
+from db import claim_fires, claim_shards, heartbeat_replica, prune_fires, release_shards, run_async
+from metrics import Gauge
+
+# Number of dispatch shards; 0 disables sharding (single replica)
+DISPATCH_SHARDS = int(os.environ.get("DISPATCH_SHARDS", "0"))
+# Seconds a shard lease or heartbeat stays valid without renewal
+SHARD_LEASE_SECONDS = float(os.environ.get("SHARD_LEASE_SECONDS", "30"))
+# Days of fire records kept for exactly-once checks
+FIRE_RETENTION_DAYS = int(os.environ.get("FIRE_RETENTION_DAYS", "2"))
+
+SHARDS_HELD = Gauge("autosend_shards_held", "Dispatch shards leased by this replica")
+
+
+def default_replica_id() -> str:
+    """Return an id unique to this process."""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def shard_of(chat_id: int, shard_count: int) -> int:
+    """Map a chat to its shard."""
+    return chat_id % shard_count
+
+
+class ShardCoordinator:
+    """Lease a fair share of shards and claim fires for them."""
+
+    def __init__(
+        self,
+        shard_count: int = DISPATCH_SHARDS,
+        lease_seconds: float = SHARD_LEASE_SECONDS,
+        replica_id: Optional[str] = None,
+    ) -> None:
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.replica_id = replica_id or default_replica_id()
+        self.shards: FrozenSet[int] = frozenset()
+        # Shards taken over since the dispatcher last asked, for catch-up
+        self._gained: Set[int] = set()
+        # Wall-clock time the leases lapsed, if some gained shards were
+        # held again after a lapse rather than taken over
+        self.lapsed_at: Optional[float] = None
+        # Leases are only trusted locally until shortly before they expire
+        self._valid_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        SHARDS_HELD.set_function(lambda: len(self.owned()))
+
+    def owned(self) -> FrozenSet[int]:
+        """Shards currently held, or none if the leases may have lapsed."""
+        if time.monotonic() > self._valid_until:
+            return frozenset()
+        return self.shards
+
+    def owns(self, chat_id: int) -> bool:
+        """Whether this replica dispatches for the chat."""
+        return shard_of(chat_id, self.shard_count) in self.owned()
+
+    def renew(self) -> FrozenSet[int]:
+        """Heartbeat, then renew and rebalance leases (blocking)."""
+        started = time.monotonic()
+        replicas = max(1, heartbeat_replica(self.replica_id, self.lease_seconds))
+        target = math.ceil(self.shard_count / replicas)
+        held = claim_shards(self.replica_id, self.shard_count, target, self.lease_seconds)
+        shards = frozenset(held)
+        previous = self.shards
+        if previous and started > self._valid_until:
+            # owned() was empty since the lapse, so every fire in it was
+            # dropped; shards held again are caught up like taken-over ones
+            lapsed_at = time.time() - (started - self._valid_until)
+            if self.lapsed_at is None or lapsed_at < self.lapsed_at:
+                self.lapsed_at = lapsed_at
+            logging.warning(f"Replica {self.replica_id} renewed its shard leases after they lapsed")
+            previous = frozenset()
+        self._gained |= shards - previous
+        if shards != self.shards:
+            logging.info(
+                f"Replica {self.replica_id} now holds {len(shards)}/{self.shard_count} "
+                f"shards ({replicas} live replicas)"
+            )
+        self.shards = shards
+        # Leave a margin so a slow renewal never overlaps another holder
+        self._valid_until = started + self.lease_seconds * 0.8
+        return shards
+
+    def pop_gained(self) -> FrozenSet[int]:
+        """Return and forget the shards acquired since the last call."""
+        gained = frozenset(self._gained)
+        self._gained.clear()
+        self.lapsed_at = None
+        return gained
+
+    async def claim(self, schedule_ids: List[int], epoch_minute: int) -> List[int]:
+        """Return the schedules not yet fired for this minute, marking them fired."""
+        fire_at = datetime.fromtimestamp(epoch_minute * 60, timezone.utc)
+        return await run_async(claim_fires, schedule_ids, fire_at)
+
+    async def run(self) -> None:
+        """Renew leases every third of the lease time and prune old fire records."""
+        last_prune = 0.0
+        while True:
+            try:
+                await run_async(self.renew)
+                if time.monotonic() - last_prune > 3600:
+                    cutoff = datetime.now(timezone.utc) - timedelta(days=FIRE_RETENTION_DAYS)
+                    await run_async(prune_fires, cutoff)
+                    last_prune = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error renewing shard leases: {e}")
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    async def start(self) -> None:
+        """Take the first leases, then keep renewing them in the background."""
+        try:
+            await run_async(self.renew)
+        except Exception as e:
+            logging.error(f"Error taking shard leases: {e}")
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop renewing and hand the shards back immediately."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.shards = frozenset()
+        try:
+            await run_async(release_shards, self.replica_id)
+        except Exception as e:
+            logging.error(f"Error releasing shard leases: {e}")
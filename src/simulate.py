@@ -0,0 +1,494 @@
+"""
+Time-warp dispatch simulation: replay a day of scheduled sends in seconds.
+
+Loads the stored schedules (or generates synthetic ones) and runs the real
+Dispatcher and SendQueue on a virtual clock, against a fake bot that only
+records what it is asked to send. The event loop's clock, ``time.time``
+and ``time.monotonic`` all follow the virtual clock, which jumps straight
+to the next timer whenever nothing is ready. Waiting for the next minute,
+rate limiting and the fake bot's latency therefore cost no real time, and
+a day of dispatch replays as fast as the dispatcher and send queue can
+run.
+
+The report covers:
+
+- every send attempt, with planned and actual (virtual) times, optionally
+  written to a CSV file
+- lateness against the planned time
+- peak sends per minute, in-flight sends and queue depth
+- the real time the dispatcher spent per minute
+
+Sends are checked against fires worked out separately from each schedule's
+local times, timezone and days. The dispatcher compiles times with the
+UTC offsets in effect when the simulation is run, as the in-memory
+dispatcher does. A simulated window where a zone's offset differs, such as
+one across a DST change, shows that zone's moved fires as missing and
+unexpected.
+
+Usage: python src/simulate.py [--hours 24] [--start 2026-10-17T00:00]
+       [--synthetic N] [--latency 0.05] [--out sends.csv]
+"""
+import csv
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import selectors
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Iterator, List, Optional, TextIO, Tuple
+
+from telegram.error import RetryAfter
+
+from db import close_pool, get_all_schedules
+from dispatcher import DISPATCH_JITTER_MINUTES, MINUTES_PER_DAY, Dispatcher, chat_offset
+from recurrence import DayFilter, day_filter
+from schedules import Schedule, minutes_of
+from sender import SEND_CONCURRENCY, SEND_RATE, SendQueue
+from timezones import DEFAULT_TIMEZONE, zone
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Shortest virtual wait; a timer due "now" after rounding would never let time pass
+_MIN_STEP = 1e-6
+# Fires that went missing or were unexpected, listed in the report
+_REPORT_EXAMPLES = 10
+
+
+class VirtualClock:
+    """A clock that only moves when the simulation moves it.
+
+    Elapsed seconds (the monotonic and event loop time) count from zero, so
+    short waits keep their precision; epoch time adds them to the start.
+    """
+
+    def __init__(self, epoch: float) -> None:
+        self.epoch = epoch
+        self.elapsed = 0.0
+
+    def time(self) -> float:
+        return self.epoch + self.elapsed
+
+    def monotonic(self) -> float:
+        return self.elapsed
+
+    def advance(self, seconds: float) -> None:
+        self.elapsed += seconds
+
+
+class _WarpSelector(selectors.DefaultSelector):
+    # Polls without blocking; a wait for a timer advances the clock instead
+    def __init__(self, clock: VirtualClock) -> None:
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout: Optional[float] = None) -> List[Tuple[Any, int]]:
+        if timeout is None:
+            # Nothing scheduled: only real I/O can wake the loop
+            return super().select(None)
+        events = super().select(0)
+        if not events and timeout > 0:
+            self._clock.advance(timeout)
+        return events
+
+
+class WarpEventLoop(asyncio.SelectorEventLoop):
+    """Event loop running on a VirtualClock."""
+
+    def __init__(self, clock: VirtualClock) -> None:
+        super().__init__(_WarpSelector(clock))
+        self._clock = clock
+
+    def time(self) -> float:
+        return self._clock.monotonic()
+
+    def call_at(self, when: float, callback: Any, *args: Any, **kwargs: Any) -> asyncio.TimerHandle:
+        return super().call_at(max(when, self.time() + _MIN_STEP), callback, *args, **kwargs)
+
+
+@contextmanager
+def virtual_time(clock: VirtualClock) -> Iterator[None]:
+    """Make ``time.time`` and ``time.monotonic`` read the virtual clock."""
+    real_time, real_monotonic = time.time, time.monotonic
+    time.time, time.monotonic = clock.time, clock.monotonic
+    try:
+        yield
+    finally:
+        time.time, time.monotonic = real_time, real_monotonic
+
+
+class FakeBot:
+    """Stand-in for the Bot API that records sends and tracks concurrency."""
+
+    def __init__(self, latency: float, error_rate: float, retry_after: int, seed: int = 1) -> None:
+        self._latency = latency
+        self._error_rate = error_rate
+        self._retry_after = retry_after
+        self._random = random.Random(seed)
+        self._next_message_id = 1
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rate_limited = 0
+
+    async def send(self, chat_id: int, message: Any) -> SimpleNamespace:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            if self._random.random() < self._error_rate:
+                self.rate_limited += 1
+                raise RetryAfter(self._retry_after)
+            message_id = self._next_message_id
+            self._next_message_id += 1
+            return SimpleNamespace(message_id=message_id, chat_id=chat_id)
+        finally:
+            self.in_flight -= 1
+
+
+class Recorder:
+    """Collect every send attempt the queue reports, optionally as CSV rows."""
+
+    def __init__(self, out: Optional[TextIO] = None) -> None:
+        self._writer = csv.writer(out) if out is not None else None
+        if self._writer is not None:
+            self._writer.writerow(
+                ("planned_at", "attempted_at", "lateness_seconds", "schedule_id", "chat_id", "status", "error")
+            )
+        self.fires: Counter = Counter()
+        self.lateness: List[float] = []
+        self.per_minute: Counter = Counter()
+        self.statuses: Counter = Counter()
+
+    def record(
+        self,
+        schedule_id: Optional[int],
+        chat_id: int,
+        planned_at: Optional[float],
+        status: str,
+        latency: float,
+        message_id: Optional[int],
+        error: Optional[str],
+    ) -> None:
+        now = time.time()
+        self.statuses[status] += 1
+        # A fire is made once it is sent or given up on
+        if status != "retry" and planned_at is not None:
+            self.fires[(schedule_id, chat_id, int(planned_at // 60))] += 1
+            if status == "sent":
+                self.lateness.append(now - planned_at)
+                self.per_minute[int(now // 60)] += 1
+        if self._writer is not None:
+            self._writer.writerow(
+                (
+                    _iso(planned_at) if planned_at is not None else "",
+                    _iso(now),
+                    f"{now - planned_at:.3f}" if planned_at is not None else "",
+                    schedule_id,
+                    chat_id,
+                    status,
+                    error or "",
+                )
+            )
+
+
+class TimedDispatcher(Dispatcher):
+    """Dispatcher that measures the real time each minute's tick takes."""
+
+    def __init__(self, *args: Any, queue: Optional[SendQueue] = None, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._queue = queue
+        self.ticks: List[Tuple[int, float]] = []
+        self.peak_depth = 0
+
+    async def tick(self, epoch_minute: int) -> None:
+        started = time.perf_counter()
+        await super().tick(epoch_minute)
+        self.ticks.append((epoch_minute, time.perf_counter() - started))
+        if self._queue is not None:
+            # Everything due is queued by now, so this is the minute's peak
+            self.peak_depth = max(self.peak_depth, self._queue.depth)
+
+
+def _iso(epoch_seconds: float) -> str:
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _fires_on(days: DayFilter, local_date: date) -> bool:
+    # The day masks checked against a local calendar date, not a day number
+    day = local_date.toordinal() - _EPOCH_ORDINAL
+    if days.first_day is not None and day < days.first_day:
+        return False
+    if days.last_day is not None and day > days.last_day:
+        return False
+    return bool((days.weekdays >> local_date.weekday()) & 1) and bool(
+        (days.monthdays >> (local_date.day - 1)) & 1
+    )
+
+
+def expected_fires(schedules: List[Schedule], start: int, end: int, jitter_minutes: int) -> Counter:
+    """Count the fires due in [start, end) epoch minutes, from local dates and times."""
+    fires: Counter = Counter()
+    first = datetime.fromtimestamp(start * 60, timezone.utc).date() - timedelta(days=1)
+    days = (end - start) // MINUTES_PER_DAY + 3
+    for schedule in schedules:
+        try:
+            tz = zone(schedule.timezone or DEFAULT_TIMEZONE)
+        except ValueError:
+            continue
+        offset = chat_offset(schedule.chat_id, jitter_minutes)
+        for n in range(days):
+            local_date = first + timedelta(days=n)
+            if schedule.days is not None and not _fires_on(schedule.days, local_date):
+                continue
+            for minute in schedule.minutes:
+                local = datetime.combine(local_date, dtime(minute // 60, minute % 60), tzinfo=tz)
+                planned = int(local.timestamp() // 60) + offset
+                if start <= planned < end:
+                    for chat_id in schedule.chat_ids:
+                        fires[(schedule.id, chat_id, planned)] += 1
+    return fires
+
+
+def synthetic_schedules(count: int, seed: int = 1) -> List[Schedule]:
+    """Generate schedules shaped like real ones: round times, a few zones, some rules."""
+    rng = random.Random(seed)
+    zones = ("UTC", "Europe/Berlin", "America/New_York", "Asia/Kolkata")
+    common = ("08:00", "09:00", "09:30", "12:00", "13:00", "17:30", "18:00", "20:00")
+    texts = [f"Reminder #{i}: stand-up in the main channel." for i in range(200)]
+    schedules = []
+    for i in range(count):
+        chat_id = -1_000_000_000 - i // 5
+        tz = rng.choice(zones)
+        times = rng.sample(common, rng.randint(1, 3))
+        if rng.random() < 0.1:
+            # Hand-picked, off the hour
+            times.append(f"{rng.randrange(24):02d}:{rng.randrange(60):02d}")
+        rule, days = None, None
+        if rng.random() < 0.2:
+            rule, days = f"weekdays {', '.join(sorted(times))}", day_filter(tz, 0b0011111, None, None, None)
+        # A few broadcasts to several chats
+        chat_ids = (chat_id, chat_id - 1, chat_id - 2) if rng.random() < 0.05 else None
+        schedules.append(
+            Schedule(
+                i + 1,
+                1_000_000 + i // 20,
+                chat_id,
+                rng.choice(texts),
+                minutes_of(times),
+                tz,
+                chat_ids=chat_ids,
+                rule=rule,
+                days=days,
+            )
+        )
+    return schedules
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _minute_label(epoch_minute: int) -> str:
+    return datetime.fromtimestamp(epoch_minute * 60, timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+async def simulate(
+    schedules: List[Schedule],
+    start: int,
+    end: int,
+    bot: FakeBot,
+    recorder: Recorder,
+    jitter_minutes: int,
+    rate: float,
+    concurrency: int,
+) -> Tuple[TimedDispatcher, SendQueue]:
+    """Dispatch [start, end) epoch minutes on the running (virtual) clock and drain the queue."""
+    queue = SendQueue(bot.send, rate=rate, concurrency=concurrency, on_attempt=recorder.record)
+    dispatcher = TimedDispatcher(
+        lambda chat_id, message, schedule_id, planned_at: _submit(
+            queue, chat_id, message, schedule_id, planned_at
+        ),
+        jitter_minutes=jitter_minutes,
+        queue=queue,
+    )
+    dispatcher.load(schedules)
+    queue.start()
+    dispatcher.start()
+    # The last minute fires at (end - 1) * 60; stop before the next would
+    await asyncio.sleep(max(0.0, end * 60 - 1 - time.time()))
+    await dispatcher.stop()
+    await queue.drain()
+    await queue.stop()
+    return dispatcher, queue
+
+
+async def _submit(queue: SendQueue, chat_id: int, message: Any, schedule_id: int, planned_at: float) -> None:
+    # As bot.send_scheduled_message: queue it, the queue reports the outcome
+    queue.submit(chat_id, message, schedule_id, planned_at)
+
+
+def run(
+    schedules: List[Schedule],
+    start: int,
+    hours: float,
+    bot: FakeBot,
+    recorder: Recorder,
+    jitter_minutes: int = DISPATCH_JITTER_MINUTES,
+    rate: float = SEND_RATE,
+    concurrency: int = SEND_CONCURRENCY,
+) -> Tuple[TimedDispatcher, SendQueue]:
+    """Run the simulation from epoch minute ``start`` on its own virtual-time event loop."""
+    end = start + int(hours * 60)
+    # One second before the first minute, so the dispatcher fires it
+    clock = VirtualClock(start * 60 - 1)
+    loop = WarpEventLoop(clock)
+    try:
+        with virtual_time(clock):
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(
+                simulate(schedules, start, end, bot, recorder, jitter_minutes, rate, concurrency)
+            )
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def format_report(
+    schedules: List[Schedule],
+    start: int,
+    hours: float,
+    jitter_minutes: int,
+    dispatcher: TimedDispatcher,
+    queue: SendQueue,
+    bot: FakeBot,
+    recorder: Recorder,
+    concurrency: int,
+    seconds: float,
+) -> str:
+    """Render the simulation results as plain text."""
+    end = start + int(hours * 60)
+    stats = dispatcher.stats()
+    lines = [
+        f"Simulated {hours:g}h from {_minute_label(start)} UTC in {seconds:.2f}s "
+        f"({hours * 3600 / seconds:.0f}x real time)",
+        f"Schedules: {len(schedules)} across {stats['minutes']} distinct minutes",
+        "",
+        f"Send attempts: {recorder.statuses['sent']} sent, {recorder.statuses['retry']} retried, "
+        f"{recorder.statuses['failed']} dead-lettered ({bot.rate_limited} 429s injected)",
+    ]
+
+    expected = expected_fires(schedules, start, end, jitter_minutes)
+    missing = expected - recorder.fires
+    unexpected = recorder.fires - expected
+    duplicated = sum(count - 1 for count in recorder.fires.values() if count > 1)
+    lines.append(
+        f"Fires: {sum(recorder.fires.values())} made, {sum(expected.values())} expected; "
+        f"{sum(missing.values())} missing, {sum(unexpected.values())} unexpected, "
+        f"{duplicated} duplicated"
+    )
+    for label, fires in (("Missing", missing), ("Unexpected", unexpected)):
+        for schedule_id, chat_id, minute in sorted(fires)[:_REPORT_EXAMPLES]:
+            lines.append(f"  {label}: schedule {schedule_id} to {chat_id} at {_minute_label(minute)}")
+
+    ordered = sorted(recorder.lateness)
+    late = sum(1 for seconds_late in ordered if seconds_late >= 60)
+    lines += [
+        "",
+        f"Lateness (sent - planned): p50 {_percentile(ordered, 0.5):.2f}s, "
+        f"p90 {_percentile(ordered, 0.9):.2f}s, p99 {_percentile(ordered, 0.99):.2f}s, "
+        f"max {ordered[-1] if ordered else 0:.2f}s; {late} sent a minute or more late",
+    ]
+    if recorder.per_minute:
+        minute, count = max(recorder.per_minute.items(), key=lambda item: (item[1], -item[0]))
+        lines.append(f"Peak: {count} sends in the minute of {_minute_label(minute)}")
+    lines.append(
+        f"Peak concurrency: {bot.peak_in_flight} sends in flight (of {concurrency} workers), "
+        f"{dispatcher.peak_depth} queued"
+    )
+
+    costs = [cost for _, cost in dispatcher.ticks]
+    if costs:
+        minute, worst = max(dispatcher.ticks, key=lambda item: item[1])
+        lines.append(
+            f"Dispatcher: {len(costs)} ticks, {sum(costs) * 1000:.1f}ms in total, "
+            f"{sum(costs) / len(costs) * 1000:.3f}ms per tick, "
+            f"slowest {worst * 1000:.2f}ms at {_minute_label(minute)}"
+        )
+    if queue.dead_letters:
+        lines.append(f"Dead letters kept: {len(queue.dead_letters)}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    """Replay dispatch of the stored (or synthetic) schedules and print a report."""
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hours", type=float, default=24, help="simulated hours (default 24)")
+    parser.add_argument(
+        "--start",
+        type=datetime.fromisoformat,
+        help="first simulated minute, UTC (default: the start of today)",
+    )
+    parser.add_argument(
+        "--synthetic", type=int, default=0, help="simulate N generated schedules instead of the database"
+    )
+    parser.add_argument(
+        "--jitter",
+        type=int,
+        default=DISPATCH_JITTER_MINUTES,
+        help="per-chat jitter window in minutes (default: DISPATCH_JITTER_MINUTES)",
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Bot API latency per send in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429s")
+    parser.add_argument("--send-rate", type=float, default=SEND_RATE, help="global sends per second (default: SEND_RATE)")
+    parser.add_argument(
+        "--concurrency", type=int, default=SEND_CONCURRENCY, help="send workers (default: SEND_CONCURRENCY)"
+    )
+    parser.add_argument("--out", help="write every send attempt to this CSV file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        schedules = synthetic_schedules(args.synthetic)
+    else:
+        try:
+            schedules = get_all_schedules()
+        except Exception as e:
+            logging.error(f"Error loading schedules: {e}")
+            sys.exit(1)
+        finally:
+            close_pool()
+
+    start_at = args.start or datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if start_at.tzinfo is None:
+        start_at = start_at.replace(tzinfo=timezone.utc)
+    start = int(start_at.timestamp() // 60)
+
+    out = open(args.out, "w", newline="") if args.out else None
+    try:
+        bot = FakeBot(args.latency, args.error_rate, args.retry_after)
+        recorder = Recorder(out)
+        started = time.perf_counter()
+        dispatcher, queue = run(
+            schedules, start, args.hours, bot, recorder, args.jitter, args.send_rate, args.concurrency
+        )
+        seconds = time.perf_counter() - started
+    finally:
+        if out is not None:
+            out.close()
+    print(
+        format_report(
+            schedules, start, args.hours, args.jitter, dispatcher, queue, bot, recorder,
+            args.concurrency, seconds,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
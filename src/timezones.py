@@ -0,0 +1,91 @@
+"""
+Timezone math for schedules: local "HH:MM" times in a chat's IANA timezone
+compiled to UTC minutes of day.
+
+A zone's UTC offset only changes at DST (or legislative) transitions, so
+the offset is computed once and cached together with the next transition.
+Fire minutes compiled with that offset stay correct until then; only zones
+whose transition has passed need recompiling.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+# Timezone of chats that have not set one
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "UTC")
+
+_MINUTES_PER_DAY = 24 * 60
+# Transitions are searched this far ahead; a zone without one is treated
+# as fixed for this long
+_HORIZON_DAYS = 400
+
+# zone name -> (UTC offset in minutes, moment the offset stops being valid)
+_offsets: Dict[str, Tuple[int, datetime]] = {}
+
+
+@lru_cache(maxsize=None)
+def zone(name: str) -> ZoneInfo:
+    """Return the zone for an IANA name, raising ValueError if it is unknown."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"unknown timezone: {name}") from e
+
+
+@lru_cache(maxsize=1)
+def _names_by_lower() -> Dict[str, str]:
+    return {name.lower(): name for name in available_timezones()}
+
+
+def normalize(name: str) -> str:
+    """Return the canonical spelling of a zone name, raising ValueError if unknown."""
+    name = name.strip()
+    name = _names_by_lower().get(name.lower(), name)
+    zone(name)
+    return name
+
+
+def offset_at(name: str, moment: datetime) -> int:
+    """Return the UTC offset of a zone at an aware moment, in minutes."""
+    return int(moment.astimezone(zone(name)).utcoffset().total_seconds() // 60)
+
+
+def next_transition(name: str, after: datetime) -> datetime:
+    """Return the first minute after ``after`` with a different UTC offset.
+
+    Zones without a transition in the search horizon return the end of it.
+    """
+    start = after.replace(second=0, microsecond=0)
+    current = offset_at(name, start)
+    # Walk a day at a time, then bisect the day that changes to the minute
+    for day in range(_HORIZON_DAYS):
+        low = start + timedelta(days=day)
+        high = low + timedelta(days=1)
+        if offset_at(name, high) == current:
+            continue
+        low_minute, high_minute = 0, 24 * 60
+        while high_minute - low_minute > 1:
+            mid = (low_minute + high_minute) // 2
+            if offset_at(name, low + timedelta(minutes=mid)) == current:
+                low_minute = mid
+            else:
+                high_minute = mid
+        return low + timedelta(minutes=high_minute)
+    return start + timedelta(days=_HORIZON_DAYS)
+
+
+def current_offset(name: str, now: Optional[datetime] = None) -> Tuple[int, datetime]:
+    """Return (UTC offset in minutes, valid until) for a zone, cached until its next transition."""
+    now = datetime.now(timezone.utc) if now is None else now
+    cached = _offsets.get(name)
+    if cached is None or cached[1] <= now:
+        cached = (offset_at(name, now), next_transition(name, now))
+        _offsets[name] = cached
+    return cached
+
+
+def utc_minute(local_minute: int, offset: int) -> int:
+    """Convert a local minute of day to a UTC minute of day for a UTC offset."""
+    return (local_minute - offset) % _MINUTES_PER_DAY
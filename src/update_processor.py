@@ -0,0 +1,99 @@
+"""
+Concurrent update processing that keeps each user's and chat's updates in order.
+
+Up to UPDATE_CONCURRENCY updates run at once, but two updates from the same
+user, or about the same chat, never overlap: each update holds an asyncio
+lock per key while its handlers run. Conversation state and the read-then-
+write steps in the handlers therefore see one update at a time per user,
+while different users proceed in parallel.
+
+An update takes one of the UPDATE_CONCURRENCY slots only once it holds its
+locks. Updates queued behind a busy user wait without a slot, so one user
+sending a burst cannot hold up everyone else.
+"""
+import asyncio
+from typing import Any, Awaitable, Dict, List, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import Gauge
+
+UPDATE_LOCK_KEYS = Gauge(
+    "autosend_update_lock_keys", "User and chat keys with an update running or waiting"
+)
+
+# ("user" | "chat", id)
+LockKey = Tuple[str, int]
+# Concurrency passed to the base class, whose slot comes before the locks
+_UNBOUNDED = 2**31 - 1
+
+
+def update_keys(update: object) -> List[LockKey]:
+    """Return the lock keys of an update, always in the same order."""
+    if not isinstance(update, Update):
+        return []
+    keys = []
+    user = update.effective_user
+    chat = update.effective_chat
+    if user is not None:
+        keys.append(("user", user.id))
+    # A private chat has the user's id; one lock covers both
+    if chat is not None and (user is None or chat.id != user.id):
+        keys.append(("chat", chat.id))
+    return keys
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, serialized per user and per chat."""
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        # PTB's own semaphore is taken before do_process_update, so it is
+        # left effectively unbounded; the real limit is taken after the locks
+        super().__init__(_UNBOUNDED)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # key -> (lock, number of updates holding or waiting for it)
+        self._locks: Dict[LockKey, Tuple[asyncio.Lock, int]] = {}
+        UPDATE_LOCK_KEYS.set_function(lambda: len(self._locks))
+
+    def _acquire_ref(self, key: LockKey) -> asyncio.Lock:
+        lock, refs = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, refs + 1)
+        return lock
+
+    def _release_ref(self, key: LockKey) -> None:
+        lock, refs = self._locks[key]
+        if refs <= 1:
+            del self._locks[key]
+        else:
+            self._locks[key] = (lock, refs - 1)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Locks are taken in a fixed order (user, then chat), so two updates
+        # can never wait on each other. Only then is a slot taken: updates
+        # waiting for a busy user's lock hold none that others could run in
+        keys = update_keys(update)
+        held = []
+        try:
+            for key in keys:
+                lock = self._acquire_ref(key)
+                try:
+                    await lock.acquire()
+                except BaseException:
+                    self._release_ref(key)
+                    raise
+                held.append((key, lock))
+            async with self._slots:
+                await coroutine
+        finally:
+            for key, lock in reversed(held):
+                lock.release()
+                self._release_ref(key)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass